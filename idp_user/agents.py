@@ -1,11 +1,23 @@
-import faust
+import asyncio
+import itertools
+import json
+import logging
+from collections import defaultdict
+from typing import Callable, Optional
+
 from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db import close_old_connections
 from django.utils.module_loading import import_string
 from faust import StreamT
+from faust.types import EventT
 
 from idp_user.services import UserService
-from idp_user.settings import IDP_ENVIRONMENT
+from idp_user.settings import IDP_ENVIRONMENT, USER_UPDATES_CONSUMER
+from idp_user.utils.lanes import OrderedLanes, get_lane
+from idp_user.utils.typing import UserRecordDict
+
+logger = logging.getLogger(__name__)
 
 app = import_string(settings.IDP_USER_APP["FAUST_APP_PATH"])
 
@@ -31,43 +43,191 @@ app = import_string(settings.IDP_USER_APP["FAUST_APP_PATH"])
 """
 
 
-class UserRecord(faust.Record):
-    first_name: str
-    last_name: str
-    username: str
-    email: str
-    is_active: bool
-    is_staff: bool
-    is_superuser: bool
-    date_joined: str
-    app_specific_configs: dict
-    is_demo: bool
+USER_UPDATES_TOPIC_NAME = f"{IDP_ENVIRONMENT}_user_updates"
+USER_UPDATES_BATCH_SIZE = USER_UPDATES_CONSUMER.get("BATCH_SIZE", 1)
+USER_UPDATES_BATCH_WINDOW = USER_UPDATES_CONSUMER.get("BATCH_WINDOW", 1.0)
+USER_UPDATES_CONCURRENCY = USER_UPDATES_CONSUMER.get("CONCURRENCY", 1)
+USER_UPDATES_MAX_IN_FLIGHT = USER_UPDATES_CONSUMER.get("MAX_IN_FLIGHT", 100)
 
+# Messages are decoded by decode_user_record into plain dicts, not deserialized into Faust records
+user_updates = app.topic(USER_UPDATES_TOPIC_NAME, value_serializer="raw")
 
-USER_UPDATES_TOPIC_NAME = f"{IDP_ENVIRONMENT}_user_updates"
 
-user_updates = app.topic(USER_UPDATES_TOPIC_NAME, value_type=UserRecord)
+def decode_user_record(message: bytes) -> Optional[UserRecordDict]:
+    """
+    Decode the raw message into a plain dict, which is much cheaper than building a Faust record.
+    Returns None for the messages that are not user records, which are logged and skipped.
+    """
+    try:
+        user_record = json.loads(message)
+    except ValueError as error:
+        logger.error(f"Skipping user update that cannot be decoded: {error}")
+        return None
+
+    if not isinstance(user_record, dict) or "username" not in user_record:
+        logger.error(
+            f"Skipping user update that is not a user record: {message[:200]!r}"
+        )
+        return None
+
+    # Metadata added by Faust, if the message has been produced as a Faust record
+    user_record.pop("__faust", None)
+    return user_record
+
+
+def run_in_thread(function: Callable) -> Callable:
+    """
+    With a concurrency of 1, the function runs in the single thread used by sync_to_async.
+    Otherwise, it runs in a thread of the default executor, with its own database connection,
+    so that the lanes can update the database in parallel.
+    """
+    if USER_UPDATES_CONCURRENCY == 1:
+        return sync_to_async(function)
+
+    def run(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(run, thread_sensitive=False)
 
 
-async def update_user(user_record: UserRecord):
-    await sync_to_async(UserService.process_user)(user_record.asdict())
+async def update_user(user_record: UserRecordDict):
+    await run_in_thread(UserService.process_user)(user_record)
 
 
-async def verify_if_user_exists_and_delete_roles(user_record: UserRecord):
-    await sync_to_async(UserService.verify_if_user_exists_and_delete_roles)(
-        user_record.asdict()
+async def verify_if_user_exists_and_delete_roles(user_record: UserRecordDict):
+    await run_in_thread(UserService.verify_if_user_exists_and_delete_roles)(user_record)
+
+
+async def process_user_record(user_record: UserRecordDict):
+    if has_access_in_app(user_record):
+        await update_user(user_record)
+    else:
+        # Having arrived here means that the user does not have access in the current app
+        # Verify however if the user already exists in the database of any tenant
+        # If this is the case, delete his/her roles
+        await verify_if_user_exists_and_delete_roles(user_record)
+
+
+# The consecutive records of a user with the same access to the app
+UserRecordsSegment = tuple[bool, list[UserRecordDict]]
+
+
+async def update_users(messages: list[bytes]):
+    """
+    Process a batch of user records, with the same outcome as processing them one by one.
+
+    The consecutive records of a user with access to the app are applied together by process_users,
+    which keeps the last record of the user in each tenant. The records without access delete the roles
+    of the user in all the tenants, so they are applied in order between the others.
+    With a concurrency greater than 1, the users are split between the lanes, which are processed concurrently.
+    """
+    segments: dict[str, list[UserRecordsSegment]] = {}
+    for message in messages:
+        user_record = decode_user_record(message)
+        if user_record is None:
+            continue
+
+        has_access = has_access_in_app(user_record)
+        user_segments = segments.setdefault(user_record["username"], [])
+        if user_segments and user_segments[-1][0] == has_access:
+            user_segments[-1][1].append(user_record)
+        else:
+            user_segments.append((has_access, [user_record]))
+
+    if USER_UPDATES_CONCURRENCY == 1:
+        await process_user_records_segments(list(segments.values()))
+        return
+
+    lanes: dict[int, list[list[UserRecordsSegment]]] = defaultdict(list)
+    for username, user_segments in segments.items():
+        lanes[get_lane(username, USER_UPDATES_CONCURRENCY)].append(user_segments)
+    await asyncio.gather(*map(process_user_records_segments, lanes.values()))
+
+
+async def process_user_records_segments(users_segments: list[list[UserRecordsSegment]]):
+    """
+    Apply the n-th segment of all the users at once, since the users are independent from each other.
+    Most users have a single segment in a batch.
+    """
+    for segments in itertools.zip_longest(*users_segments):
+        records_with_access = []
+        for segment in segments:
+            if segment is None:
+                continue
+
+            has_access, user_records = segment
+            if has_access:
+                records_with_access.extend(user_records)
+            else:
+                await verify_if_user_exists_and_delete_roles(user_records[-1])
+
+        if records_with_access:
+            await run_in_thread(UserService.process_users)(records_with_access)
+
+
+def has_access_in_app(user_record: UserRecordDict) -> bool:
+    """
+    Decided on the decoded record, since the records without access delete the roles of the user:
+    the app identifier may not appear as is in the raw message, e.g. if it is escaped.
+    """
+    return bool(
+        (user_record.get("app_specific_configs") or {}).get(
+            settings.IDP_USER_APP["APP_IDENTIFIER"]
+        )
     )
 
 
+@app.task
+async def load_username_index():
+    """
+    Load the usernames of all the tenants at startup, if the username index is configured.
+    """
+    await sync_to_async(UserService.load_username_index)()
+
+
 @app.agent(user_updates)
-async def update_user_stream_processor(user_records: StreamT[UserRecord]):
-    async for user_record in user_records:
-        if user_record.app_specific_configs.get(
-            settings.IDP_USER_APP["APP_IDENTIFIER"]
+async def update_user_stream_processor(messages: StreamT[bytes]):
+    if USER_UPDATES_BATCH_SIZE > 1:
+        async for messages_batch in messages.take(
+            USER_UPDATES_BATCH_SIZE, within=USER_UPDATES_BATCH_WINDOW
         ):
-            await update_user(user_record)
-        else:
-            # Having arrived here means that the user does not have access in the current app
-            # Verify however if the user already exists in the database of any tenant
-            # If this is the case, delete his/her roles
-            await verify_if_user_exists_and_delete_roles(user_record)
+            await update_users(messages_batch)
+        return
+
+    if USER_UPDATES_CONCURRENCY > 1:
+        await process_events_in_lanes(messages)
+        return
+
+    async for message in messages:
+        if (user_record := decode_user_record(message)) is not None:
+            await process_user_record(user_record)
+
+
+async def process_event(item: tuple[EventT, UserRecordDict]):
+    event, user_record = item
+    await process_user_record(user_record)
+    event.ack()
+
+
+async def process_events_in_lanes(messages: StreamT[bytes]):
+    """
+    The messages of each username are processed in order by the same lane.
+    Events are acknowledged only once they have been processed, since the lanes complete them out of order,
+    and Faust commits the offset of each partition only up to the first event that is not acknowledged yet.
+    """
+    async with OrderedLanes(
+        process_event,
+        concurrency=USER_UPDATES_CONCURRENCY,
+        max_in_flight=USER_UPDATES_MAX_IN_FLIGHT,
+    ) as lanes:
+        async for event in messages.noack().events():
+            user_record = decode_user_record(event.value)
+            if user_record is None:
+                event.ack()
+                continue
+
+            await lanes.submit(user_record["username"], (event, user_record))
+        await lanes.join()
@@ -1,7 +1,9 @@
+import django
 from django.apps import AppConfig
 from django.conf import settings
 
 
+from django.core.signals import request_finished
 from django.db.models.signals import post_delete, post_save
 
 
@@ -9,6 +11,15 @@ class IDPUserConfig(AppConfig):
     name = "idp_user"
 
     def ready(self):
+        from idp_user.models import User, UserRole, UserRoleEntityRestriction
+        from idp_user.services.username_index import process_user_post_save
+
+        post_save.connect(
+            receiver=UserRoleEntityRestriction.process_user_role_post_save,
+            sender=UserRole,
+        )
+        post_save.connect(receiver=process_user_post_save, sender=User)
+
         # If Kafka is not configured, do not register signals
         is_kafka_configured = getattr(settings, "KAFKA_ARN", None) or getattr(
             settings, "KAFKA_BROKER", None
@@ -16,8 +27,24 @@ class IDPUserConfig(AppConfig):
         if not is_kafka_configured:
             return
 
+        from idp_user.producer import flush_producer, get_kafka_producer_config
         from idp_user.services.base_user import BaseUserService
-        from idp_user.settings import APP_ENTITIES
+        from idp_user.settings import APP_ENTITIES, ASYNC_APP_ENTITY_RECORD_EVENTS
+
+        if get_kafka_producer_config() is not None:
+            # Messages are not flushed one by one, make sure they leave with the response
+            request_finished.connect(receiver=flush_producer)
+
+        # Signals support async receivers since Django 5.0.
+        # Sync saves go through async_to_sync with async receivers, so they are opt-in.
+        if ASYNC_APP_ENTITY_RECORD_EVENTS and django.VERSION >= (5, 0):
+            post_save_receiver = BaseUserService.aprocess_app_entity_record_post_save
+            post_delete_receiver = (
+                BaseUserService.aprocess_app_entity_record_post_delete
+            )
+        else:
+            post_save_receiver = BaseUserService.process_app_entity_record_post_save
+            post_delete_receiver = BaseUserService.process_app_entity_record_post_delete
 
         for (
             _app_entity_type,
@@ -25,10 +52,10 @@ class IDPUserConfig(AppConfig):
         ) in APP_ENTITIES.items():
             model = config["model"]
             post_save.connect(
-                receiver=BaseUserService.process_app_entity_record_post_save,
+                receiver=post_save_receiver,
                 sender=model,
             )
             post_delete.connect(
-                receiver=BaseUserService.process_app_entity_record_post_delete,
+                receiver=post_delete_receiver,
                 sender=model,
             )
@@ -0,0 +1,67 @@
+import logging
+
+from django.conf import settings
+
+from idp_user.producer import AioKafkaProducer
+from idp_user.utils.http import close_idp_async_session
+
+logger = logging.getLogger(__name__)
+
+
+def is_kafka_configured() -> bool:
+    return bool(
+        getattr(settings, "KAFKA_ARN", None) or getattr(settings, "KAFKA_BROKER", None)
+    )
+
+
+class IDPUserLifespanMiddleware:
+    """
+    Handles the lifespan events of the ASGI server, which Django does not support:
+    the async Kafka producer is started on startup, so that app entity record events are sent with it,
+    and it is closed on shutdown together with the async session used for the requests to the IDP.
+
+    Usage, in asgi.py:
+        application = IDPUserLifespanMiddleware(get_asgi_application())
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "lifespan":
+            return await self.app(scope, receive, send)
+
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as error:
+                    logger.exception("Could not start the IDP user components")
+                    await send(
+                        {"type": "lifespan.startup.failed", "message": str(error)}
+                    )
+                    return
+                await send({"type": "lifespan.startup.complete"})
+
+            elif message["type"] == "lifespan.shutdown":
+                try:
+                    await self.shutdown()
+                except Exception as error:
+                    logger.exception("Could not stop the IDP user components")
+                    await send(
+                        {"type": "lifespan.shutdown.failed", "message": str(error)}
+                    )
+                    return
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def startup():
+        if is_kafka_configured():
+            await AioKafkaProducer().start()
+
+    @staticmethod
+    async def shutdown():
+        await AioKafkaProducer().close()
+        await close_idp_async_session()
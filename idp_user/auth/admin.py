@@ -1,12 +1,12 @@
 from typing import Optional
 
-import requests
 from django.conf import settings
 from django.contrib.auth.backends import ModelBackend
 from jwt.exceptions import InvalidTokenError
 
 from idp_user.models.user import User
 from idp_user.utils.functions import get_or_none, get_jwt_payload
+from idp_user.utils.http import idp_request
 
 IDP_URL = settings.IDP_USER_APP.get("IDP_URL")
 HTTP_200_OK = 200
@@ -28,7 +28,8 @@ class IDPAuthBackend(ModelBackend):
 
     @staticmethod
     def _fetch_token(request) -> Optional[str]:
-        response = requests.post(
+        response = idp_request(
+            "POST",
             url=f"{IDP_URL}/api/login/",
             json={
                 "username": request.POST.get("username"),
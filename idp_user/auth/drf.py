@@ -6,8 +6,9 @@ from rest_framework.authentication import get_authorization_header
 from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.request import Request
 
+from idp_user.auth.user_resolver import resolve_user
 from idp_user.models.user import User
-from idp_user.utils.functions import get_or_none, get_jwt_payload, authorize_request_with_idp
+from idp_user.utils.functions import get_jwt_payload, authorize_request_with_idp
 from idp_user.utils.typing import JwtData
 
 
@@ -22,9 +23,13 @@ class AuthenticationBackend(authentication.TokenAuthentication):
         return self.authenticate_credentials(token)
 
     def authenticate_credentials(self, token: str):
-        user = get_or_none(User.objects, username=self._get_username(token))
+        user = self._get_user(token)
         return user, self
 
+    @classmethod
+    def _get_user(cls, token: str) -> Optional[User]:
+        return resolve_user(cls._get_username(token), token)
+
     @classmethod
     def _get_username(cls, token) -> JwtData:
         try:
@@ -55,16 +60,16 @@ class AuthenticationBackend(authentication.TokenAuthentication):
             raise AuthenticationFailed("Invalid token header: not bearer.")
 
         if len(auth) == 1:
-            msg = 'Invalid token header. No credentials provided.'
+            msg = "Invalid token header. No credentials provided."
             raise AuthenticationFailed(msg)
         elif len(auth) > 2:
-            msg = 'Invalid token header. Token string should not contain spaces.'
+            msg = "Invalid token header. Token string should not contain spaces."
             raise AuthenticationFailed(msg)
 
         try:
             token = auth[1].decode()
         except UnicodeError:
-            msg = 'Invalid token header. Token string should not contain invalid characters.'
+            msg = "Invalid token header. Token string should not contain invalid characters."
             raise AuthenticationFailed(msg)
 
         return token
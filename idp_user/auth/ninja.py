@@ -2,13 +2,17 @@ import logging
 from typing import Optional
 
 from django.conf import settings
-from django.contrib.auth import get_user_model
 from django.http import HttpRequest
 from jwt import InvalidTokenError
 from ninja.errors import HttpError
 from ninja.security import HttpBearer
 
-from idp_user.utils.functions import get_jwt_payload, authorize_request_with_idp, authorize_request_with_idp_async
+from idp_user.auth.user_resolver import aresolve_user, resolve_user
+from idp_user.utils.functions import (
+    get_jwt_payload,
+    authorize_request_with_idp,
+    authorize_request_with_idp_async,
+)
 
 logger = logging.getLogger()
 
@@ -59,15 +63,14 @@ class NinjaAuthBearer(HttpBearer):
         except InvalidTokenError:
             return None
 
-        return jwt_payload.get('username')
+        return jwt_payload.get("username")
 
     def authenticate(self, request, token):
         username = self._get_username(token)
         if not username:
             return None
 
-        user_model = get_user_model()
-        user = user_model.objects.filter(username=username).first()
+        user = resolve_user(username, token)
 
         if user:
             request.user = user
@@ -92,8 +95,7 @@ class NinjaAuthBearerAsync(NinjaAuthBearer):
         if not username:
             return None
 
-        user_model = get_user_model()
-        user = await user_model.objects.filter(username=username).afirst()
+        user = await aresolve_user(username, token)
 
         if user:
             request.user = user
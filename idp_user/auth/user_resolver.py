@@ -0,0 +1,113 @@
+import copy
+import hashlib
+from functools import lru_cache
+from typing import Optional
+
+from django.conf import settings
+
+from idp_user.models import User
+from idp_user.utils.caches import LRUCache
+
+
+class UserResolver:
+    """
+    Resolves the users of the authenticated requests, keeping them in memory for a short time,
+    so that repeated authentications with the same token do not query the database.
+
+    Entries are keyed by the database and the username, and are only used for the same token.
+    They are dropped when the user is updated from the IDP in the same process.
+    """
+
+    def __init__(
+        self, ttl: float = 30, max_size: int = 10000, prefetch_roles: bool = False
+    ):
+        self.prefetch_roles = prefetch_roles
+        self._users = LRUCache(max_size=max_size, ttl=ttl)
+
+    @staticmethod
+    def _get_key(username: str) -> tuple[str, str]:
+        # The router decides the database of the tenant being accessed
+        return User.objects.db, username
+
+    @staticmethod
+    def _get_token_fingerprint(token: Optional[str]) -> Optional[str]:
+        if token is None:
+            return None
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def _get_queryset(self):
+        queryset = User.objects.all()
+        if self.prefetch_roles:
+            queryset = queryset.prefetch_related("user_roles")
+        return queryset
+
+    def _get_cached_user(self, key, token_fingerprint) -> Optional[User]:
+        entry = self._users.get(key)
+        if entry is None or entry[0] != token_fingerprint:
+            return None
+        # Requests must not share the same instance, since they might modify it
+        return copy.copy(entry[1])
+
+    def get_user(self, username: str, token: Optional[str] = None) -> Optional[User]:
+        key = self._get_key(username)
+        token_fingerprint = self._get_token_fingerprint(token)
+
+        if user := self._get_cached_user(key, token_fingerprint):
+            return user
+
+        if user := self._get_queryset().filter(username=username).first():
+            self._users.set(key, (token_fingerprint, user))
+            return copy.copy(user)
+
+    async def aget_user(
+        self, username: str, token: Optional[str] = None
+    ) -> Optional[User]:
+        key = self._get_key(username)
+        token_fingerprint = self._get_token_fingerprint(token)
+
+        if user := self._get_cached_user(key, token_fingerprint):
+            return user
+
+        if user := await self._get_queryset().filter(username=username).afirst():
+            self._users.set(key, (token_fingerprint, user))
+            return copy.copy(user)
+
+    def invalidate(self, username: str):
+        self._users.delete(self._get_key(username))
+
+    def clear(self):
+        self._users.clear()
+
+
+@lru_cache(maxsize=None)
+def get_user_resolver() -> Optional[UserResolver]:
+    """
+    Get the user resolver of the current process,
+    or None if IDP_USER_APP['USER_RESOLVER'] is not configured.
+    """
+    config = settings.IDP_USER_APP.get("USER_RESOLVER")
+    if config is None:
+        return None
+
+    return UserResolver(
+        ttl=config.get("TTL", 30),
+        max_size=config.get("MAX_SIZE", 10000),
+        prefetch_roles=config.get("PREFETCH_ROLES", False),
+    )
+
+
+def resolve_user(username: str, token: Optional[str] = None) -> Optional[User]:
+    if user_resolver := get_user_resolver():
+        return user_resolver.get_user(username, token)
+    return User.objects.filter(username=username).first()
+
+
+async def aresolve_user(username: str, token: Optional[str] = None) -> Optional[User]:
+    if user_resolver := get_user_resolver():
+        return await user_resolver.aget_user(username, token)
+    return await User.objects.filter(username=username).afirst()
+
+
+def invalidate_resolved_user(username: str):
+    if user_resolver := get_user_resolver():
+        user_resolver.invalidate(username)
@@ -1,27 +1,166 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
 
-from django.core.management import BaseCommand
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
+from idp_user.producer import Producer
 from idp_user.services import UserService
 from idp_user.settings import APP_ENTITIES
+from idp_user.utils.typing import AppEntityTypeConfig
 
 logger = logging.getLogger()
 
 
+def _parse_since(value: str) -> datetime:
+    since = parse_datetime(value)
+    if since is None:
+        raise ValueError(f"Invalid datetime: {value}")
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def _batched(iterable, batch_size: int):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
 class Command(BaseCommand):
     help = (
         "Put the data of the app entities that are used in the scope of authorization in Kafka, "
         "so that the IDP is notified."
     )
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--entity-type",
+            action="append",
+            dest="entity_types",
+            choices=list(APP_ENTITIES.keys()),
+            help="The app entity type to put in Kafka. Can be repeated. Defaults to all.",
+        )
+        parser.add_argument(
+            "--since",
+            type=_parse_since,
+            help="Only put the records updated since this datetime. "
+            "Requires 'updated_at_attr' in the config of the app entity type.",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="The number of app entity types processed concurrently.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Read the records without sending them to Kafka.",
+        )
+
     def handle(self, **options):
-        logger.info("Putting data of vehicles...")
-
-        for (
-            app_entity_type,
-            config,
-        ) in APP_ENTITIES.items():  # type: str, AppEntityTypeConfig
-            for record in config["model"].objects.all():
-                UserService.send_app_entity_record_event_to_kafka(
-                    app_entity_type=app_entity_type, app_entity_record=record
+        app_entity_types = options["entity_types"] or list(APP_ENTITIES.keys())
+        since = options["since"]
+
+        if since:
+            for app_entity_type in app_entity_types:
+                if not APP_ENTITIES[app_entity_type].get("updated_at_attr"):
+                    raise CommandError(
+                        f"--since requires 'updated_at_attr' in the config of {app_entity_type}."
+                    )
+
+        if not options["dry_run"]:
+            # Create the producer before starting the workers
+            Producer()
+
+        started_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, options["workers"])) as executor:
+            totals = executor.map(
+                lambda app_entity_type: self._put_app_entity_records(
+                    app_entity_type=app_entity_type,
+                    since=since,
+                    batch_size=options["batch_size"],
+                    dry_run=options["dry_run"],
+                ),
+                app_entity_types,
+            )
+            total = sum(totals)
+
+        if not options["dry_run"]:
+            Producer().flush()
+
+        elapsed = time.monotonic() - started_at
+        logger.info(
+            f"Put {total} records in {elapsed:.1f}s ({total / max(elapsed, 1e-6):.0f} records/s)."
+            + (" (dry run)" if options["dry_run"] else "")
+        )
+
+    def _put_app_entity_records(
+        self, app_entity_type: str, since: datetime, batch_size: int, dry_run: bool
+    ) -> int:
+        config: AppEntityTypeConfig = APP_ENTITIES[app_entity_type]
+        logger.info(f"Putting data of {app_entity_type}...")
+
+        try:
+            queryset = config["model"].objects.order_by()
+            if since:
+                queryset = queryset.filter(
+                    **{f"{config['updated_at_attr']}__gte": since}
+                )
+
+            count = 0
+            started_at = time.monotonic()
+            for records in _batched(
+                self._get_identifiers_and_labels(queryset, config, batch_size),
+                batch_size,
+            ):
+                events = [
+                    UserService._build_app_entity_record_event_from_values(
+                        app_entity_type=app_entity_type,
+                        record_identifier=record_identifier,
+                        label=label,
+                    )
+                    for record_identifier, label in records
+                ]
+                if not dry_run:
+                    UserService.send_app_entity_record_events_to_kafka(events)
+
+                count += len(events)
+                elapsed = time.monotonic() - started_at
+                logger.info(
+                    f"{app_entity_type}: {count} records ({count / max(elapsed, 1e-6):.0f} records/s)"
                 )
+
+            return count
+        finally:
+            # Each worker thread has its own database connections
+            connections.close_all()
+
+    @staticmethod
+    def _get_identifiers_and_labels(
+        queryset, config: AppEntityTypeConfig, batch_size: int
+    ):
+        """
+        Fetch only the identifier and the label of the records, unless they are not model fields.
+        """
+        try:
+            for attr in (config["identifier_attr"], config["label_attr"]):
+                queryset.model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            for record in queryset.iterator(chunk_size=batch_size):
+                yield getattr(record, config["identifier_attr"]), getattr(
+                    record, config["label_attr"]
+                )
+            return
+
+        yield from queryset.values_list(
+            config["identifier_attr"], config["label_attr"]
+        ).iterator(chunk_size=batch_size)
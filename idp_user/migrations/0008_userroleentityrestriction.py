@@ -0,0 +1,56 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_entity_restrictions(apps, schema_editor):
+    UserRole = apps.get_model('idp_user', 'UserRole')
+    UserRoleEntityRestriction = apps.get_model('idp_user', 'UserRoleEntityRestriction')
+    database = schema_editor.connection.alias
+
+    restrictions = []
+    for user_role in UserRole.objects.using(database).exclude(app_entities_restrictions=None).iterator():
+        for app_entity_type, identifiers in user_role.app_entities_restrictions.items():
+            if identifiers is None:
+                continue
+
+            restrictions.append(UserRoleEntityRestriction(user_role=user_role, app_entity_type=app_entity_type))
+            restrictions.extend(
+                UserRoleEntityRestriction(
+                    user_role=user_role, app_entity_type=app_entity_type, record_identifier=str(identifier)
+                )
+                for identifier in set(identifiers)
+            )
+
+        if len(restrictions) >= 1000:
+            UserRoleEntityRestriction.objects.using(database).bulk_create(restrictions)
+            restrictions = []
+
+    UserRoleEntityRestriction.objects.using(database).bulk_create(restrictions)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('idp_user', '0007_user_demo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserRoleEntityRestriction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('app_entity_type', models.CharField(max_length=140)),
+                ('record_identifier', models.CharField(
+                    help_text='The identifier of an accessible record, or null for the row marking the app entity type as restricted.',
+                    max_length=255, null=True)),
+                ('user_role', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, related_name='entity_restrictions',
+                    to='idp_user.userrole')),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['app_entity_type', 'record_identifier'], name='idp_user_restriction_record'),
+                ],
+            },
+        ),
+        migrations.RunPython(populate_entity_restrictions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,73 @@
+from django.db import migrations, models
+
+
+def populate_permission_restrictions(apps, schema_editor):
+    UserRole = apps.get_model('idp_user', 'UserRole')
+    UserRoleEntityRestriction = apps.get_model('idp_user', 'UserRoleEntityRestriction')
+    database = schema_editor.connection.alias
+
+    restrictions = []
+    for user_role in UserRole.objects.using(database).iterator():
+        for permission, restriction in (user_role.permission_restrictions or {}).items():
+            if not isinstance(restriction, dict):
+                continue
+
+            for app_entity_type, identifiers in restriction.items():
+                if not identifiers:
+                    continue
+
+                restrictions.append(
+                    UserRoleEntityRestriction(
+                        user_role=user_role, app_entity_type=app_entity_type, permission=permission
+                    )
+                )
+                restrictions.extend(
+                    UserRoleEntityRestriction(
+                        user_role=user_role,
+                        app_entity_type=app_entity_type,
+                        record_identifier=str(identifier),
+                        permission=permission,
+                    )
+                    for identifier in set(identifiers)
+                )
+
+        if len(restrictions) >= 1000:
+            UserRoleEntityRestriction.objects.using(database).bulk_create(restrictions)
+            restrictions = []
+
+    UserRoleEntityRestriction.objects.using(database).bulk_create(restrictions)
+
+
+def delete_permission_restrictions(apps, schema_editor):
+    UserRoleEntityRestriction = apps.get_model('idp_user', 'UserRoleEntityRestriction')
+    UserRoleEntityRestriction.objects.using(schema_editor.connection.alias).exclude(permission=None).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('idp_user', '0008_userroleentityrestriction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userroleentityrestriction',
+            name='permission',
+            field=models.CharField(
+                help_text='The restricted permission, or null for the restrictions of the role.',
+                max_length=140, null=True),
+        ),
+        migrations.RemoveIndex(
+            model_name='userroleentityrestriction',
+            name='idp_user_restriction_record',
+        ),
+        migrations.AddIndex(
+            model_name='userroleentityrestriction',
+            index=models.Index(
+                fields=['app_entity_type', 'record_identifier', 'permission'], name='idp_user_restriction_record'),
+        ),
+        migrations.AddIndex(
+            model_name='userroleentityrestriction',
+            index=models.Index(fields=['user_role', 'app_entity_type', 'permission'], name='idp_user_restriction_role'),
+        ),
+        migrations.RunPython(populate_permission_restrictions, delete_permission_restrictions),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('idp_user', '0009_userroleentityrestriction_permission'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='idp_payload_hash',
+            field=models.CharField(blank=True, editable=False, help_text='Hash of the last update of this user received from the IDP.', max_length=64, null=True),
+        ),
+    ]
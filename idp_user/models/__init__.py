@@ -1,2 +1,3 @@
 from .user import User
 from .user_role import UserRole
+from .user_role_entity_restriction import UserRoleEntityRestriction
@@ -0,0 +1,27 @@
+from django.db import models
+
+
+class AppEntityQuerySetMixin:
+    """
+    Adds authorization to the querysets of the models declared in IDP_USER_APP['APP_ENTITIES'], e.g.:
+
+        class Vehicle(models.Model):
+            objects = AppEntityQuerySet.as_manager()
+
+        Vehicle.objects.filter(active=True).allowed_for(user, role, permission)
+    """
+
+    def allowed_for(self, user, role: str, permission: str = None):
+        """
+        Keep the records that the user can access, filtered by the database with subqueries
+        on the restrictions of the user instead of lists of identifiers.
+        """
+        from idp_user.services import UserService
+
+        return UserService.filter_allowed_app_entity_records(
+            self, user=user, role=role, permission=permission
+        )
+
+
+class AppEntityQuerySet(AppEntityQuerySetMixin, models.QuerySet):
+    pass
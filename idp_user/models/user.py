@@ -3,4 +3,13 @@ from django.db import models
 
 
 class User(AbstractUser):
-    is_demo = models.BooleanField(default=False, null=False, help_text='Whether this user is a demo user.')
+    is_demo = models.BooleanField(
+        default=False, null=False, help_text="Whether this user is a demo user."
+    )
+    idp_payload_hash = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Hash of the last update of this user received from the IDP.",
+    )
@@ -0,0 +1,276 @@
+from typing import Any, Iterable, Optional
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.db.models import Exists, OuterRef, Q, Value
+from django.db.models.functions import Cast, Lower, Replace
+
+from .user_role import UserRole
+
+
+class UserRoleEntityRestriction(models.Model):
+    """
+    Normalized copy of the app_entities_restrictions and permission_restrictions of UserRole,
+    so that restrictions can be queried in SQL with indexes.
+
+    The rows are rebuilt whenever a user role is saved, whatever saves it (user services, admin, fixtures...).
+    Bulk operations and queryset updates do not send signals, and must call rebuild themselves.
+
+    Every app entity type restricted by a user role has a row with a null record_identifier,
+    and one row per record identifier that the user role can access.
+    Rows of permission restrictions have the permission set, the others have a null permission.
+    """
+
+    user_role = models.ForeignKey(
+        to="idp_user.UserRole",
+        related_name="entity_restrictions",
+        on_delete=models.CASCADE,
+    )
+    app_entity_type = models.CharField(max_length=140)
+    record_identifier = models.CharField(
+        max_length=255,
+        null=True,
+        help_text="The identifier of an accessible record, or null for the row marking the app entity type as restricted.",
+    )
+    permission = models.CharField(
+        max_length=140,
+        null=True,
+        help_text="The restricted permission, or null for the restrictions of the role.",
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["app_entity_type", "record_identifier", "permission"],
+                name="idp_user_restriction_record",
+            ),
+            models.Index(
+                fields=["user_role", "app_entity_type", "permission"],
+                name="idp_user_restriction_role",
+            ),
+        ]
+
+    @staticmethod
+    def to_record_identifier(identifier) -> Optional[str]:
+        return None if identifier is None else str(identifier)
+
+    @staticmethod
+    def get_source_restrictions(user_role) -> tuple:
+        """
+        The fields of the user role the rows are built from, to detect when they need to be rebuilt.
+        """
+        return user_role.app_entities_restrictions, user_role.permission_restrictions
+
+    @classmethod
+    def rebuild(cls, user_roles: list, using: Optional[str] = None):
+        """
+        Rewrite the rows of the given user roles from their restrictions.
+        """
+        if not user_roles:
+            return
+
+        cls.objects.using(using).filter(user_role__in=user_roles).delete()
+        cls.objects.using(using).bulk_create(
+            [
+                entity_restriction
+                for user_role in user_roles
+                for entity_restriction in cls.from_user_role(user_role)
+            ],
+            batch_size=1000,
+        )
+
+    @classmethod
+    def process_user_role_post_save(
+        cls, sender, instance, created=False, update_fields=None, using=None, **kwargs
+    ):
+        """
+        Receiver of the post_save signal of UserRole.
+        Saves that do not touch the restrictions of the user role keep its rows.
+        """
+        if update_fields is not None and not {
+            "app_entities_restrictions",
+            "permission_restrictions",
+        } & set(update_fields):
+            return
+
+        cls.rebuild([instance], using=using)
+
+    @classmethod
+    def from_user_role(cls, user_role) -> list["UserRoleEntityRestriction"]:
+        restrictions = cls._from_restrictions(
+            user_role, None, user_role.app_entities_restrictions or {}
+        )
+        for permission, restriction in (
+            user_role.permission_restrictions or {}
+        ).items():
+            # Permissions can also be restricted with a plain boolean,
+            # and empty restrictions fall back to the restrictions of the role.
+            if isinstance(restriction, dict):
+                restrictions.extend(
+                    cls._from_restrictions(
+                        user_role,
+                        permission,
+                        {
+                            app_entity_type: identifiers
+                            for app_entity_type, identifiers in restriction.items()
+                            if identifiers
+                        },
+                    )
+                )
+        return restrictions
+
+    @classmethod
+    def _from_restrictions(
+        cls,
+        user_role,
+        permission: Optional[str],
+        restrictions: dict[str, Optional[list]],
+    ) -> list["UserRoleEntityRestriction"]:
+        rows = []
+        for app_entity_type, identifiers in restrictions.items():
+            if identifiers is None:
+                continue
+
+            rows.append(
+                cls(
+                    user_role=user_role,
+                    app_entity_type=app_entity_type,
+                    permission=permission,
+                )
+            )
+            rows.extend(
+                cls(
+                    user_role=user_role,
+                    app_entity_type=app_entity_type,
+                    record_identifier=cls.to_record_identifier(identifier),
+                    permission=permission,
+                )
+                for identifier in set(identifiers)
+            )
+        return rows
+
+    @classmethod
+    def get_unrestricted_user_role_condition(cls, app_entity_type: str) -> Q:
+        """
+        Condition on UserRole querysets, true if the user role does not restrict the app entity type.
+        """
+        return ~Exists(
+            cls.objects.filter(
+                user_role=OuterRef("pk"),
+                app_entity_type=app_entity_type,
+                record_identifier=None,
+                permission=None,
+            )
+        )
+
+    @classmethod
+    def get_record_access_user_role_condition(
+        cls, app_entity_type: str, record_identifier
+    ) -> Q:
+        """
+        Condition on UserRole querysets, true if the user role can access the app entity record.
+        """
+        return cls.get_unrestricted_user_role_condition(app_entity_type) | Exists(
+            cls.objects.filter(
+                user_role=OuterRef("pk"),
+                app_entity_type=app_entity_type,
+                record_identifier=cls.to_record_identifier(record_identifier),
+                permission=None,
+            )
+        )
+
+    @classmethod
+    def group_users_by_record_identifier(
+        cls,
+        records_identifiers: list[Any],
+        unrestricted_users: list,
+        entity_restrictions: Iterable["UserRoleEntityRestriction"],
+    ) -> dict[Any, list]:
+        """
+        Get the users with access to each record, given the users that can access all of them
+        and the entity restrictions of the records, with their user roles and users selected.
+        """
+        users_by_record = {
+            cls.to_record_identifier(record_identifier): {
+                user.pk: user for user in unrestricted_users
+            }
+            for record_identifier in records_identifiers
+        }
+        for entity_restriction in entity_restrictions:
+            user = entity_restriction.user_role.user
+            users_by_record[entity_restriction.record_identifier].setdefault(
+                user.pk, user
+            )
+
+        return {
+            record_identifier: list(
+                users_by_record[cls.to_record_identifier(record_identifier)].values()
+            )
+            for record_identifier in records_identifiers
+        }
+
+    @classmethod
+    def get_allowed_records_condition(
+        cls,
+        user,
+        role: str,
+        app_entity_type: str,
+        identifier_attr: str,
+        permission: Optional[str] = None,
+        model: Optional[type[models.Model]] = None,
+    ) -> Q:
+        """
+        Condition on the querysets of an app entity, true for the records that the user can access in the role.
+        Same resolution as UserService._get_allowed_app_entity_records_identifiers, performed by the database:
+        permission restrictions take precedence over the restrictions of the role,
+        and app entity types without restrictions are fully accessible.
+        The model of the app entity is needed to compare UUID identifiers.
+        """
+        restrictions = cls.objects.filter(
+            user_role__user=user,
+            user_role__role=role,
+            app_entity_type=app_entity_type,
+            record_identifier__isnull=False,
+        )
+        record_identifier = Cast(
+            OuterRef(identifier_attr), output_field=models.CharField()
+        )
+        if isinstance(
+            cls._get_identifier_field(model, identifier_attr), models.UUIDField
+        ):
+            # Depending on the database, UUIDs are cast with or without hyphens,
+            # and the identifiers of the restrictions are stored as reported by the IDP
+            record_identifier = Replace(Lower(record_identifier), Value("-"), Value(""))
+            restrictions = restrictions.annotate(
+                normalized_record_identifier=Replace(
+                    Lower("record_identifier"), Value("-"), Value("")
+                )
+            )
+            record_identifier_lookup = "normalized_record_identifier"
+        else:
+            record_identifier_lookup = "record_identifier"
+
+        role_restrictions = restrictions.filter(permission=None)
+        condition = ~Exists(role_restrictions) | Exists(
+            role_restrictions.filter(**{record_identifier_lookup: record_identifier})
+        )
+        if permission:
+            permission_restrictions = restrictions.filter(permission=permission)
+            condition = Exists(
+                permission_restrictions.filter(
+                    **{record_identifier_lookup: record_identifier}
+                )
+            ) | (~Exists(permission_restrictions) & condition)
+
+        return Exists(UserRole.objects.filter(user=user, role=role)) & condition
+
+    @staticmethod
+    def _get_identifier_field(
+        model: Optional[type[models.Model]], identifier_attr: str
+    ) -> Optional[models.Field]:
+        if model is None:
+            return None
+        try:
+            return model._meta.get_field(identifier_attr)
+        except FieldDoesNotExist:
+            return None
@@ -1,51 +1,232 @@
+import asyncio
+import atexit
+import functools
 import json
+import logging
+from typing import Optional
 
 from aiokafka import AIOKafkaProducer
+from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
 from kafka import KafkaProducer
 
 from idp_user.utils.classes import Singleton
 from idp_user.utils.functions import get_kafka_bootstrap_servers
 import ssl
 
+logger = logging.getLogger(__name__)
 
-class Producer(metaclass=Singleton):
-    __connection = None
+DEFAULT_TRANSPORT = "idp_user.producer.KafkaTransport"
 
-    def __init__(self):
-        self.__connection = KafkaProducer(
+
+def get_kafka_producer_config() -> Optional[dict]:
+    return settings.IDP_USER_APP.get("KAFKA_PRODUCER")
+
+
+class KafkaTransport:
+    """
+    Sends the messages to the Kafka brokers.
+    Messages are sent in the background, in batches, according to linger_ms and batch_size.
+    """
+
+    def __init__(
+        self,
+        linger_ms: int = 0,
+        batch_size: int = 16384,
+        compression_type: Optional[str] = None,
+    ):
+        self._producer = KafkaProducer(
             bootstrap_servers=get_kafka_bootstrap_servers(include_uri_scheme=False),
             value_serializer=lambda v: json.dumps(v, cls=DjangoJSONEncoder).encode(
                 "utf-8"
             ),
             ssl_context=ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH),
-            security_protocol="SSL"
+            security_protocol="SSL",
+            linger_ms=linger_ms,
+            batch_size=batch_size,
+            compression_type=compression_type,
         )
 
+    @staticmethod
+    def _on_delivery_error(error, topic: str, key: bytes):
+        logger.error(f"Could not deliver message {key!r} to {topic}: {error}")
+
+    def send(self, topic: str, key: bytes, value: dict):
+        future = self._producer.send(topic=topic, key=key, value=value)
+        future.add_errback(self._on_delivery_error, topic=topic, key=key)
+
+    def flush(self, timeout: Optional[float] = None):
+        self._producer.flush(timeout=timeout)
+
+    def close(self):
+        self._producer.close()
+
+
+class InMemoryTransport:
+    """
+    Keeps the messages in memory instead of sending them to Kafka, e.g. for tests.
+    Messages are pending until the transport is flushed.
+    """
+
+    def __init__(self, **kwargs):
+        self.pending_messages: list[tuple[str, bytes, dict]] = []
+        self.messages: list[tuple[str, bytes, dict]] = []
+        self.flushes = 0
+
+    def send(self, topic: str, key: bytes, value: dict):
+        self.pending_messages.append((topic, key, value))
+
+    def flush(self, timeout: Optional[float] = None):
+        self.messages.extend(self.pending_messages)
+        self.pending_messages.clear()
+        self.flushes += 1
+
+    def close(self):
+        self.flush()
+
+
+class Producer(metaclass=Singleton):
+    """
+    Without IDP_USER_APP['KAFKA_PRODUCER'], every message is flushed right after being sent.
+    Otherwise, messages are batched by the transport and flushed at the end of each request
+    and on the shutdown of the process.
+    """
+
+    _transport = None
+
+    def __init__(self):
+        # The Singleton metaclass calls __init__ on every instantiation
+        if self._transport is not None:
+            return
+
+        config = get_kafka_producer_config()
+        self._flush_each_message = config is None
+        config = config or {}
+
+        transport_class = import_string(config.get("TRANSPORT", DEFAULT_TRANSPORT))
+        self._transport = transport_class(
+            **{
+                option: config[setting]
+                for option, setting in (
+                    ("linger_ms", "LINGER_MS"),
+                    ("batch_size", "BATCH_SIZE"),
+                    ("compression_type", "COMPRESSION_TYPE"),
+                )
+                if setting in config
+            }
+        )
+        atexit.register(self.close)
+
+    @property
+    def transport(self):
+        return self._transport
+
     def send_message(self, topic: str, key: str, data: dict):
-        self.__connection.send(topic=topic, key=key.encode("utf-8"), value=data)
-        # Sometimes messages do not get sent.
-        # Flushing after each message seems to solve the issue
-        self.__connection.flush()
+        self._transport.send(topic=topic, key=key.encode("utf-8"), value=data)
+        if self._flush_each_message:
+            # Sometimes messages do not get sent.
+            # Flushing after each message seems to solve the issue
+            self.flush()
+
+    def send_messages(self, topic: str, messages: list[tuple[str, dict]]):
+        """
+        Send (key, data) messages, flushing at most once.
+        """
+        for key, data in messages:
+            self._transport.send(topic=topic, key=key.encode("utf-8"), value=data)
+        if self._flush_each_message and messages:
+            self.flush()
+
+    def flush(self):
+        self._transport.flush()
+
+    def close(self):
+        self._transport.close()
+
+
+def flush_producer(**kwargs):
+    """
+    Flush the producer, if it has been used by the current process.
+    Used as a receiver of request_finished, so kwargs are required.
+    """
+    if producer := Producer._instances.get(Producer):
+        producer.flush()
 
 
 class AioKafkaProducer(metaclass=Singleton):
+    """
+    Async producer, bound to the event loop where it is started.
+    send_messages does not wait for the delivery of the messages, which are batched
+    according to IDP_USER_APP['KAFKA_PRODUCER'] and sent in the background.
+    """
+
     _producer = None
+    _loop = None
+
+    def is_started(self) -> bool:
+        """
+        Whether the producer has been started in the running event loop, e.g. on the startup of the ASGI application.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        return self._producer is not None and self._loop is loop
+
+    async def start(self):
+        if self.is_started():
+            return
+
+        config = get_kafka_producer_config() or {}
+        self._producer = AIOKafkaProducer(
+            bootstrap_servers=get_kafka_bootstrap_servers(include_uri_scheme=False),
+            value_serializer=lambda v: json.dumps(v, cls=DjangoJSONEncoder).encode(
+                "utf-8"
+            ),
+            ssl_context=ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH),
+            security_protocol="SSL",
+            **{
+                option: config[setting]
+                for option, setting in (
+                    ("linger_ms", "LINGER_MS"),
+                    ("max_batch_size", "BATCH_SIZE"),
+                    ("compression_type", "COMPRESSION_TYPE"),
+                )
+                if setting in config
+            },
+        )
+        self._loop = asyncio.get_running_loop()
+        await self._producer.start()
 
     async def get_producer(self):
-        if self._producer is None:
-            self._producer = AIOKafkaProducer(
-                bootstrap_servers=get_kafka_bootstrap_servers(include_uri_scheme=False),
-                value_serializer=lambda v: json.dumps(v, cls=DjangoJSONEncoder).encode(
-                    "utf-8"
-                ),
-            )
-            await self._producer.start()
+        await self.start()
         return self._producer
 
     async def send_message(self, topic: str, key: str, data: dict):
         producer = await self.get_producer()
         await producer.send_and_wait(topic=topic, key=key.encode("utf-8"), value=data)
 
+    @staticmethod
+    def _on_delivery(topic: str, key: bytes, future: asyncio.Future):
+        if not future.cancelled() and (error := future.exception()):
+            logger.error(f"Could not deliver message {key!r} to {topic}: {error}")
+
+    async def send_messages(self, topic: str, messages: list[tuple[str, dict]]):
+        """
+        Send (key, data) messages without waiting for their delivery.
+        """
+        producer = await self.get_producer()
+        for key, data in messages:
+            key = key.encode("utf-8")
+            delivery = await producer.send(topic=topic, key=key, value=data)
+            delivery.add_done_callback(functools.partial(self._on_delivery, topic, key))
+
+    async def flush(self):
+        if self._producer is not None:
+            await self._producer.flush()
+
     async def close(self):
-        await self._producer.stop()
+        if self._producer is not None:
+            producer, self._producer, self._loop = self._producer, None, None
+            await producer.stop()
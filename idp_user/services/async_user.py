@@ -1,25 +1,37 @@
 import logging
 from collections import defaultdict
-from typing import Any, Optional, Union
+from typing import Any, Iterable, Optional, Union
 
-from asgiref.sync import sync_to_async
 from django.core.exceptions import PermissionDenied
 from django.db import models
-from django.db.models import Q, QuerySet
+from django.db.models import Exists, OuterRef, QuerySet
 from django.http import HttpRequest
 
+from idp_user.auth.user_resolver import aresolve_user, invalidate_resolved_user
 from idp_user.models import User
 from idp_user.models.user_role import UserRole
+from idp_user.models.user_role_entity_restriction import UserRoleEntityRestriction
+from idp_user.services.authorization_index import (
+    BulkAuthorization,
+    CompiledUserRole,
+    get_authorization_index,
+)
 from idp_user.settings import APP_ENTITIES, ROLES
 from idp_user.signals import post_create_idp_user
 from idp_user.utils.functions import (
+    aupdate_changed_fields,
+    aupdate_record,
     cache_user_service_results,
-    get_or_none,
+    get_user_payload_hash,
     keep_keys,
     parse_query_params_from_scope,
-    update_record,
 )
-from idp_user.utils.typing import ALL, AppEntityTypeConfig, UserTenantData
+from idp_user.utils.typing import (
+    ALL,
+    AppEntityTypeConfig,
+    AuthorizationQuery,
+    UserTenantData,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -106,19 +118,26 @@ class UserServiceAsync:
         assert (
             app_entity_type in APP_ENTITIES.keys()
         ), f"Unknown app entity: {app_entity_type}!"
+
         allowed_app_entity_records_identifiers = (
-            await UserServiceAsync._get_allowed_app_entity_records_identifiers(
+            await UserServiceAsync._resolve_allowed_app_entity_records_identifiers(
                 user=user,
                 role=role,
                 app_entity_type=app_entity_type,
                 permission=permission,
             )
         )
+
         if allowed_app_entity_records_identifiers == ALL:
             return
 
-        if not set(app_entity_records_identifiers).issubset(
-            set(allowed_app_entity_records_identifiers)
+        if not isinstance(allowed_app_entity_records_identifiers, frozenset):
+            allowed_app_entity_records_identifiers = set(
+                allowed_app_entity_records_identifiers
+            )
+
+        if not allowed_app_entity_records_identifiers.issuperset(
+            app_entity_records_identifiers
         ):
             raise PermissionDenied(
                 "You are not allowed to access the records in the requested entity!"
@@ -130,6 +149,7 @@ class UserServiceAsync:
     ) -> models.QuerySet:
         """
         Gets the app entity records that the user can access.
+        The restrictions are applied by the database, with subqueries on UserRoleEntityRestriction.
 
         Args:
             user:               The user performing the request
@@ -145,19 +165,49 @@ class UserServiceAsync:
         assert (
             app_entity_type in APP_ENTITIES.keys()
         ), f"Unknown app entity: {app_entity_type}!"
+        if ROLES.as_dict().get(role) is None:
+            raise PermissionDenied(f"Role does not exist: {role}")
 
-        allowed_app_entity_records_identifiers = (
-            await UserServiceAsync._get_allowed_app_entity_records_identifiers(
+        app_entity_type_configs = await UserServiceAsync._get_app_entity_type_configs(
+            app_entity_type
+        )
+        return app_entity_type_configs["model"].objects.filter(
+            UserRoleEntityRestriction.get_allowed_records_condition(
                 user=user,
                 role=role,
                 app_entity_type=app_entity_type,
+                identifier_attr=app_entity_type_configs["identifier_attr"],
                 permission=permission,
+                model=app_entity_type_configs["model"],
             )
         )
-        return await UserServiceAsync._get_records(
-            app_entity_type=app_entity_type,
-            records_identifiers=allowed_app_entity_records_identifiers,
-        )
+
+    @staticmethod
+    async def bulk_get_allowed_app_entity_records_identifiers(
+        queries: Iterable[AuthorizationQuery],
+    ) -> dict[AuthorizationQuery, Union[frozenset, ALL]]:
+        """
+        Gets the identifiers of the app entity records that many users can access,
+        loading all the needed user roles at once. Useful for background jobs and notifications.
+
+        Args:
+            queries:    The (user, role, app_entity_type, permission) tuples to resolve
+
+        Returns:
+            Dict of query to the allowed identifiers of the query, or ALL
+        """
+        queries = [AuthorizationQuery(*query) for query in queries]
+        for query in queries:
+            assert (
+                query.app_entity_type in APP_ENTITIES.keys()
+            ), f"Unknown app entity: {query.app_entity_type}!"
+
+        bulk_authorization = BulkAuthorization(queries)
+        for database, user_roles in bulk_authorization.get_user_roles_querysets():
+            bulk_authorization.add_user_roles(
+                database, [user_role async for user_role in user_roles]
+            )
+        return bulk_authorization.resolve()
 
     @staticmethod
     async def _get_app_entity_type_configs(app_entity_type: str) -> AppEntityTypeConfig:
@@ -179,12 +229,53 @@ class UserServiceAsync:
         model = app_entity_type_configs["model"]
 
         if records_identifiers == ALL:
-            return await sync_to_async(list)(model.objects.all())
+            return model.objects.all()
         model_identifier_attr = app_entity_type_configs["identifier_attr"]
-        return await sync_to_async(model.objects.filter)(
+        return model.objects.filter(
             **{f"{model_identifier_attr}__in": records_identifiers}
         )
 
+    @staticmethod
+    async def _resolve_allowed_app_entity_records_identifiers(
+        user: User, role: ROLES, app_entity_type: str, permission: str = None
+    ) -> Union[list[Any], frozenset, ALL]:
+        """
+        Gets the identifiers of the app entity records that the user can access,
+        from the authorization index of the process if it is configured.
+        """
+        if get_authorization_index() is None:
+            return await UserServiceAsync._get_allowed_app_entity_records_identifiers(
+                user=user,
+                role=role,
+                app_entity_type=app_entity_type,
+                permission=permission,
+            )
+
+        if ROLES.as_dict().get(role) is None:
+            raise PermissionDenied(f"Role does not exist: {role}")
+
+        compiled_user_role = await UserServiceAsync._get_compiled_user_role(
+            user=user, role=role
+        )
+        return compiled_user_role.get_allowed_identifiers(app_entity_type, permission)
+
+    @staticmethod
+    async def _get_compiled_user_role(user: User, role: ROLES) -> CompiledUserRole:
+        authorization_index = get_authorization_index()
+
+        if authorization_index and (
+            compiled_user_role := authorization_index.get(user, role)
+        ):
+            return compiled_user_role
+
+        compiled_user_role = CompiledUserRole.from_user_role(
+            await UserRole.objects.filter(user=user, role=role).afirst()
+        )
+        if authorization_index:
+            authorization_index.set(user, role, compiled_user_role)
+
+        return compiled_user_role
+
     @staticmethod
     @cache_user_service_results
     async def _get_allowed_app_entity_records_identifiers(
@@ -232,10 +323,11 @@ class UserServiceAsync:
         return ALL
 
     @staticmethod
-    async def _create_or_update_user(data: UserTenantData) -> User:
-        user = await sync_to_async(get_or_none)(
-            User.objects, username=data.get("username")
-        )
+    async def _create_or_update_user(data: UserTenantData) -> Optional[User]:
+        """
+        Returns None if the user has not changed since its last update.
+        """
+        user = await User.objects.filter(username=data.get("username")).afirst()
         user_data = keep_keys(
             data,
             [
@@ -249,8 +341,15 @@ class UserServiceAsync:
                 "date_joined",
             ],
         )
+        user_data["idp_payload_hash"] = get_user_payload_hash(data)
         if user:
-            await sync_to_async(update_record)(user, **user_data)
+            if user.idp_payload_hash == user_data["idp_payload_hash"]:
+                return None
+
+            changed_fields = await aupdate_changed_fields(user, **user_data)
+            # The hash changes with anything in the record, even the keys that are not stored
+            if set(changed_fields) - {"idp_payload_hash"}:
+                invalidate_resolved_user(user.username)
         else:
             user = await User.objects.acreate(**user_data)
             post_create_idp_user.send(sender=UserServiceAsync, user=user)
@@ -264,9 +363,14 @@ class UserServiceAsync:
 
         Step 1: Create or update User Object
         Step 2: Create/Update/Delete User Roles for this user.
+
+        Updates that have already been applied (e.g. replays of the topic) are skipped.
         """
 
         user = await UserServiceAsync._create_or_update_user(data)
+        if user is None:
+            logger.info(f"User {data['username']} has not changed, skipping.")
+            return
 
         current_user_roles = defaultdict()
         async for user_role in user.user_roles.all():
@@ -274,15 +378,16 @@ class UserServiceAsync:
 
         roles_data = data.get("app_specific_configs")
 
+        # The entity restrictions of the saved user roles are rebuilt on post_save
         for role, role_data in roles_data.items():
             if existing_user_role := current_user_roles.get(role):
-                await sync_to_async(update_record)(
+                await aupdate_record(
                     existing_user_role,
                     permission_restrictions=role_data.get("permission_restrictions"),
                     app_entities_restrictions=role_data.get(
                         "app_entities_restrictions"
                     ),
-                    organization=role_data.get("organization")
+                    organization=role_data.get("organization"),
                 )
             else:
                 await UserRole.objects.acreate(
@@ -292,14 +397,17 @@ class UserServiceAsync:
                     app_entities_restrictions=role_data.get(
                         "app_entities_restrictions"
                     ),
-                    organization=role_data.get("organization")
+                    organization=role_data.get("organization"),
                 )
 
         # Verify if any of the previous user roles is not being reported anymore
         # Delete it if this is the case
         for role, user_role in current_user_roles.items():  # type: str, UserRole
             if roles_data.get(role) is None:
-                user_role.delete()
+                await user_role.adelete()
+
+        if authorization_index := get_authorization_index():
+            authorization_index.invalidate(user)
 
     @staticmethod
     async def get_users_with_access_to_app_entity_record(
@@ -313,21 +421,55 @@ class UserServiceAsync:
             app_entity_type in APP_ENTITIES.keys()
         ), f"Unknown app entity: {app_entity_type}!"
 
-        roles = await sync_to_async(UserRole.objects.filter)(
-            Q(user__is_active=True)
-            & Q(role__in=roles)
-            & (
-                Q(app_entities_restrictions__isnull=True)
-                | Q(**{f"app_entities_restrictions__{app_entity_type}__isnull": True})
-                | Q(
-                    **{
-                        f"app_entities_restrictions__{app_entity_type}__contains": record_identifier
-                    }
+        user_roles = UserRole.objects.filter(
+            UserRoleEntityRestriction.get_record_access_user_role_condition(
+                app_entity_type, record_identifier
+            ),
+            user=OuterRef("pk"),
+            role__in=roles,
+        )
+        return User.objects.filter(Exists(user_roles), is_active=True)
+
+    @staticmethod
+    async def get_users_with_access_to_app_entity_records(
+        app_entity_type: str, records_identifiers: list[Any], roles: list[str]
+    ) -> dict[Any, list[User]]:
+        """
+        Get users that have access to each of the required app entity records in the given roles,
+        with two queries regardless of the number of records.
+        """
+
+        assert (
+            app_entity_type in APP_ENTITIES.keys()
+        ), f"Unknown app entity: {app_entity_type}!"
+
+        unrestricted_users = User.objects.filter(
+            Exists(
+                UserRole.objects.filter(
+                    UserRoleEntityRestriction.get_unrestricted_user_role_condition(
+                        app_entity_type
+                    ),
+                    user=OuterRef("pk"),
+                    role__in=roles,
                 )
-            )
+            ),
+            is_active=True,
         )
-        return await sync_to_async(User.objects.filter)(
-            pk__in=list(roles.values_list("user__pk", flat=True))
+        entity_restrictions = UserRoleEntityRestriction.objects.filter(
+            app_entity_type=app_entity_type,
+            record_identifier__in=[
+                UserRoleEntityRestriction.to_record_identifier(record_identifier)
+                for record_identifier in records_identifiers
+            ],
+            permission=None,
+            user_role__role__in=roles,
+            user_role__user__is_active=True,
+        ).select_related("user_role__user")
+
+        return UserRoleEntityRestriction.group_users_by_record_identifier(
+            records_identifiers,
+            [user async for user in unrestricted_users],
+            [entity_restriction async for entity_restriction in entity_restrictions],
         )
 
     @staticmethod
@@ -335,4 +477,4 @@ class UserServiceAsync:
         """
         Get user by username
         """
-        return await sync_to_async(get_or_none)(User.objects, username=username)
+        return await aresolve_user(username)
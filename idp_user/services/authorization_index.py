@@ -0,0 +1,227 @@
+from collections import defaultdict
+from functools import lru_cache
+from typing import Any, Iterable, Optional, Union
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.db.models import QuerySet
+
+from idp_user.models import User, UserRole
+from idp_user.settings import ROLES
+from idp_user.utils.caches import LRUCache
+from idp_user.utils.typing import ALL, AuthorizationQuery
+
+
+class CompiledUserRole:
+    """
+    The restrictions of a UserRole, precompiled into frozensets
+    so that permission checks do not need to walk the JSON fields.
+    """
+
+    __slots__ = ("exists", "app_entities_restrictions", "permission_restrictions")
+
+    def __init__(
+        self,
+        exists: bool,
+        app_entities_restrictions: dict[str, frozenset],
+        permission_restrictions: dict[str, dict[str, frozenset]],
+    ):
+        self.exists = exists
+        self.app_entities_restrictions = app_entities_restrictions
+        self.permission_restrictions = permission_restrictions
+
+    @classmethod
+    def from_user_role(cls, user_role: Optional[UserRole]) -> "CompiledUserRole":
+        if user_role is None:
+            return cls(
+                exists=False, app_entities_restrictions={}, permission_restrictions={}
+            )
+
+        permission_restrictions = {}
+        for permission, restriction in (
+            user_role.permission_restrictions or {}
+        ).items():
+            # Permissions can also be restricted with a plain boolean,
+            # which does not affect the accessible entity records.
+            if isinstance(restriction, dict):
+                permission_restrictions[permission] = cls._compile_restrictions(
+                    restriction
+                )
+
+        return cls(
+            exists=True,
+            app_entities_restrictions=cls._compile_restrictions(
+                user_role.app_entities_restrictions or {}
+            ),
+            permission_restrictions=permission_restrictions,
+        )
+
+    @staticmethod
+    def _compile_restrictions(restrictions: dict[str, list]) -> dict[str, frozenset]:
+        # Empty restrictions are ignored, the same as in UserService
+        return {
+            app_entity_type: frozenset(identifiers)
+            for app_entity_type, identifiers in restrictions.items()
+            if identifiers
+        }
+
+    def get_allowed_identifiers(
+        self, app_entity_type: str, permission: str = None
+    ) -> Union[frozenset, ALL]:
+        """
+        Same resolution as UserService._get_allowed_app_entity_records_identifiers:
+        permission restrictions take precedence over the app entity restrictions of the role.
+        """
+        if not self.exists:
+            return frozenset()
+
+        if permission and (
+            permission_restriction := self.permission_restrictions.get(permission)
+        ):
+            if identifiers := permission_restriction.get(app_entity_type):
+                return identifiers
+
+        return self.app_entities_restrictions.get(app_entity_type, ALL)
+
+
+class AuthorizationIndex:
+    """
+    Per-process index of the compiled user roles, keyed by (user, role).
+
+    Entries are dropped whenever the user is updated from the IDP in this process.
+    Since the updates usually arrive in another process (the Kafka consumer),
+    entries also expire after a configurable time to live.
+    """
+
+    def __init__(self, ttl: Optional[float] = 60, max_size: int = 10000):
+        self._users = LRUCache(max_size=max_size, ttl=ttl)
+
+    @staticmethod
+    def _get_key(user: User) -> tuple[Optional[str], Any]:
+        # The database is part of the key, since users of different tenants can share the pk
+        return user._state.db, user.pk
+
+    def get(self, user: User, role: str) -> Optional[CompiledUserRole]:
+        user_roles = self._users.get(self._get_key(user))
+        if user_roles is None:
+            return None
+        return user_roles.get(role)
+
+    def set(self, user: User, role: str, compiled_user_role: CompiledUserRole):
+        key = self._get_key(user)
+        user_roles = self._users.get(key)
+        if user_roles is None:
+            user_roles = {}
+            self._users.set(key, user_roles)
+        user_roles[role] = compiled_user_role
+
+    def invalidate(self, user: User):
+        self._users.delete(self._get_key(user))
+
+    def clear(self):
+        self._users.clear()
+
+    def stats(self) -> dict[str, int]:
+        return self._users.stats()
+
+
+class BulkAuthorization:
+    """
+    Resolves the allowed identifiers of many (user, role, app entity type, permission) queries,
+    loading the missing user roles with one query per database, instead of one per (user, role).
+    Compiled user roles found in the authorization index are reused, and the loaded ones are added to it.
+
+    Usage:
+        bulk_authorization = BulkAuthorization(queries)
+        for database, user_roles in bulk_authorization.get_user_roles_querysets():
+            bulk_authorization.add_user_roles(database, user_roles)
+        bulk_authorization.resolve()
+    """
+
+    def __init__(self, queries: Iterable[AuthorizationQuery]):
+        self.queries = [AuthorizationQuery(*query) for query in queries]
+        self._authorization_index = get_authorization_index()
+        self._compiled_user_roles: dict[tuple, CompiledUserRole] = {}
+        self._missing_user_roles: dict[Optional[str], tuple[set, set]] = defaultdict(
+            lambda: (set(), set())
+        )
+
+        for query in self.queries:
+            if ROLES.as_dict().get(query.role) is None:
+                raise PermissionDenied(f"Role does not exist: {query.role}")
+
+            key = self._get_key(query.user, query.role)
+            if key in self._compiled_user_roles:
+                continue
+
+            if self._authorization_index and (
+                compiled_user_role := self._authorization_index.get(
+                    query.user, query.role
+                )
+            ):
+                self._compiled_user_roles[key] = compiled_user_role
+            else:
+                user_ids, roles = self._missing_user_roles[query.user._state.db]
+                user_ids.add(query.user.pk)
+                roles.add(query.role)
+
+    @staticmethod
+    def _get_key(user: User, role: str) -> tuple:
+        return user._state.db, user.pk, role
+
+    def get_user_roles_querysets(self) -> list[tuple[Optional[str], QuerySet]]:
+        """
+        The querysets of the user roles to load, per database.
+        They can include user roles that are not needed, which are ignored.
+        """
+        return [
+            (
+                database,
+                UserRole.objects.using(database).filter(
+                    user_id__in=user_ids, role__in=roles
+                ),
+            )
+            for database, (user_ids, roles) in self._missing_user_roles.items()
+        ]
+
+    def add_user_roles(self, database: Optional[str], user_roles: Iterable[UserRole]):
+        for user_role in user_roles:
+            self._compiled_user_roles[
+                (database, user_role.user_id, user_role.role)
+            ] = CompiledUserRole.from_user_role(user_role)
+
+    def resolve(self) -> dict[AuthorizationQuery, Union[frozenset, ALL]]:
+        results = {}
+        for query in self.queries:
+            key = self._get_key(query.user, query.role)
+            compiled_user_role = self._compiled_user_roles.get(key)
+            if compiled_user_role is None:
+                # The user does not have the role
+                compiled_user_role = self._compiled_user_roles[
+                    key
+                ] = CompiledUserRole.from_user_role(None)
+
+            if self._authorization_index:
+                self._authorization_index.set(
+                    query.user, query.role, compiled_user_role
+                )
+
+            results[query] = compiled_user_role.get_allowed_identifiers(
+                query.app_entity_type, query.permission
+            )
+        return results
+
+
+@lru_cache(maxsize=None)
+def get_authorization_index() -> Optional[AuthorizationIndex]:
+    """
+    Get the authorization index of the current process,
+    or None if IDP_USER_APP['AUTHORIZATION_INDEX'] is not configured.
+    """
+    config = settings.IDP_USER_APP.get("AUTHORIZATION_INDEX")
+    if config is None:
+        return None
+
+    return AuthorizationIndex(
+        ttl=config.get("TTL", 60), max_size=config.get("MAX_SIZE", 10000)
+    )
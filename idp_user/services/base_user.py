@@ -1,10 +1,12 @@
 import logging
+import threading
 from datetime import datetime
-from typing import Any, Type
+from typing import Any, Optional, Type
 
-from django.db import models
+from asgiref.sync import sync_to_async
+from django.db import DEFAULT_DB_ALIAS, models, transaction
 
-from idp_user.producer import Producer
+from idp_user.producer import AioKafkaProducer, Producer
 from idp_user.settings import (
     APP_ENTITIES,
     APP_ENTITY_RECORD_EVENT_TOPIC,
@@ -16,29 +18,220 @@ from idp_user.utils.typing import AppEntityRecordEventDict
 logger = logging.getLogger(__name__)
 
 
+_pending_event_batches = threading.local()
+
+
+class AppEntityRecordEventBatch:
+    """
+    The app entity record events of a transaction, coalesced per record,
+    that are sent to Kafka when the transaction is committed.
+
+    A batch is created for each savepoint in which records are saved,
+    so that the events of rolled back savepoints are dropped together with their batch.
+    """
+
+    def __init__(self, service, using: str, savepoint_ids: list[str]):
+        self.service = service
+        self.using = using
+        self.savepoint_ids = savepoint_ids
+        self.events: dict[tuple[str, Any], AppEntityRecordEventDict] = {}
+
+    def is_pending(self, connection) -> bool:
+        return any(entry[1] is self for entry in connection.run_on_commit)
+
+    def is_ancestor_of(self, savepoint_ids: list[str]) -> bool:
+        return savepoint_ids[: len(self.savepoint_ids)] == self.savepoint_ids
+
+    def add(self, event: AppEntityRecordEventDict):
+        key = (event["app_entity_type"], event["record_identifier"])
+        self.events.pop(key, None)
+        self.events[key] = event
+
+    def discard(self, event: AppEntityRecordEventDict):
+        self.events.pop((event["app_entity_type"], event["record_identifier"]), None)
+
+    def __call__(self):
+        batches = getattr(_pending_event_batches, self.using, [])
+        if self in batches:
+            batches.remove(self)
+        self.service.send_app_entity_record_events_to_kafka(list(self.events.values()))
+
+
 class BaseUserService:
     @classmethod
-    def send_app_entity_record_event_to_kafka(
+    def _build_app_entity_record_event(
         cls, app_entity_type: str, app_entity_record: Any, deleted=False
-    ):
+    ) -> AppEntityRecordEventDict:
         app_entity_type_config = APP_ENTITIES[app_entity_type]
 
-        event: AppEntityRecordEventDict = {
-            "app_identifier": APP_IDENTIFIER,
-            "app_entity_type": app_entity_type,
-            "record_identifier": getattr(
+        return cls._build_app_entity_record_event_from_values(
+            app_entity_type=app_entity_type,
+            record_identifier=getattr(
                 app_entity_record, app_entity_type_config["identifier_attr"]
             ),
-            "label": getattr(app_entity_record, app_entity_type_config["label_attr"]),
+            label=getattr(app_entity_record, app_entity_type_config["label_attr"]),
+            deleted=deleted,
+        )
+
+    @classmethod
+    def _build_app_entity_record_event_from_values(
+        cls,
+        app_entity_type: str,
+        record_identifier: Any,
+        label: Optional[str],
+        deleted=False,
+    ) -> AppEntityRecordEventDict:
+        return {
+            "app_identifier": APP_IDENTIFIER,
+            "app_entity_type": app_entity_type,
+            "record_identifier": record_identifier,
+            "label": label,
             "deleted": deleted,
         }
 
+    @classmethod
+    def send_app_entity_record_event_to_kafka(
+        cls, app_entity_type: str, app_entity_record: Any, deleted=False
+    ):
+        event = cls._build_app_entity_record_event(
+            app_entity_type=app_entity_type,
+            app_entity_record=app_entity_record,
+            deleted=deleted,
+        )
+
         logger.info(f"Sending update {event}...")
 
         Producer().send_message(
             topic=APP_ENTITY_RECORD_EVENT_TOPIC, key=str(datetime.now()), data=event
         )
 
+    @classmethod
+    def send_app_entity_record_events_to_kafka(
+        cls, events: list[AppEntityRecordEventDict]
+    ):
+        if not events:
+            return
+
+        logger.info(f"Sending {len(events)} app entity record updates...")
+
+        Producer().send_messages(
+            topic=APP_ENTITY_RECORD_EVENT_TOPIC,
+            messages=[(str(datetime.now()), event) for event in events],
+        )
+
+    @classmethod
+    async def asend_app_entity_record_event_to_kafka(
+        cls, app_entity_type: str, app_entity_record: Any, deleted=False
+    ):
+        event = cls._build_app_entity_record_event(
+            app_entity_type=app_entity_type,
+            app_entity_record=app_entity_record,
+            deleted=deleted,
+        )
+
+        logger.info(f"Sending update {event}...")
+
+        await cls.asend_app_entity_record_events_to_kafka([event])
+
+    @classmethod
+    async def asend_app_entity_record_events_to_kafka(
+        cls, events: list[AppEntityRecordEventDict]
+    ):
+        """
+        Send the events with the async producer, without waiting for their delivery.
+        """
+        if not events:
+            return
+
+        logger.info(f"Sending {len(events)} app entity record updates...")
+
+        await AioKafkaProducer().send_messages(
+            topic=APP_ENTITY_RECORD_EVENT_TOPIC,
+            messages=[(str(datetime.now()), event) for event in events],
+        )
+
+    @classmethod
+    def send_app_entity_record_event_on_commit(
+        cls, app_entity_type: str, app_entity_record: Any, deleted=False, using=None
+    ):
+        """
+        Send the event of the record when the current transaction is committed,
+        together with the other events of the transaction.
+        Only the last event of each record is sent, and nothing is sent if the transaction is rolled back.
+        """
+        event = cls._build_app_entity_record_event(
+            app_entity_type=app_entity_type,
+            app_entity_record=app_entity_record,
+            deleted=deleted,
+        )
+
+        if not cls._add_app_entity_record_event_to_transaction(event, using=using):
+            cls.send_app_entity_record_events_to_kafka([event])
+
+    @classmethod
+    async def asend_app_entity_record_event_on_commit(
+        cls, app_entity_type: str, app_entity_record: Any, deleted=False, using=None
+    ):
+        """
+        Same as send_app_entity_record_event_on_commit, with the events that are not part
+        of a transaction being sent by the async producer, if it has been started in the running event loop.
+        """
+        event = cls._build_app_entity_record_event(
+            app_entity_type=app_entity_type,
+            app_entity_record=app_entity_record,
+            deleted=deleted,
+        )
+
+        # Runs in the thread of the transaction, if any
+        if await sync_to_async(cls._add_app_entity_record_event_to_transaction)(
+            event, using=using
+        ):
+            return
+
+        if AioKafkaProducer().is_started():
+            await cls.asend_app_entity_record_events_to_kafka([event])
+        else:
+            await sync_to_async(cls.send_app_entity_record_events_to_kafka)([event])
+
+    @classmethod
+    def _add_app_entity_record_event_to_transaction(
+        cls, event: AppEntityRecordEventDict, using=None
+    ) -> bool:
+        """
+        Add the event to the batch of the current savepoint, to be sent on commit.
+        Returns False if the connection is not in a transaction.
+        """
+        using = using or DEFAULT_DB_ALIAS
+        connection = transaction.get_connection(using)
+        if not connection.in_atomic_block:
+            return False
+
+        savepoint_ids = list(connection.savepoint_ids)
+        batches = [
+            batch
+            for batch in getattr(_pending_event_batches, using, [])
+            if batch.is_pending(connection)
+        ]
+        setattr(_pending_event_batches, using, batches)
+
+        current_batch = None
+        for batch in batches:
+            if batch.savepoint_ids == savepoint_ids:
+                current_batch = batch
+            elif not batch.is_ancestor_of(savepoint_ids):
+                # The savepoint of the batch has been released, the new event replaces its own
+                batch.discard(event)
+
+        if current_batch is None:
+            current_batch = AppEntityRecordEventBatch(
+                service=cls, using=using, savepoint_ids=savepoint_ids
+            )
+            transaction.on_commit(current_batch, using=using)
+            batches.append(current_batch)
+
+        current_batch.add(event)
+        return True
+
     @classmethod
     def _get_app_entity_type_from_model(cls, model: Type[models.Model]):
         for (
@@ -56,14 +249,15 @@ class BaseUserService:
     ):
         """
         Whenever an app entity record is saved (created/updated),
-        send a message to Kafka to notify the IDP.
+        send a message to Kafka to notify the IDP once the transaction is committed.
 
         kwargs are required for signal receivers.
         """
 
-        cls.send_app_entity_record_event_to_kafka(
+        cls.send_app_entity_record_event_on_commit(
             app_entity_type=cls._get_app_entity_type_from_model(sender),
             app_entity_record=instance,
+            using=kwargs.get("using"),
         )
 
     @classmethod
@@ -72,13 +266,43 @@ class BaseUserService:
     ):
         """
         Whenever an app entity record is deleted,
-        send a message to Kafka to notify the IDP.
+        send a message to Kafka to notify the IDP once the transaction is committed.
 
         kwargs are required for signal receivers.
         """
 
-        cls.send_app_entity_record_event_to_kafka(
+        cls.send_app_entity_record_event_on_commit(
+            app_entity_type=cls._get_app_entity_type_from_model(sender),
+            app_entity_record=instance,
+            deleted=True,
+            using=kwargs.get("using"),
+        )
+
+    @classmethod
+    async def aprocess_app_entity_record_post_save(
+        cls, sender: Type[models.Model], instance, **kwargs
+    ):
+        """
+        Async version of process_app_entity_record_post_save, connected with ASYNC_APP_ENTITY_RECORD_EVENTS.
+        """
+
+        await cls.asend_app_entity_record_event_on_commit(
+            app_entity_type=cls._get_app_entity_type_from_model(sender),
+            app_entity_record=instance,
+            using=kwargs.get("using"),
+        )
+
+    @classmethod
+    async def aprocess_app_entity_record_post_delete(
+        cls, sender: Type[models.Model], instance, **kwargs
+    ):
+        """
+        Async version of process_app_entity_record_post_delete, connected with ASYNC_APP_ENTITY_RECORD_EVENTS.
+        """
+
+        await cls.asend_app_entity_record_event_on_commit(
             app_entity_type=cls._get_app_entity_type_from_model(sender),
             app_entity_record=instance,
             deleted=True,
+            using=kwargs.get("using"),
         )
@@ -1,17 +1,22 @@
 import logging
 from collections import defaultdict
-from copy import deepcopy
-from typing import Any, Optional, Union
+from typing import Any, Iterable, Optional, Union
 
 from django.conf import settings
-from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.db import models, transaction
-from django.db.models import Q, QuerySet
+from django.db.models import Exists, OuterRef, QuerySet
 
-from idp_user.models import UserRole
+from idp_user.auth.user_resolver import invalidate_resolved_user
+from idp_user.models import UserRole, UserRoleEntityRestriction
 from idp_user.models.user import User
+from idp_user.services.authorization_index import (
+    BulkAuthorization,
+    CompiledUserRole,
+    get_authorization_index,
+)
 from idp_user.services.base_user import BaseUserService
+from idp_user.services.username_index import get_username_index
 from idp_user.settings import APP_ENTITIES, APP_IDENTIFIER, ROLES, TENANTS
 from idp_user.signals import (
     post_create_idp_user,
@@ -21,18 +26,40 @@ from idp_user.signals import (
 from idp_user.utils.functions import (
     cache_user_service_results,
     get_or_none,
+    get_user_payload_hash,
+    increment_user_cache_generation,
+    keep_all_keys,
     keep_keys,
-    update_record,
+    set_changed_fields,
+    update_changed_fields,
 )
 from idp_user.utils.typing import (
     ALL,
     AppEntityTypeConfig,
+    AuthorizationQuery,
     UserRecordDict,
     UserTenantData,
 )
 
 logger = logging.getLogger(__name__)
 
+IDP_USER_FIELDS = [
+    "username",
+    "email",
+    "first_name",
+    "last_name",
+    "is_active",
+    "is_staff",
+    "is_superuser",
+    "date_joined",
+    "is_demo",
+]
+USER_ROLE_FIELDS = [
+    "permission_restrictions",
+    "app_entities_restrictions",
+    "organization",
+]
+
 
 class UserService(BaseUserService):
     # Service Methods Used by Django Application
@@ -113,7 +140,7 @@ class UserService(BaseUserService):
         ), f"Unknown app entity: {app_entity_type}!"
 
         allowed_app_entity_records_identifiers = (
-            UserService._get_allowed_app_entity_records_identifiers(
+            UserService._resolve_allowed_app_entity_records_identifiers(
                 user=user,
                 role=role,
                 app_entity_type=app_entity_type,
@@ -124,8 +151,13 @@ class UserService(BaseUserService):
         if allowed_app_entity_records_identifiers == ALL:
             return
 
-        if not set(app_entity_records_identifiers).issubset(
-            set(allowed_app_entity_records_identifiers)
+        if not isinstance(allowed_app_entity_records_identifiers, frozenset):
+            allowed_app_entity_records_identifiers = set(
+                allowed_app_entity_records_identifiers
+            )
+
+        if not allowed_app_entity_records_identifiers.issuperset(
+            app_entity_records_identifiers
         ):
             raise PermissionDenied(
                 "You are not allowed to access the records in the requested entity!"
@@ -153,19 +185,83 @@ class UserService(BaseUserService):
             app_entity_type in APP_ENTITIES.keys()
         ), f"Unknown app entity: {app_entity_type}!"
 
-        allowed_app_entity_records_identifiers = (
-            UserService._get_allowed_app_entity_records_identifiers(
+        model = UserService._get_app_entity_type_configs(app_entity_type)["model"]
+        return UserService.filter_allowed_app_entity_records(
+            model.objects.all(),
+            user=user,
+            role=role,
+            permission=permission,
+            app_entity_type=app_entity_type,
+        )
+
+    @staticmethod
+    def filter_allowed_app_entity_records(
+        queryset: models.QuerySet,
+        user: User,
+        role: ROLES,
+        permission: str = None,
+        app_entity_type: str = None,
+    ) -> models.QuerySet:
+        """
+        Filters the queryset of an app entity, keeping the records that the user can access.
+        The restrictions are applied by the database, with subqueries on UserRoleEntityRestriction.
+
+        Args:
+            queryset:           The queryset of the app entity records
+            user:               The user performing the request
+            role:               The role that the user is acting as.
+            permission:         In case of specific permissions we can have permission restrictions
+                                    through IDP. The value is the name of the permission
+            app_entity_type:    The app entity of the queryset, found from its model if not provided
+
+        Returns:
+            The filtered queryset
+        """
+        if app_entity_type is None:
+            app_entity_type = UserService._get_app_entity_type_from_model(
+                queryset.model
+            )
+
+        if ROLES.as_dict().get(role) is None:
+            raise PermissionDenied(f"Role does not exist: {role}")
+
+        return queryset.filter(
+            UserRoleEntityRestriction.get_allowed_records_condition(
                 user=user,
                 role=role,
                 app_entity_type=app_entity_type,
+                identifier_attr=UserService._get_app_entity_type_configs(
+                    app_entity_type
+                )["identifier_attr"],
                 permission=permission,
+                model=queryset.model,
             )
         )
 
-        return UserService._get_records(
-            app_entity_type=app_entity_type,
-            records_identifiers=allowed_app_entity_records_identifiers,
-        )
+    @staticmethod
+    def bulk_get_allowed_app_entity_records_identifiers(
+        queries: Iterable[AuthorizationQuery],
+    ) -> dict[AuthorizationQuery, Union[frozenset, ALL]]:
+        """
+        Gets the identifiers of the app entity records that many users can access,
+        loading all the needed user roles at once. Useful for background jobs and notifications.
+
+        Args:
+            queries:    The (user, role, app_entity_type, permission) tuples to resolve
+
+        Returns:
+            Dict of query to the allowed identifiers of the query, or ALL
+        """
+        queries = [AuthorizationQuery(*query) for query in queries]
+        for query in queries:
+            assert (
+                query.app_entity_type in APP_ENTITIES.keys()
+            ), f"Unknown app entity: {query.app_entity_type}!"
+
+        bulk_authorization = BulkAuthorization(queries)
+        for database, user_roles in bulk_authorization.get_user_roles_querysets():
+            bulk_authorization.add_user_roles(database, user_roles)
+        return bulk_authorization.resolve()
 
     @staticmethod
     def _get_app_entity_type_configs(app_entity_type: str) -> AppEntityTypeConfig:
@@ -194,6 +290,46 @@ class UserService(BaseUserService):
                 **{f"{model_identifier_attr}__in": records_identifiers}
             )
 
+    @staticmethod
+    def _resolve_allowed_app_entity_records_identifiers(
+        user: User, role: ROLES, app_entity_type: str, permission: str = None
+    ) -> Union[list[Any], frozenset, ALL]:
+        """
+        Gets the identifiers of the app entity records that the user can access,
+        from the authorization index of the process if it is configured.
+        """
+        if get_authorization_index() is None:
+            return UserService._get_allowed_app_entity_records_identifiers(
+                user=user,
+                role=role,
+                app_entity_type=app_entity_type,
+                permission=permission,
+            )
+
+        if ROLES.as_dict().get(role) is None:
+            raise PermissionDenied(f"Role does not exist: {role}")
+
+        return UserService._get_compiled_user_role(
+            user=user, role=role
+        ).get_allowed_identifiers(app_entity_type, permission)
+
+    @staticmethod
+    def _get_compiled_user_role(user: User, role: ROLES) -> CompiledUserRole:
+        authorization_index = get_authorization_index()
+
+        if authorization_index and (
+            compiled_user_role := authorization_index.get(user, role)
+        ):
+            return compiled_user_role
+
+        compiled_user_role = CompiledUserRole.from_user_role(
+            get_or_none(UserRole.objects, user=user, role=role)
+        )
+        if authorization_index:
+            authorization_index.set(user, role, compiled_user_role)
+
+        return compiled_user_role
+
     @staticmethod
     @cache_user_service_results
     def _get_allowed_app_entity_records_identifiers(
@@ -241,25 +377,24 @@ class UserService(BaseUserService):
         return ALL
 
     @staticmethod
-    def _create_or_update_user(data: UserTenantData) -> User:
+    def _create_or_update_user(data: UserTenantData) -> Optional[User]:
+        """
+        Returns None if the user has not changed since its last update,
+        i.e. the hash of the data is the one stored on the user.
+        """
         user = get_or_none(User.objects, username=data.get("username"))
-        user_data = keep_keys(
-            data,
-            [
-                "username",
-                "email",
-                "first_name",
-                "last_name",
-                "is_active",
-                "is_staff",
-                "is_superuser",
-                "date_joined",
-                "is_demo"
-            ],
-        )
+        user_data = {
+            **keep_keys(data, IDP_USER_FIELDS),
+            "idp_payload_hash": get_user_payload_hash(data),
+        }
         if user:
-            update_record(user, **user_data)
-            UserService._invalidate_user_cache_entries(user=user)
+            if user.idp_payload_hash == user_data["idp_payload_hash"]:
+                return None
+
+            changed_fields = update_changed_fields(user, **user_data)
+            # The hash changes with anything in the record, even the keys that are not stored
+            if set(changed_fields) - {"idp_payload_hash"}:
+                invalidate_resolved_user(user.username)
             return user
         else:
             user = User.objects.create(**user_data)
@@ -271,10 +406,15 @@ class UserService(BaseUserService):
     def _invalidate_user_cache_entries(user: User):
         """
         Invalidate all the entries in the cache for the given user.
-        To do this, find all the entries that start with the app identifier and username of the user.
+        To do this, increment the generation of the user, which is part of the keys of the entries.
         """
         if settings.IDP_USER_APP.get("USE_REDIS_CACHE", False):
-            cache.delete_pattern(f"{APP_IDENTIFIER}-{user.username}*")
+            increment_user_cache_generation(user.username)
+
+    @staticmethod
+    def _invalidate_authorization_index(user: User):
+        if authorization_index := get_authorization_index():
+            authorization_index.invalidate(user)
 
     @classmethod
     def process_user(cls, data: UserRecordDict):
@@ -301,15 +441,59 @@ class UserService(BaseUserService):
             logger.info(f"Updating user {data['username']} for tenant {tenant}")
             pre_update_idp_user.send(sender=cls.__class__, tenant=tenant)
 
-            # Extract specific tenant information
-            user_record_for_tenant = deepcopy(data)
-            user_record_for_tenant["app_specific_configs"] = reported_user_app_configs[
-                tenant
-            ]
+            # Extract specific tenant information, without copying the rest of the record
+            user_record_for_tenant = {
+                **data,
+                "app_specific_configs": reported_user_app_configs[tenant],
+            }
 
             try:
                 with transaction.atomic(using=tenant):
                     UserService._update_user(user_record_for_tenant)  # type: ignore
+                if username_index := get_username_index():
+                    username_index.add(tenant, [data["username"]])
+            finally:
+                post_update_idp_user.send(sender=cls.__class__, tenant=tenant)
+
+    @classmethod
+    def process_users(cls, records: list[UserRecordDict]):
+        """
+        Batch version of process_user, with the same outcome as processing the records one by one.
+
+        Only the last record of each user is applied in each tenant, since a record only updates
+        the tenants that it reports. All the users of a tenant are updated in a single transaction,
+        with bulk queries, between a single pair of signals.
+        """
+        latest_records_per_tenant: dict[str, dict[str, UserTenantData]] = defaultdict(
+            dict
+        )
+        for data in records:
+            for tenant, tenant_configs in cls._get_reported_user_app_configs(
+                data
+            ).items():
+                if tenant not in TENANTS:
+                    logger.info(f"Tenant {tenant} not present, skipping.")
+                    continue
+
+                latest_tenant_records = latest_records_per_tenant[tenant]
+                latest_tenant_records.pop(data["username"], None)
+                latest_tenant_records[data["username"]] = {
+                    **data,
+                    "app_specific_configs": tenant_configs,
+                }
+
+        for tenant, latest_tenant_records in latest_records_per_tenant.items():
+            tenant_records = list(latest_tenant_records.values())
+            logger.info(f"Updating {len(tenant_records)} users for tenant {tenant}")
+            pre_update_idp_user.send(sender=cls.__class__, tenant=tenant)
+
+            try:
+                with transaction.atomic(using=tenant):
+                    UserService._update_users(tenant_records)  # type: ignore
+                if username_index := get_username_index():
+                    username_index.add(
+                        tenant, [data["username"] for data in tenant_records]
+                    )
             finally:
                 post_update_idp_user.send(sender=cls.__class__, tenant=tenant)
 
@@ -317,18 +501,62 @@ class UserService(BaseUserService):
     def verify_if_user_exists_and_delete_roles(cls, data: UserRecordDict):
         """
         Verify if the user exists in any of the tenants and delete all the roles associated with it.
+        With the username index, only the tenants where the user exists are queried.
+        Tenants loaded before the last creation of a user by another process are reloaded first.
         """
-        for tenant in TENANTS:
+        tenants = TENANTS
+        if username_index := get_username_index():
+            version = username_index.get_version()
+            cls.load_username_index(
+                [
+                    tenant
+                    for tenant in TENANTS
+                    if not username_index.is_loaded(tenant, version)
+                ]
+            )
+            tenants = [
+                tenant
+                for tenant in TENANTS
+                if username_index.contains(tenant, data["username"]) is not False
+            ]
+
+        for tenant in tenants:
             pre_update_idp_user.send(sender=cls.__class__, tenant=tenant)
 
             if user := get_or_none(User.objects, username=data["username"]):
                 logger.info(
                     f"Deleting roles for user {data['username']} in tenant {tenant}"
                 )
-                UserRole.objects.filter(user=user).delete()  # type: ignore
+                deleted, _ = UserRole.objects.filter(user=user).delete()  # type: ignore
+                if deleted:
+                    # The next update of the user must restore the roles, even if it is a replay
+                    User.objects.filter(pk=user.pk).update(idp_payload_hash=None)
+                    UserService._invalidate_user_cache_entries(user=user)
+                    UserService._invalidate_authorization_index(user=user)
 
             post_update_idp_user.send(sender=cls.__class__, tenant=tenant)
 
+    @classmethod
+    def load_username_index(cls, tenants: Optional[list[str]] = None):
+        """
+        Load the usernames of the given tenants (all by default) in the username index, if it is configured.
+        Used at the startup of the consumer, and for the tenants that have not been loaded yet.
+        """
+        if (username_index := get_username_index()) is None:
+            return
+
+        version = username_index.get_version()
+        for tenant in TENANTS if tenants is None else tenants:
+            pre_update_idp_user.send(sender=cls.__class__, tenant=tenant)
+            try:
+                username_index.load(
+                    tenant,
+                    User.objects.values_list("username", flat=True).iterator(),
+                    version=version,
+                )
+            finally:
+                post_update_idp_user.send(sender=cls.__class__, tenant=tenant)
+
     @staticmethod
     def _update_user(data: UserTenantData):
         """
@@ -337,9 +565,16 @@ class UserService(BaseUserService):
 
         Step 1: Create or update User Object
         Step 2: Create/Update/Delete User Roles for this user.
+
+        Updates that have already been applied (e.g. replays of the topic) are skipped.
+        Only the fields that changed are saved, and the cached results of the user are invalidated
+        only if its roles changed.
         """
 
         user = UserService._create_or_update_user(data)
+        if user is None:
+            logger.info(f"User {data['username']} has not changed, skipping.")
+            return
 
         current_user_roles = defaultdict()
         for user_role in user.user_roles.all():
@@ -347,33 +582,175 @@ class UserService(BaseUserService):
 
         roles_data = data.get("app_specific_configs")
 
+        # The entity restrictions of the saved user roles are rebuilt on post_save
+        roles_changed = False
         for role, role_data in roles_data.items():
             if existing_user_role := current_user_roles.get(role):
-                update_record(
-                    existing_user_role,
-                    permission_restrictions=role_data.get("permission_restrictions"),
-                    app_entities_restrictions=role_data.get(
-                        "app_entities_restrictions"
-                    ),
-                    organization=role_data.get("organization")
-                )
+                if update_changed_fields(
+                    existing_user_role, **keep_all_keys(role_data, USER_ROLE_FIELDS)
+                ):
+                    roles_changed = True
             else:
+                roles_changed = True
                 UserRole.objects.create(
-                    user=user,
-                    role=role,
-                    permission_restrictions=role_data.get("permission_restrictions"),
-                    app_entities_restrictions=role_data.get(
-                        "app_entities_restrictions"
-                    ),
-                    organization=role_data.get("organization")
+                    user=user, role=role, **keep_all_keys(role_data, USER_ROLE_FIELDS)
                 )
 
         # Verify if any of the previous user roles is not being reported anymore
         # Delete it if this is the case
         for role, user_role in current_user_roles.items():  # type: str, UserRole
             if roles_data.get(role) is None:
+                roles_changed = True
                 user_role.delete()
 
+        if roles_changed:
+            UserService._invalidate_user_cache_entries(user=user)
+            UserService._invalidate_authorization_index(user=user)
+            # The resolved user might have its roles prefetched
+            invalidate_resolved_user(user.username)
+
+    @staticmethod
+    def _update_users(records: list[UserTenantData]):
+        """
+        Bulk version of _update_user, for users with distinct usernames.
+        Only the changed fields are updated, and only for the users and user roles where they changed.
+        """
+        users = {
+            user.username: user
+            for user in User.objects.filter(
+                username__in=[data["username"] for data in records]
+            )
+        }
+
+        # Skip the users that have not changed since their last update
+        payload_hashes = {
+            data["username"]: get_user_payload_hash(data) for data in records
+        }
+        records = [
+            data
+            for data in records
+            if (user := users.get(data["username"])) is None
+            or user.idp_payload_hash != payload_hashes[data["username"]]
+        ]
+        if not records:
+            return
+        users = {
+            data["username"]: users[data["username"]]
+            for data in records
+            if data["username"] in users
+        }
+
+        users_to_create, users_to_update, updated_fields = [], [], set()
+        for data in records:
+            user_data = {
+                **keep_keys(data, IDP_USER_FIELDS),
+                "idp_payload_hash": payload_hashes[data["username"]],
+            }
+            if user := users.get(data["username"]):
+                changed_fields = set_changed_fields(user, **user_data)
+                users_to_update.append(user)
+                updated_fields.update(changed_fields)
+                # The hash changes with anything in the record, even the keys that are not stored
+                if set(changed_fields) - {"idp_payload_hash"}:
+                    invalidate_resolved_user(user.username)
+            else:
+                users_to_create.append(User(**user_data))
+
+        if users_to_update:
+            User.objects.bulk_update(
+                users_to_update, fields=sorted(updated_fields - {"username"})
+            )
+
+        if users_to_create:
+            User.objects.bulk_create(users_to_create)
+            # Not all databases return the primary keys of the created rows
+            users.update(
+                {
+                    user.username: user
+                    for user in User.objects.filter(
+                        username__in=[user.username for user in users_to_create]
+                    )
+                }
+            )
+            for user in users_to_create:
+                post_create_idp_user.send(sender=UserService, user=users[user.username])
+            # Bulk creations do not send post_save
+            if username_index := get_username_index():
+                username_index.add_created_users(
+                    user.username for user in users_to_create
+                )
+
+        current_user_roles = defaultdict(dict)
+        for user_role in UserRole.objects.filter(user__in=list(users.values())):
+            current_user_roles[user_role.user_id][user_role.role] = user_role
+
+        user_roles_to_create, user_roles_to_update, user_roles_to_delete = [], [], []
+        user_roles_with_changed_restrictions, updated_user_role_fields = [], set()
+        users_with_changed_roles = {}
+        for data in records:
+            user = users[data["username"]]
+            roles_data = data.get("app_specific_configs")
+
+            for role, role_data in roles_data.items():
+                user_role_data = keep_all_keys(role_data, USER_ROLE_FIELDS)
+                if existing_user_role := current_user_roles[user.pk].get(role):
+                    restrictions = UserRoleEntityRestriction.get_source_restrictions(
+                        existing_user_role
+                    )
+                    if changed_fields := set_changed_fields(
+                        existing_user_role, **user_role_data
+                    ):
+                        user_roles_to_update.append(existing_user_role)
+                        updated_user_role_fields.update(changed_fields)
+                        users_with_changed_roles[user.pk] = user
+                    if (
+                        UserRoleEntityRestriction.get_source_restrictions(
+                            existing_user_role
+                        )
+                        != restrictions
+                    ):
+                        user_roles_with_changed_restrictions.append(existing_user_role)
+                else:
+                    user_roles_to_create.append(
+                        UserRole(user=user, role=role, **user_role_data)
+                    )
+                    users_with_changed_roles[user.pk] = user
+
+            for role, user_role in current_user_roles[user.pk].items():
+                if roles_data.get(role) is None:
+                    user_roles_to_delete.append(user_role.pk)
+                    users_with_changed_roles[user.pk] = user
+
+        UserRole.objects.bulk_create(user_roles_to_create)
+        if user_roles_to_update:
+            UserRole.objects.bulk_update(
+                user_roles_to_update, fields=sorted(updated_user_role_fields)
+            )
+        if user_roles_to_delete:
+            UserRole.objects.filter(pk__in=user_roles_to_delete).delete()
+
+        if any(user_role.pk is None for user_role in user_roles_to_create):
+            # Not all databases return the primary keys of the created rows
+            created_user_roles = {
+                (user_role.user_id, user_role.role)
+                for user_role in user_roles_to_create
+            }
+            user_roles_to_create = [
+                user_role
+                for user_role in UserRole.objects.filter(user__in=list(users.values()))
+                if (user_role.user_id, user_role.role) in created_user_roles
+            ]
+        # Bulk queries do not send post_save
+        UserRoleEntityRestriction.rebuild(
+            user_roles_with_changed_restrictions + user_roles_to_create
+        )
+
+        for user in users_with_changed_roles.values():
+            UserService._invalidate_user_cache_entries(user=user)
+            UserService._invalidate_authorization_index(user=user)
+            # The resolved user might have its roles prefetched
+            invalidate_resolved_user(user.username)
+
     @staticmethod
     def _get_reported_user_app_configs(data):
         return data.get("app_specific_configs", {}).get(APP_IDENTIFIER, {})
@@ -390,29 +767,64 @@ class UserService(BaseUserService):
             app_entity_type in APP_ENTITIES.keys()
         ), f"Unknown app entity: {app_entity_type}!"
 
-        roles = UserRole.objects.filter(
-            Q(user__is_active=True)
-            & Q(role__in=roles)
-            & (
-                Q(app_entities_restrictions__isnull=True)
-                | Q(**{f"app_entities_restrictions__{app_entity_type}__isnull": True})
-                | Q(
-                    **{
-                        f"app_entities_restrictions__{app_entity_type}__contains": record_identifier
-                    }
+        user_roles = UserRole.objects.filter(
+            UserRoleEntityRestriction.get_record_access_user_role_condition(
+                app_entity_type, record_identifier
+            ),
+            user=OuterRef("pk"),
+            role__in=roles,
+        )
+        return User.objects.filter(Exists(user_roles), is_active=True)
+
+    @staticmethod
+    def get_users_with_access_to_app_entity_records(
+        app_entity_type: str, records_identifiers: list[Any], roles: list[str]
+    ) -> dict[Any, list[User]]:
+        """
+        Get users that have access to each of the required app entity records in the given roles,
+        with two queries regardless of the number of records.
+        """
+
+        assert (
+            app_entity_type in APP_ENTITIES.keys()
+        ), f"Unknown app entity: {app_entity_type}!"
+
+        unrestricted_users = User.objects.filter(
+            Exists(
+                UserRole.objects.filter(
+                    UserRoleEntityRestriction.get_unrestricted_user_role_condition(
+                        app_entity_type
+                    ),
+                    user=OuterRef("pk"),
+                    role__in=roles,
                 )
-            )
+            ),
+            is_active=True,
         )
+        entity_restrictions = UserRoleEntityRestriction.objects.filter(
+            app_entity_type=app_entity_type,
+            record_identifier__in=[
+                UserRoleEntityRestriction.to_record_identifier(record_identifier)
+                for record_identifier in records_identifiers
+            ],
+            permission=None,
+            user_role__role__in=roles,
+            user_role__user__is_active=True,
+        ).select_related("user_role__user")
 
-        return User.objects.filter(
-            pk__in=list(roles.values_list("user__pk", flat=True))
+        return UserRoleEntityRestriction.group_users_by_record_identifier(
+            records_identifiers, list(unrestricted_users), entity_restrictions
         )
 
     @staticmethod
     def get_organization_names() -> list[str]:
         """Get the names of all organizations."""
 
-        return list(UserRole.objects.exclude(organization=None).values_list("organization", flat=True).distinct())
+        return list(
+            UserRole.objects.exclude(organization=None)
+            .values_list("organization", flat=True)
+            .distinct()
+        )
 
     @staticmethod
     def get_organization_users(organization_name: str) -> QuerySet[User]:
@@ -421,8 +833,7 @@ class UserService(BaseUserService):
         """
 
         roles = UserRole.objects.filter(
-            user__is_active=True,
-            organization=organization_name
+            user__is_active=True, organization=organization_name
         )
 
         return User.objects.filter(
@@ -0,0 +1,139 @@
+import threading
+import time
+from functools import lru_cache
+from typing import Iterable, NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class _TenantUsernames(NamedTuple):
+    loaded_at: float
+    version: Optional[int]
+    usernames: set[str]
+
+
+class UsernameIndex:
+    """
+    The usernames of the users of each tenant, so that the updates of users that never had access
+    to this app do not need to query the database of every tenant.
+
+    The usernames of a tenant are loaded the first time the tenant is checked (or at the startup of the consumer),
+    and are kept current by the user updates of this process. Users can also be created by other processes
+    (e.g. other consumers, the admin or scripts), which increment a version of the usernames in the shared cache:
+    tenants loaded before the last increment are reloaded before being checked.
+    Usernames are also reloaded after a configurable time to live, for the creations that are not notified,
+    e.g. bulk creations outside the user services, or with a cache that is not shared between the processes.
+    """
+
+    def __init__(self, ttl: Optional[float] = 3600):
+        self.ttl = ttl
+        self._usernames: dict[str, _TenantUsernames] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def version_key(self) -> str:
+        return f"{settings.IDP_USER_APP.get('APP_IDENTIFIER')}-usernames-version"
+
+    def get_version(self) -> int:
+        """
+        Get the version of the usernames in the shared cache.
+        The initial value is time based, so that it does not go back to a previous value if the key gets evicted.
+        """
+        version = cache.get(self.version_key)
+        if version is None:
+            version = time.time_ns()
+            if not cache.add(self.version_key, version, timeout=None):
+                version = cache.get(self.version_key, version)
+        return version
+
+    def is_loaded(self, tenant: str, version: Optional[int] = None) -> bool:
+        """
+        Whether the usernames of the tenant are loaded, and not older than the given version.
+        """
+        entry = self._usernames.get(tenant)
+        return (
+            entry is not None
+            and (self.ttl is None or time.monotonic() - entry.loaded_at < self.ttl)
+            and (version is None or entry.version == version)
+        )
+
+    def load(
+        self, tenant: str, usernames: Iterable[str], version: Optional[int] = None
+    ):
+        """
+        The version must be read before querying the usernames,
+        so that the creations that happen in the meantime cause a reload.
+        """
+        usernames = set(usernames)
+        with self._lock:
+            self._usernames[tenant] = _TenantUsernames(
+                time.monotonic(), version, usernames
+            )
+
+    def add(self, tenant: str, usernames: Iterable[str]):
+        """
+        Add the usernames to the tenant, if its usernames are loaded.
+        """
+        with self._lock:
+            if entry := self._usernames.get(tenant):
+                entry.usernames.update(usernames)
+
+    def add_created_users(self, usernames: Iterable[str]):
+        """
+        Notify the creation of users, whose tenant is not known.
+        The usernames are added to all the tenants, which only causes an unneeded query if the user is not there,
+        and the version of the usernames is incremented for the other processes.
+        """
+        usernames = list(usernames)
+        if not usernames:
+            return
+
+        with self._lock:
+            for entry in self._usernames.values():
+                entry.usernames.update(usernames)
+
+        try:
+            version = cache.incr(self.version_key)
+        except ValueError:
+            cache.set(self.version_key, time.time_ns(), timeout=None)
+            return
+
+        # Without creations of other processes in the meantime, the loaded tenants are still current
+        with self._lock:
+            for tenant, entry in self._usernames.items():
+                if entry.version == version - 1:
+                    self._usernames[tenant] = entry._replace(version=version)
+
+    def contains(self, tenant: str, username: str) -> Optional[bool]:
+        """
+        Returns None if the usernames of the tenant are not loaded.
+        """
+        if not self.is_loaded(tenant):
+            return None
+        return username in self._usernames[tenant].usernames
+
+    def clear(self):
+        with self._lock:
+            self._usernames.clear()
+
+
+@lru_cache(maxsize=None)
+def get_username_index() -> Optional[UsernameIndex]:
+    """
+    Get the username index of the current process,
+    or None if IDP_USER_APP['USERNAME_INDEX'] is not configured.
+    """
+    config = settings.IDP_USER_APP.get("USERNAME_INDEX")
+    if config is None:
+        return None
+
+    return UsernameIndex(ttl=config.get("TTL", 3600))
+
+
+def process_user_post_save(sender, instance, created=False, **kwargs):
+    """
+    Receiver of the post_save signal of User, for the users created outside the user updates.
+    """
+    if created and (username_index := get_username_index()):
+        username_index.add_created_users([instance.username])
@@ -3,10 +3,14 @@ from django.utils.module_loading import import_string
 
 IDP_ENVIRONMENT = settings.IDP_USER_APP.get("IDP_ENVIRONMENT")
 ASYNC_MODE = settings.IDP_USER_APP.get("ASYNC_MODE", False)
+ASYNC_APP_ENTITY_RECORD_EVENTS = settings.IDP_USER_APP.get(
+    "ASYNC_APP_ENTITY_RECORD_EVENTS", False
+)
 APP_IDENTIFIER = settings.IDP_USER_APP["APP_IDENTIFIER"]
 ROLES = import_string(settings.IDP_USER_APP.get("ROLES"))
 APP_ENTITIES = settings.IDP_USER_APP.get("APP_ENTITIES") or {}
 TENANTS = settings.IDP_USER_APP.get("TENANTS") or list(settings.DATABASES.keys())
+USER_UPDATES_CONSUMER = settings.IDP_USER_APP.get("USER_UPDATES_CONSUMER") or {}
 
 if APP_ENTITIES:
     for _, config_dict in APP_ENTITIES.items():
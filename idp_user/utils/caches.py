@@ -0,0 +1,190 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Hashable, Optional
+
+import jwt
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpRequest
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe, in-process cache with least-recently-used eviction
+    and an optional time to live for its entries.
+
+    It keeps hit/miss counters, so that its efficiency can be monitored.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[
+            Hashable, tuple[Optional[float], Any]
+        ] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ValidationResultCache:
+    """
+    Caches the results of the token validations performed by the IDP,
+    so that the same token is not validated again for every request of a page load.
+
+    The entries are keyed by a hash of the token, the method, the path and the tenant of the request.
+    They never outlive the expiration of the token, and rejections are kept for a shorter time.
+    The results are kept either in an in-process LRU cache (backend="local"),
+    or in a Django cache (backend="django").
+    """
+
+    def __init__(
+        self,
+        backend: str = "local",
+        cache_alias: str = "default",
+        max_size: int = 10000,
+        ttl: float = 60,
+        negative_ttl: float = 5,
+    ):
+        if backend not in ("local", "django"):
+            raise ValueError(f"Unsupported validation cache backend: {backend}")
+
+        self.backend = backend
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._local_cache = LRUCache(max_size=max_size) if backend == "local" else None
+        self._cache_alias = cache_alias
+
+    @property
+    def _django_cache(self):
+        return caches[self._cache_alias]
+
+    @staticmethod
+    def get_key(request: HttpRequest, token: str) -> str:
+        token_hash = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        request_shape = "\n".join(
+            [
+                request.method or "",
+                request.get_full_path(),
+                request.headers.get("X-TENANT") or "",
+            ]
+        )
+        request_shape_hash = hashlib.sha256(request_shape.encode("utf-8")).hexdigest()
+        return f"idp_user-validation-{token_hash}-{request_shape_hash}"
+
+    def _get_timeout(self, token: str, error: Optional[str]) -> Optional[float]:
+        timeout = self.ttl if error is None else self.negative_ttl
+
+        try:
+            expiration = jwt.decode(token, options={"verify_signature": False}).get(
+                "exp"
+            )
+        except jwt.InvalidTokenError:
+            return None
+        if expiration is not None:
+            timeout = min(timeout, int(expiration) - time.time())
+
+        return timeout if timeout > 0 else None
+
+    def _count(self, entry: Optional[dict]) -> Optional[dict]:
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Returns None on a miss, otherwise a dict with the error returned by the IDP, if any.
+        """
+        if self._local_cache is not None:
+            return self._count(self._local_cache.get(key))
+        return self._count(self._django_cache.get(key))
+
+    async def aget(self, key: str) -> Optional[dict]:
+        if self._local_cache is not None:
+            return self.get(key)
+        return self._count(await self._django_cache.aget(key))
+
+    def set(self, key: str, token: str, error: Optional[str]):
+        if (timeout := self._get_timeout(token, error)) is None:
+            return
+
+        if self._local_cache is not None:
+            self._local_cache.set(key, {"error": error}, ttl=timeout)
+        else:
+            self._django_cache.set(key, {"error": error}, timeout=timeout)
+
+    async def aset(self, key: str, token: str, error: Optional[str]):
+        if self._local_cache is not None:
+            return self.set(key, token, error)
+
+        if (timeout := self._get_timeout(token, error)) is None:
+            return
+
+        await self._django_cache.aset(key, {"error": error}, timeout=timeout)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+@lru_cache(maxsize=None)
+def get_validation_cache() -> Optional[ValidationResultCache]:
+    """
+    Get the cache of the IDP validation results,
+    or None if IDP_USER_APP['IDP_VALIDATION_CACHE'] is not configured.
+    """
+    config = settings.IDP_USER_APP.get("IDP_VALIDATION_CACHE")
+    if config is None:
+        return None
+
+    return ValidationResultCache(
+        backend=config.get("BACKEND", "local"),
+        cache_alias=config.get("CACHE_ALIAS", "default"),
+        max_size=config.get("MAX_SIZE", 10000),
+        ttl=config.get("TTL", 60),
+        negative_ttl=config.get("NEGATIVE_TTL", 5),
+    )
@@ -1,27 +1,55 @@
+import asyncio
 import base64
+import copy
+import functools
+import hashlib
+import inspect
 import json
+import logging
+import math
 import os
-from typing import Optional
+import random
+import time
+import weakref
+from datetime import datetime
+from typing import Any, Optional
 from urllib.parse import parse_qs
 
-import aiohttp
 import boto3
 import jwt
 import requests
 from django.conf import settings
 from django.core.cache import cache
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import (
+    FieldDoesNotExist,
+    ObjectDoesNotExist,
+    ValidationError,
+)
 from django.http import HttpRequest
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from idp_user.utils.caches import LRUCache, get_validation_cache
+from idp_user.utils.http import idp_request, idp_request_async
+from idp_user.utils.jwks import get_jwks_client, get_local_token_validation_config
+from idp_user.utils.serializers import BaseSerializer
+
+logger = logging.getLogger(__name__)
 
 APP_IDENTIFIER = settings.IDP_USER_APP.get("APP_IDENTIFIER")
 IDP_URL = settings.IDP_USER_APP.get("IDP_URL")
 IDP_VALIDATE_URL = f"{IDP_URL}/api/validate/"
+DEFAULT_USER_SERVICE_CACHE_SERIALIZER = "idp_user.utils.serializers.JSONSerializer"
 
 
 def keep_keys(dictionary, keys):
     return {k: v for k, v in dictionary.items() if k in keys}
 
 
+def keep_all_keys(dictionary, keys):
+    return {k: dictionary.get(k) for k in keys}
+
+
 def get_or_none(records, *args, **kwargs):
     try:
         return records.get(*args, **kwargs)
@@ -29,35 +57,350 @@ def get_or_none(records, *args, **kwargs):
         return None
 
 
-def update_record(record, save=True, **data):
-    if data:
-        for key, value in data.items():
+def get_user_payload_hash(data: dict) -> str:
+    """
+    Stable hash of the user record of a tenant, regardless of the order of its keys.
+    """
+    payload = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _to_field_value(record, key: str, value):
+    """
+    Convert the value to the python type of the field, as it is loaded from the database,
+    e.g. datetime strings to aware datetimes.
+    """
+    try:
+        field = record._meta.get_field(key)
+    except FieldDoesNotExist:
+        return value
+    if field.is_relation or not field.concrete:
+        return value
+
+    try:
+        value = field.to_python(value)
+    except ValidationError:
+        # Left to the database to reject
+        return value
+    if isinstance(value, datetime) and settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
+
+
+def set_changed_fields(record, **data) -> list[str]:
+    """
+    Assign only the values that differ from the current ones, and return the names of the changed fields.
+    """
+    changed_fields = []
+    for key, value in data.items():
+        value = _to_field_value(record, key, value)
+        if getattr(record, key, _MISS) != value:
             setattr(record, key, value)
-        if save:
-            record.save()
+            changed_fields.append(key)
+    return changed_fields
+
+
+def update_changed_fields(record, save=True, **data) -> list[str]:
+    """
+    Same as update_record, returning the names of the changed fields.
+    """
+    changed_fields = set_changed_fields(record, **data)
+    if save and record._state.adding:
+        record.save()
+    elif save and changed_fields:
+        record.save(update_fields=changed_fields)
+    return changed_fields
+
+
+async def aupdate_changed_fields(record, save=True, **data) -> list[str]:
+    changed_fields = set_changed_fields(record, **data)
+    if save and record._state.adding:
+        await record.asave()
+    elif save and changed_fields:
+        await record.asave(update_fields=changed_fields)
+    return changed_fields
+
+
+def update_record(record, save=True, **data):
+    """
+    Only the fields whose values changed are saved, and nothing is saved if none changed.
+    """
+    update_changed_fields(record, save=save, **data)
+    return record
+
+
+async def aupdate_record(record, save=True, **data):
+    await aupdate_changed_fields(record, save=save, **data)
     return record
 
 
+def get_user_service_cache_config() -> dict:
+    return settings.IDP_USER_APP.get("USER_SERVICE_CACHE") or {}
+
+
+@functools.lru_cache(maxsize=None)
+def get_user_service_l1_cache() -> Optional[LRUCache]:
+    """
+    Get the in-process cache in front of the shared cache of the user service results,
+    or None if IDP_USER_APP['USER_SERVICE_CACHE']['L1_TTL'] is not configured.
+
+    The generations of the users are kept in it as well, so other processes
+    see the invalidations of a user at most L1_TTL seconds later.
+    """
+    config = get_user_service_cache_config()
+    if not config.get("L1_TTL"):
+        return None
+    return LRUCache(max_size=config.get("L1_MAX_SIZE", 1024), ttl=config["L1_TTL"])
+
+
+@functools.lru_cache(maxsize=None)
+def get_user_service_cache_serializer() -> BaseSerializer:
+    config = get_user_service_cache_config()
+    serializer_class = import_string(
+        config.get("SERIALIZER", DEFAULT_USER_SERVICE_CACHE_SERIALIZER)
+    )
+    return serializer_class(compression_threshold=config.get("COMPRESSION_THRESHOLD"))
+
+
+def _get_user_cache_generation_key(username: str) -> str:
+    return f"{APP_IDENTIFIER}-{username}-generation"
+
+
+def get_user_cache_generation(username: str) -> int:
+    """
+    Get the generation of the cache entries of the user, which is part of their keys.
+    The initial value is time based, so that the generation does not go back
+    to a previous value if the key gets evicted.
+    """
+    generation_key = _get_user_cache_generation_key(username)
+    l1_cache = get_user_service_l1_cache()
+    if (
+        l1_cache is not None
+        and (generation := l1_cache.get(generation_key)) is not None
+    ):
+        return generation
+
+    generation = cache.get(generation_key)
+    if generation is None:
+        generation = time.time_ns()
+        if not cache.add(generation_key, generation, timeout=None):
+            generation = cache.get(generation_key, generation)
+
+    if l1_cache is not None:
+        l1_cache.set(generation_key, generation)
+    return generation
+
+
+async def aget_user_cache_generation(username: str) -> int:
+    """
+    Same as get_user_cache_generation (async).
+    """
+    generation_key = _get_user_cache_generation_key(username)
+    l1_cache = get_user_service_l1_cache()
+    if (
+        l1_cache is not None
+        and (generation := l1_cache.get(generation_key)) is not None
+    ):
+        return generation
+
+    generation = await cache.aget(generation_key)
+    if generation is None:
+        generation = time.time_ns()
+        if not await cache.aadd(generation_key, generation, timeout=None):
+            generation = await cache.aget(generation_key, generation)
+
+    if l1_cache is not None:
+        l1_cache.set(generation_key, generation)
+    return generation
+
+
+def increment_user_cache_generation(username: str):
+    """
+    Invalidate all the cache entries of the user in O(1), by moving to a new generation.
+    The entries of the previous generation are not reachable anymore and expire on their own.
+    """
+    generation_key = _get_user_cache_generation_key(username)
+    try:
+        cache.incr(generation_key)
+    except ValueError:
+        cache.set(generation_key, time.time_ns(), timeout=None)
+
+    if (l1_cache := get_user_service_l1_cache()) is not None:
+        l1_cache.delete(generation_key)
+
+
+def _get_user_service_cache_key(function, user, generation, args, kwargs) -> str:
+    cache_key = f"{APP_IDENTIFIER}-{user.username}-{generation}-{function.__name__}"
+    for arg in args:
+        cache_key += f",{arg}"
+    for key, value in kwargs.items():
+        cache_key += f",{key}={value}"
+    return cache_key
+
+
+_in_flight_lookups: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, asyncio.Future]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _get_in_flight_lookups() -> dict[str, asyncio.Future]:
+    return _in_flight_lookups.setdefault(asyncio.get_running_loop(), {})
+
+
+class _LookupCancelled(Exception):
+    """
+    Set on an in-flight lookup when the call computing it is cancelled,
+    so that the calls waiting for it compute the result themselves instead of being cancelled.
+    """
+
+
+_MISS = object()
+
+
+def _copy_result(result):
+    """
+    The results kept in memory are shared between the calls, so each call gets its own copy,
+    which the caller can change (e.g. append to a list of identifiers) without changing the cached result.
+    """
+    return copy.copy(result)
+
+
+def _read_user_service_cache_entry(entry) -> Any:
+    """
+    Get the result stored in the cache entry, or _MISS if there is none.
+
+    To avoid all the processes recomputing an entry at the same time when it expires,
+    each read may treat the entry as expired a bit earlier, with a probability that grows
+    as the expiration gets closer and with the time it took to compute it (probabilistic early expiration).
+
+    Entries written by another serializer, or that cannot be decoded, are treated as missing.
+    """
+    if not isinstance(entry, tuple) or len(entry) != 4:
+        return _MISS
+
+    serializer = get_user_service_cache_serializer()
+    serializer_id, payload, computation_time, expires_at = entry
+    if serializer_id != serializer.serializer_id:
+        return _MISS
+    beta = get_user_service_cache_config().get("EARLY_EXPIRATION_BETA", 1.0)
+    if beta and (
+        time.time() - computation_time * beta * math.log(1 - random.random())
+        >= expires_at
+    ):
+        return _MISS
+
+    try:
+        return serializer.loads(payload)
+    except Exception as error:
+        logger.warning(f"Could not decode the cached result, recomputing it: {error!r}")
+        return _MISS
+
+
+def _make_user_service_cache_entry(
+    result, computation_time: float
+) -> tuple[tuple, float]:
+    """
+    Empty results (e.g. the user has no role) are cached as well, with their own TTL.
+    """
+    config = get_user_service_cache_config()
+    timeout = config.get("TTL", 3600) if result else config.get("NEGATIVE_TTL", 300)
+    serializer = get_user_service_cache_serializer()
+    entry = (
+        serializer.serializer_id,
+        serializer.dumps(result),
+        computation_time,
+        time.time() + timeout,
+    )
+    return entry, timeout
+
+
 def cache_user_service_results(function):
-    from idp_user.settings import APP_IDENTIFIER
+    """
+    Cache the results of the decorated service method, per user and arguments.
+    Coroutine functions are cached with the async API of the cache, and concurrent calls
+    with the same arguments on the same event loop wait for a single computation.
+    """
 
     def wrapper(user, *args, **kwargs):
-        cache_key = f"{APP_IDENTIFIER}-{user.username}-{function.__name__}"
-        for arg in args:
-            cache_key += f",{arg}"
-        for key, value in kwargs.items():
-            cache_key += f",{key}={value}"
-
-        result = cache.get(cache_key)
-        if result:
-            return json.loads(result)
-        result = function(user=user, *args, **kwargs)  # noqa
-        cache.set(cache_key, json.dumps(result))
+        generation = get_user_cache_generation(user.username)
+        cache_key = _get_user_service_cache_key(
+            function, user, generation, args, kwargs
+        )
+
+        l1_cache = get_user_service_l1_cache()
+        if l1_cache is not None and (result := l1_cache.get(cache_key)) is not None:
+            return _copy_result(result)
+
+        result = _read_user_service_cache_entry(cache.get(cache_key))
+        if result is _MISS:
+            started_at = time.monotonic()
+            result = function(user=user, *args, **kwargs)  # noqa
+            entry, timeout = _make_user_service_cache_entry(
+                result, time.monotonic() - started_at
+            )
+            cache.set(cache_key, entry, timeout=timeout)
+
+        if l1_cache is not None:
+            l1_cache.set(cache_key, _copy_result(result))
         return result
 
-    if settings.IDP_USER_APP.get('USE_REDIS_CACHE', False) is False:
+    async def async_wrapper(user, *args, **kwargs):
+        generation = await aget_user_cache_generation(user.username)
+        cache_key = _get_user_service_cache_key(
+            function, user, generation, args, kwargs
+        )
+
+        l1_cache = get_user_service_l1_cache()
+        if l1_cache is not None and (result := l1_cache.get(cache_key)) is not None:
+            return _copy_result(result)
+
+        result = _read_user_service_cache_entry(await cache.aget(cache_key))
+        if result is not _MISS:
+            if l1_cache is not None:
+                l1_cache.set(cache_key, _copy_result(result))
+            return result
+
+        in_flight_lookups = _get_in_flight_lookups()
+        if (in_flight_lookup := in_flight_lookups.get(cache_key)) is not None:
+            try:
+                # The computing call returns the result itself
+                return _copy_result(await asyncio.shield(in_flight_lookup))
+            except _LookupCancelled:
+                return await async_wrapper(user, *args, **kwargs)
+
+        in_flight_lookup = in_flight_lookups[
+            cache_key
+        ] = asyncio.get_running_loop().create_future()
+        try:
+            started_at = time.monotonic()
+            result = await function(user=user, *args, **kwargs)  # noqa
+            entry, timeout = _make_user_service_cache_entry(
+                result, time.monotonic() - started_at
+            )
+            await cache.aset(cache_key, entry, timeout=timeout)
+            if l1_cache is not None:
+                l1_cache.set(cache_key, _copy_result(result))
+        except asyncio.CancelledError:
+            in_flight_lookup.set_exception(_LookupCancelled())
+            in_flight_lookup.exception()
+            raise
+        except Exception as error:
+            in_flight_lookup.set_exception(error)
+            # Mark the exception as retrieved, in case no other call is waiting for it
+            in_flight_lookup.exception()
+            raise
+        else:
+            in_flight_lookup.set_result(result)
+            return result
+        finally:
+            in_flight_lookups.pop(cache_key, None)
+
+    if settings.IDP_USER_APP.get("USE_REDIS_CACHE", False) is False:
         return function
 
+    if inspect.iscoroutinefunction(function):
+        return functools.wraps(function)(async_wrapper)
+
     return wrapper
 
 
@@ -67,12 +410,14 @@ def get_kafka_bootstrap_servers(include_uri_scheme=True):
     We have to find the bootstrap servers and create the connection using them.
     """
     if kafka_arn := settings.KAFKA_ARN:
-        resource = boto3.client("kafka", region_name=os.getenv("AWS_REGION", "eu-central-1"))
+        resource = boto3.client(
+            "kafka", region_name=os.getenv("AWS_REGION", "eu-central-1")
+        )
         response = resource.get_bootstrap_brokers(
             ClusterArn=base64.b64decode(kafka_arn).decode("utf-8")
         )
         assert (
-                "BootstrapBrokerStringTls" in response.keys()
+            "BootstrapBrokerStringTls" in response.keys()
         ), "Something went wrong while receiving kafka servers!"
 
         bootstrap_servers = response.get("BootstrapBrokerStringTls").split(",")
@@ -112,10 +457,79 @@ def get_jwt_payload(token: str) -> dict:
     """
     return jwt.decode(
         token,
-        options={"verify_signature": False},  # Signature is verified from IDP
+        options={
+            "verify_signature": False
+        },  # Signature is verified from IDP or with its keys
     )
 
 
+def verify_jwt(token: str, signing_key) -> dict:
+    """
+    Verify the signature, expiration and not-before claims of the JWT token locally.
+
+    Args:
+        token (str): JWT token
+        signing_key (jwt.PyJWK): The public key of the IDP used to sign the token
+
+    Returns:
+        dict: payload
+
+    Raises:
+        jwt.exceptions.InvalidTokenError: If token is invalid
+    """
+    config = get_local_token_validation_config()
+    return jwt.decode(
+        token,
+        key=signing_key.key,
+        algorithms=config.get("ALGORITHMS", ["RS256"]),
+        leeway=config.get("LEEWAY", 0),
+        options={"require": ["exp"], "verify_aud": False},
+    )
+
+
+def authorize_request_locally(token: str) -> Optional[str]:
+    """
+    Validate token against the public keys of the IDP, without contacting it
+    unless the keys are not known yet.
+
+    Args:
+        token: The JWT token provided
+
+    Return:
+        The error message if any, otherwise None
+    """
+    try:
+        signing_key = get_jwks_client().get_signing_key(
+            jwt.get_unverified_header(token).get("kid")
+        )
+        verify_jwt(token, signing_key)
+    except jwt.InvalidTokenError as error:
+        return f"Invalid token: {str(error)}"
+    except requests.RequestException as error:
+        return f"Unable to fetch the signing keys of the IDP: {str(error)}"
+
+
+async def authorize_request_locally_async(token: str) -> Optional[str]:
+    """
+    Validate token against the public keys of the IDP (async).
+
+    Args:
+        token: The JWT token provided
+
+    Return:
+        The error message if any, otherwise None
+    """
+    try:
+        signing_key = await get_jwks_client().aget_signing_key(
+            jwt.get_unverified_header(token).get("kid")
+        )
+        verify_jwt(token, signing_key)
+    except jwt.InvalidTokenError as error:
+        return f"Invalid token: {str(error)}"
+    except requests.RequestException as error:
+        return f"Unable to fetch the signing keys of the IDP: {str(error)}"
+
+
 def _get_headers_for_idp_authorization(request: HttpRequest, token: str) -> dict:
     headers = {
         "Authorization": f"Bearer {token}",
@@ -134,9 +548,16 @@ def _get_query_params_for_idp_authorization(request: HttpRequest) -> dict:
     return query_params
 
 
+def _is_cacheable_idp_response(status: int) -> bool:
+    # Only definitive answers are cached, not errors of the IDP itself
+    return status < 400 or status in (401, 403)
+
+
 def authorize_request_with_idp(request: HttpRequest, token: str) -> Optional[str]:
     """
     Validate token with IDP.
+    If IDP_USER_APP['LOCAL_TOKEN_VALIDATION'] is configured, the token is validated locally instead.
+    If IDP_USER_APP['IDP_VALIDATION_CACHE'] is configured, the results of the IDP are cached.
 
     Args:
         request: The original request
@@ -145,22 +566,41 @@ def authorize_request_with_idp(request: HttpRequest, token: str) -> Optional[str
     Return:
         The error message if any, otherwise None
     """
-    response = requests.get(
+    if get_local_token_validation_config() is not None:
+        return authorize_request_locally(token)
+
+    if validation_cache := get_validation_cache():
+        cache_key = validation_cache.get_key(request, token)
+        if (cached_result := validation_cache.get(cache_key)) is not None:
+            return cached_result["error"]
+
+    response = idp_request(
+        "GET",
         IDP_VALIDATE_URL,
         params=_get_query_params_for_idp_authorization(request),
         headers=_get_headers_for_idp_authorization(request, token),
     )
 
+    error = None
     if not response.ok:
         try:
-            return response.json().get("detail")
-        except Exception as error:
-            return str(error)
+            error = response.json().get("detail")
+        except Exception as exception:
+            error = str(exception)
 
+    if validation_cache and _is_cacheable_idp_response(response.status_code):
+        validation_cache.set(cache_key, token, error)
 
-async def authorize_request_with_idp_async(request: HttpRequest, token: str) -> Optional[str]:
+    return error
+
+
+async def authorize_request_with_idp_async(
+    request: HttpRequest, token: str
+) -> Optional[str]:
     """
     Validate token with IDP (async).
+    If IDP_USER_APP['LOCAL_TOKEN_VALIDATION'] is configured, the token is validated locally instead.
+    If IDP_USER_APP['IDP_VALIDATION_CACHE'] is configured, the results of the IDP are cached.
 
     Args:
         request: The original request
@@ -169,13 +609,28 @@ async def authorize_request_with_idp_async(request: HttpRequest, token: str) ->
     Return:
         The error message if any, otherwise None
     """
+    if get_local_token_validation_config() is not None:
+        return await authorize_request_locally_async(token)
+
+    if validation_cache := get_validation_cache():
+        cache_key = validation_cache.get_key(request, token)
+        if (cached_result := await validation_cache.aget(cache_key)) is not None:
+            return cached_result["error"]
+
     headers = _get_headers_for_idp_authorization(request, token)
     params = _get_query_params_for_idp_authorization(request)
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(IDP_VALIDATE_URL, params=params) as response:
-            if not response.ok:
-                try:
-                    response_content = await response.json()
-                    return response_content.get("detail")
-                except Exception as error:
-                    return str(error)
+    error = None
+    async with idp_request_async(
+        "GET", IDP_VALIDATE_URL, params=params, headers=headers
+    ) as response:
+        if not response.ok:
+            try:
+                response_content = await response.json()
+                error = response_content.get("detail")
+            except Exception as exception:
+                error = str(exception)
+
+    if validation_cache and _is_cacheable_idp_response(response.status):
+        await validation_cache.aset(cache_key, token, error)
+
+    return error
@@ -0,0 +1,163 @@
+import asyncio
+import atexit
+import threading
+import weakref
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, AsyncIterator
+
+import aiohttp
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_IDP_HTTP_CLIENT_CONFIG = {
+    "POOL_CONNECTIONS": 10,
+    "POOL_MAXSIZE": 10,
+    "TIMEOUT": 10,
+    "RETRIES": 2,
+    "BACKOFF_FACTOR": 0.1,
+    "KEEPALIVE_TIMEOUT": 30,
+}
+RETRY_STATUSES = (502, 503, 504)
+
+_thread_local = threading.local()
+_sessions = weakref.WeakSet()
+_async_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, tuple[aiohttp.ClientSession, AsyncGenerator]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_idp_http_client_config() -> dict:
+    return {
+        **DEFAULT_IDP_HTTP_CLIENT_CONFIG,
+        **settings.IDP_USER_APP.get("IDP_HTTP_CLIENT", {}),
+    }
+
+
+def _create_session() -> requests.Session:
+    config = get_idp_http_client_config()
+    adapter = HTTPAdapter(
+        pool_connections=config["POOL_CONNECTIONS"],
+        pool_maxsize=config["POOL_MAXSIZE"],
+        max_retries=Retry(
+            total=config["RETRIES"],
+            backoff_factor=config["BACKOFF_FACTOR"],
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False,
+        ),
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_idp_session() -> requests.Session:
+    """
+    Get the keep-alive session of the current thread, used for all the requests to the IDP.
+    Sessions are not shared between threads, since requests.Session is not thread-safe.
+    """
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = _thread_local.session = _create_session()
+        _sessions.add(session)
+    return session
+
+
+def idp_request(method: str, url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", get_idp_http_client_config()["TIMEOUT"])
+    return get_idp_session().request(method, url, **kwargs)
+
+
+def close_idp_sessions():
+    for session in list(_sessions):
+        session.close()
+    _sessions.clear()
+    _thread_local.__dict__.pop("session", None)
+
+
+async def _close_on_loop_shutdown(
+    loop: asyncio.AbstractEventLoop, session: aiohttp.ClientSession
+) -> AsyncGenerator[None, None]:
+    """
+    Closes the session when the event loop shuts down its async generators,
+    which asyncio.run, and so async_to_sync, does before closing the loop.
+    """
+    try:
+        yield
+    finally:
+        if _async_sessions.get(loop, (None, None))[0] is session:
+            del _async_sessions[loop]
+        await session.close()
+
+
+async def get_idp_async_session() -> aiohttp.ClientSession:
+    """
+    Get the keep-alive session of the running event loop, used for all the async requests to the IDP.
+    The session is closed with its event loop, so short-lived loops do not leak their sessions.
+    """
+    loop = asyncio.get_running_loop()
+    session, _ = _async_sessions.get(loop, (None, None))
+    if session is None or session.closed:
+        config = get_idp_http_client_config()
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=config["POOL_MAXSIZE"],
+                keepalive_timeout=config["KEEPALIVE_TIMEOUT"],
+            ),
+            timeout=aiohttp.ClientTimeout(total=config["TIMEOUT"]),
+        )
+        closer = _close_on_loop_shutdown(loop, session)
+        # Starting the generator registers it in the loop, which only keeps a weak reference to it
+        await closer.__anext__()
+        _async_sessions[loop] = (session, closer)
+    return session
+
+
+@asynccontextmanager
+async def idp_request_async(
+    method: str, url: str, **kwargs
+) -> AsyncIterator[aiohttp.ClientResponse]:
+    """
+    Same as idp_request, with the retry policy applied manually since aiohttp has none.
+    """
+    config = get_idp_http_client_config()
+    session = await get_idp_async_session()
+
+    attempt = 0
+    while True:
+        try:
+            response = await session.request(method, url, **kwargs)
+        except aiohttp.ClientConnectionError:
+            if attempt >= config["RETRIES"]:
+                raise
+        else:
+            if (
+                attempt >= config["RETRIES"]
+                or method.upper() != "GET"
+                or response.status not in RETRY_STATUSES
+            ):
+                break
+            response.release()
+
+        await asyncio.sleep(config["BACKOFF_FACTOR"] * (2**attempt))
+        attempt += 1
+
+    try:
+        yield response
+    finally:
+        response.release()
+
+
+async def close_idp_async_session():
+    """
+    Close the session of the running event loop, e.g. on the shutdown of the ASGI application.
+    """
+    _, closer = _async_sessions.get(asyncio.get_running_loop(), (None, None))
+    if closer is not None:
+        await closer.aclose()
+
+
+atexit.register(close_idp_sessions)
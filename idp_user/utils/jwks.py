@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+from functools import lru_cache
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from jwt import PyJWK
+from jwt.exceptions import InvalidTokenError, PyJWKError
+
+from idp_user.utils.http import idp_request
+
+logger = logging.getLogger(__name__)
+
+
+class JWKSClient:
+    """
+    Keeps the public keys of the IDP in memory, so that tokens can be verified locally.
+
+    The key set is fetched once and refreshed when it gets older than `lifespan` seconds,
+    or when a token is signed with an unknown key id (e.g. after a key rotation on the IDP).
+    Refreshes caused by unknown key ids happen at most once every `min_refresh_interval` seconds,
+    so that tokens with random key ids cannot flood the IDP.
+    """
+
+    def __init__(
+        self, url: str, lifespan: float = 3600, min_refresh_interval: float = 30
+    ):
+        self.url = url
+        self.lifespan = lifespan
+        self.min_refresh_interval = min_refresh_interval
+        self._keys: dict[Optional[str], PyJWK] = {}
+        self._fetched_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def fetch_jwks(self) -> dict:
+        response = idp_request("GET", self.url)
+        response.raise_for_status()
+        return response.json()
+
+    def refresh(self):
+        keys = {}
+        for jwk_data in self.fetch_jwks().get("keys", []):
+            try:
+                key = PyJWK(jwk_data)
+            except PyJWKError as error:
+                logger.warning(f"Skipping unusable key {jwk_data.get('kid')}: {error}")
+                continue
+            keys[key.key_id] = key
+
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+
+    def _is_expired(self) -> bool:
+        return self._fetched_at is None or (
+            time.monotonic() - self._fetched_at > self.lifespan
+        )
+
+    def get_cached_signing_key(self, kid: Optional[str]) -> Optional[PyJWK]:
+        """
+        Get the key without performing any request, if it is known and the key set is not expired.
+        """
+        if self._is_expired():
+            return None
+        return self._keys.get(kid)
+
+    def get_signing_key(self, kid: Optional[str]) -> PyJWK:
+        if key := self.get_cached_signing_key(kid):
+            return key
+
+        with self._lock:
+            # Another thread might have refreshed the keys while waiting for the lock
+            if key := self.get_cached_signing_key(kid):
+                return key
+
+            if self._is_expired() or (
+                time.monotonic() - self._fetched_at > self.min_refresh_interval
+            ):
+                self.refresh()
+
+        if key := self._keys.get(kid):
+            return key
+
+        raise InvalidTokenError(f"Unknown signing key: {kid}")
+
+    async def aget_signing_key(self, kid: Optional[str]) -> PyJWK:
+        if key := self.get_cached_signing_key(kid):
+            return key
+        return await sync_to_async(self.get_signing_key, thread_sensitive=False)(kid)
+
+
+def get_local_token_validation_config() -> Optional[dict]:
+    return settings.IDP_USER_APP.get("LOCAL_TOKEN_VALIDATION")
+
+
+@lru_cache(maxsize=None)
+def get_jwks_client() -> JWKSClient:
+    config = get_local_token_validation_config() or {}
+    idp_url = settings.IDP_USER_APP.get("IDP_URL")
+
+    return JWKSClient(
+        url=config.get("JWKS_URL") or f"{idp_url}/.well-known/jwks.json",
+        lifespan=config.get("JWKS_LIFESPAN", 3600),
+        min_refresh_interval=config.get("JWKS_MIN_REFRESH_INTERVAL", 30),
+    )
@@ -0,0 +1,95 @@
+import asyncio
+import zlib
+from typing import Any, Awaitable, Callable
+
+
+def get_lane(key: str, lanes: int) -> int:
+    """
+    Stable across processes, unlike hash(), which is randomized for strings.
+    """
+    return zlib.crc32(key.encode("utf-8")) % lanes
+
+
+class OrderedLanes:
+    """
+    Processes items concurrently in `concurrency` lanes, while the items with the same key
+    always go to the same lane and are processed in the order they were submitted.
+
+    Each lane queues at most `max_in_flight / concurrency` items, so submit waits
+    when the lane of the item is full. If the processing of an item fails, the lane stops
+    and the error is raised by the next call to submit or join.
+    """
+
+    def __init__(
+        self,
+        process: Callable[[Any], Awaitable],
+        concurrency: int,
+        max_in_flight: int = 100,
+    ):
+        self.process = process
+        self.concurrency = concurrency
+        self.max_in_flight = max_in_flight
+        self._queues: list[asyncio.Queue] = []
+        self._workers: list[asyncio.Task] = []
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def start(self):
+        maxsize = max(1, self.max_in_flight // self.concurrency)
+        self._queues = [asyncio.Queue(maxsize=maxsize) for _ in range(self.concurrency)]
+        self._workers = [
+            asyncio.create_task(self._run_lane(queue)) for queue in self._queues
+        ]
+
+    async def _run_lane(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            try:
+                await self.process(item)
+            finally:
+                queue.task_done()
+
+    def _raise_failure(self):
+        for worker in self._workers:
+            if worker.done():
+                # Raises the error of the lane
+                worker.result()
+
+    async def _wait(self, awaitable: Awaitable):
+        """
+        Wait for the awaitable, unless a lane fails in the meantime.
+        """
+        future = asyncio.ensure_future(awaitable)
+        await asyncio.wait(
+            [future, *self._workers], return_when=asyncio.FIRST_COMPLETED
+        )
+        if not future.done():
+            future.cancel()
+        self._raise_failure()
+
+    async def submit(self, key: str, item: Any):
+        self._raise_failure()
+        queue = self._queues[get_lane(key, self.concurrency)]
+        if queue.full():
+            await self._wait(queue.put(item))
+        else:
+            queue.put_nowait(item)
+
+    async def join(self):
+        """
+        Wait until all the submitted items have been processed.
+        """
+        self._raise_failure()
+        await self._wait(asyncio.gather(*(queue.join() for queue in self._queues)))
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queues = []
@@ -0,0 +1,108 @@
+import json
+import zlib
+from array import array
+from typing import Any, Optional
+
+from django.core.exceptions import ImproperlyConfigured
+
+UNCOMPRESSED = b"-"
+COMPRESSED = b"z"
+
+
+class BaseSerializer:
+    """
+    Serializes the results of the user service methods for the shared cache.
+    Payloads of at least `compression_threshold` bytes are compressed with zlib.
+    """
+
+    def __init__(self, compression_threshold: Optional[int] = None):
+        self.compression_threshold = compression_threshold
+
+    @property
+    def serializer_id(self) -> str:
+        """
+        Stored along with the payloads, so that the payloads of another serializer
+        (e.g. after a change of the setting) are not decoded with this one.
+        """
+        return f"{type(self).__module__}.{type(self).__qualname__}"
+
+    def encode(self, value: Any) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+    def dumps(self, value: Any) -> bytes:
+        data = self.encode(value)
+        if (
+            self.compression_threshold is not None
+            and len(data) >= self.compression_threshold
+        ):
+            return COMPRESSED + zlib.compress(data)
+        return UNCOMPRESSED + data
+
+    def loads(self, data: bytes) -> Any:
+        if data[:1] == COMPRESSED:
+            return self.decode(zlib.decompress(data[1:]))
+        return self.decode(data[1:])
+
+
+class JSONSerializer(BaseSerializer):
+    def encode(self, value: Any) -> bytes:
+        return json.dumps(value).encode("utf-8")
+
+    def decode(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class PackedSerializer(JSONSerializer):
+    """
+    Lists of integers are packed into 64-bit integer arrays and loaded as frozensets,
+    without building intermediate lists. Any other value falls back to JSON.
+    """
+
+    PACKED = b"q"
+    JSON = b"j"
+
+    @staticmethod
+    def _is_packable(value: Any) -> bool:
+        # bool is a subclass of int, but would be loaded back as an int
+        return isinstance(value, list) and all(type(item) is int for item in value)
+
+    def encode(self, value: Any) -> bytes:
+        if self._is_packable(value):
+            try:
+                return self.PACKED + array("q", value).tobytes()
+            except OverflowError:
+                pass
+        return self.JSON + super().encode(value)
+
+    def decode(self, data: bytes) -> Any:
+        if data[:1] == self.PACKED:
+            identifiers = array("q")
+            identifiers.frombytes(data[1:])
+            return frozenset(identifiers)
+        return super().decode(data[1:])
+
+
+class MsgpackSerializer(BaseSerializer):
+    """
+    Requires the msgpack package. Lists are loaded as tuples.
+    """
+
+    def __init__(self, compression_threshold: Optional[int] = None):
+        try:
+            import msgpack
+        except ImportError as error:
+            raise ImproperlyConfigured(
+                "MsgpackSerializer requires msgpack: pip install django-idp-user[msgpack]"
+            ) from error
+
+        super().__init__(compression_threshold=compression_threshold)
+        self._msgpack = msgpack
+
+    def encode(self, value: Any) -> bytes:
+        return self._msgpack.packb(value)
+
+    def decode(self, data: bytes) -> Any:
+        return self._msgpack.unpackb(data, use_list=False)
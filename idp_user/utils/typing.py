@@ -1,7 +1,12 @@
-from typing import Any, List, Optional, Type, TypedDict, Union
+from typing import Any, List, NamedTuple, Optional, Type, TypedDict, Union
 
 from django.db import models
 
+try:
+    from typing import NotRequired
+except ImportError:  # Python < 3.11
+    from typing_extensions import NotRequired
+
 ALL = "all"
 
 
@@ -124,6 +129,7 @@ class AppEntityTypeConfig(TypedDict):
     model: Union[str, Type[models.Model]]
     identifier_attr: str
     label_attr: str
+    updated_at_attr: NotRequired[str]
 
 
 class AppEntityRecordEventDict(TypedDict):
@@ -132,3 +138,10 @@ class AppEntityRecordEventDict(TypedDict):
     record_identifier: Any
     deleted: bool
     label: Optional[str]
+
+
+class AuthorizationQuery(NamedTuple):
+    user: Any
+    role: str
+    app_entity_type: str
+    permission: Optional[str] = None
@@ -0,0 +1,42 @@
+import asyncio
+from unittest import mock
+
+from idp_user.asgi import IDPUserLifespanMiddleware
+
+
+def _run_lifespan(middleware):
+    messages = asyncio.Queue()
+    for message_type in ("lifespan.startup", "lifespan.shutdown"):
+        messages.put_nowait({"type": message_type})
+    sent = []
+
+    async def send(message):
+        sent.append(message["type"])
+
+    asyncio.run(middleware({"type": "lifespan"}, messages.get, send))
+    return sent
+
+
+def test_lifespan_starts_and_stops_the_async_components():
+    app = mock.AsyncMock()
+    with mock.patch("idp_user.asgi.is_kafka_configured", return_value=True), mock.patch(
+        "idp_user.asgi.AioKafkaProducer"
+    ) as aio_kafka_producer, mock.patch(
+        "idp_user.asgi.close_idp_async_session"
+    ) as close_idp_async_session:
+        aio_kafka_producer.return_value.start = mock.AsyncMock()
+        aio_kafka_producer.return_value.close = mock.AsyncMock()
+        sent = _run_lifespan(IDPUserLifespanMiddleware(app))
+
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+    aio_kafka_producer.return_value.start.assert_awaited_once()
+    aio_kafka_producer.return_value.close.assert_awaited_once()
+    close_idp_async_session.assert_awaited_once()
+    app.assert_not_called()
+
+
+def test_other_scopes_are_passed_to_the_application():
+    app = mock.AsyncMock()
+    scope = {"type": "http"}
+    asyncio.run(IDPUserLifespanMiddleware(app)(scope, None, None))
+    app.assert_awaited_once_with(scope, None, None)
@@ -0,0 +1,37 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from idp_user.auth.user_resolver import UserResolver
+from idp_user.models import User
+
+
+class TestUserResolver:
+    def test_repeated_lookups_do_not_query_the_database(self):
+        User.objects.create(username="resolved_user")
+        user_resolver = UserResolver(ttl=30)
+        user = user_resolver.get_user("resolved_user", token="token")
+
+        with CaptureQueriesContext(connection) as queries:
+            same_user = user_resolver.get_user("resolved_user", token="token")
+        assert len(queries) == 0
+        assert same_user == user and same_user is not user
+
+        with CaptureQueriesContext(connection) as queries:
+            user_resolver.get_user("resolved_user", token="another_token")
+        assert len(queries) == 1
+
+    def test_invalidate(self):
+        user = User.objects.create(username="resolved_user", first_name="Old")
+        user_resolver = UserResolver(ttl=30)
+        user_resolver.get_user("resolved_user")
+
+        User.objects.filter(pk=user.pk).update(first_name="New")
+        user_resolver.invalidate("resolved_user")
+        assert user_resolver.get_user("resolved_user").first_name == "New"
+
+    def test_unknown_users_are_not_cached(self):
+        user_resolver = UserResolver(ttl=30)
+        assert user_resolver.get_user("unknown_user") is None
+
+        User.objects.create(username="unknown_user")
+        assert user_resolver.get_user("unknown_user") is not None
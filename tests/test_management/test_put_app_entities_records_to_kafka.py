@@ -0,0 +1,85 @@
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.utils import timezone
+
+from idp_user.models import User
+from idp_user.producer import Producer
+from idp_user.settings import APP_ENTITIES
+
+# Users are used as the records of the app entities, since the test model has no table
+USER_ENTITY_CONFIG = {"model": User, "identifier_attr": "id", "label_attr": "username"}
+
+
+# The records are read by worker threads, which only see committed data
+@pytest.mark.django_db(transaction=True)
+class TestPutAppEntitiesRecordsToKafka:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        Producer._instances.pop(Producer, None)
+        now = timezone.now()
+        self.users = [
+            User.objects.create(username="old_user", date_joined=now - timedelta(days=2)),
+            User.objects.create(username="new_user", date_joined=now),
+        ]
+        with mock.patch.dict(
+            APP_ENTITIES,
+            {
+                "test_model": {**USER_ENTITY_CONFIG, "updated_at_attr": "date_joined"},
+                "other_model": USER_ENTITY_CONFIG,
+            },
+        ), mock.patch.dict(
+            settings.IDP_USER_APP,
+            {"KAFKA_PRODUCER": {"TRANSPORT": "idp_user.producer.InMemoryTransport"}},
+        ):
+            yield
+        Producer._instances.pop(Producer, None)
+
+    def _get_sent_events(self):
+        transport = Producer().transport
+        return sorted(
+            (event["app_entity_type"], event["label"])
+            for _, _, event in transport.messages + transport.pending_messages
+        )
+
+    def test_all_records_are_sent(self):
+        call_command("put_app_entities_records_to_kafka", "--batch-size", "1")
+
+        assert self._get_sent_events() == [
+            ("other_model", "new_user"),
+            ("other_model", "old_user"),
+            ("test_model", "new_user"),
+            ("test_model", "old_user"),
+        ]
+        assert Producer().transport.flushes == 1
+
+    def test_entity_types_and_since_filter_the_records(self):
+        call_command(
+            "put_app_entities_records_to_kafka",
+            "--entity-type",
+            "test_model",
+            "--since",
+            (timezone.now() - timedelta(days=1)).isoformat(),
+            "--workers",
+            "1",
+        )
+
+        assert self._get_sent_events() == [("test_model", "new_user")]
+
+    def test_dry_run_does_not_send_records(self):
+        call_command("put_app_entities_records_to_kafka", "--dry-run")
+
+        assert Producer not in Producer._instances
+
+    def test_since_requires_updated_at_attr(self):
+        with pytest.raises(CommandError, match="updated_at_attr"):
+            call_command(
+                "put_app_entities_records_to_kafka",
+                "--entity-type",
+                "other_model",
+                "--since",
+                "2024-01-01T00:00:00",
+            )
@@ -0,0 +1,103 @@
+import asyncio
+import ssl
+from unittest import mock
+
+import pytest
+from django.conf import settings
+
+from idp_user.producer import (
+    AioKafkaProducer,
+    InMemoryTransport,
+    Producer,
+    flush_producer,
+)
+
+
+class TestProducer:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        Producer._instances.pop(Producer, None)
+        yield
+        Producer._instances.pop(Producer, None)
+
+    def test_messages_are_batched_until_flushed(self):
+        with mock.patch.dict(
+            settings.IDP_USER_APP,
+            {"KAFKA_PRODUCER": {"TRANSPORT": "idp_user.producer.InMemoryTransport"}},
+        ):
+            Producer().send_message(topic="topic", key="1", data={"id": 1})
+            Producer().send_message(topic="topic", key="2", data={"id": 2})
+
+        transport = Producer().transport
+        assert isinstance(transport, InMemoryTransport)
+        assert len(transport.pending_messages) == 2 and transport.flushes == 0
+
+        flush_producer()
+        assert transport.messages == [
+            ("topic", b"1", {"id": 1}),
+            ("topic", b"2", {"id": 2}),
+        ]
+        assert transport.flushes == 1
+
+    def test_flush_each_message_without_config(self):
+        with mock.patch("idp_user.producer.DEFAULT_TRANSPORT", "idp_user.producer.InMemoryTransport"):
+            Producer().send_messages(topic="topic", messages=[("1", {}), ("2", {})])
+            Producer().send_message(topic="topic", key="3", data={})
+
+        transport = Producer().transport
+        assert len(transport.messages) == 3 and transport.flushes == 2
+
+
+class TestAioKafkaProducer:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        AioKafkaProducer._instances.pop(AioKafkaProducer, None)
+        with mock.patch(
+            "idp_user.producer.AIOKafkaProducer"
+        ) as self.aiokafka_producer, mock.patch(
+            "idp_user.producer.get_kafka_bootstrap_servers", return_value="localhost:9092"
+        ):
+            self.aiokafka_producer.return_value.start = mock.AsyncMock()
+            self.aiokafka_producer.return_value.stop = mock.AsyncMock()
+            yield
+        AioKafkaProducer._instances.pop(AioKafkaProducer, None)
+
+    def test_messages_are_sent_without_waiting_for_delivery(self):
+        async def send_messages():
+            loop = asyncio.get_running_loop()
+            deliveries = []
+
+            async def send(**kwargs):
+                deliveries.append(loop.create_future())
+                return deliveries[-1]
+
+            self.aiokafka_producer.return_value.send = send
+            with mock.patch.dict(
+                settings.IDP_USER_APP, {"KAFKA_PRODUCER": {"LINGER_MS": 50}}
+            ):
+                await AioKafkaProducer().send_messages(
+                    topic="topic", messages=[("1", {}), ("2", {})]
+                )
+            assert AioKafkaProducer().is_started()
+            return deliveries
+
+        deliveries = asyncio.run(send_messages())
+        assert len(deliveries) == 2 and not any(delivery.done() for delivery in deliveries)
+        assert self.aiokafka_producer.call_args.kwargs["linger_ms"] == 50
+        assert not AioKafkaProducer().is_started()
+
+    def test_close(self):
+        async def start_and_close():
+            await AioKafkaProducer().start()
+            await AioKafkaProducer().close()
+            return AioKafkaProducer().is_started()
+
+        assert asyncio.run(start_and_close()) is False
+        self.aiokafka_producer.return_value.stop.assert_awaited_once()
+
+    def test_connects_with_ssl_like_the_sync_transport(self):
+        asyncio.run(AioKafkaProducer().start())
+
+        kwargs = self.aiokafka_producer.call_args.kwargs
+        assert kwargs["security_protocol"] == "SSL"
+        assert isinstance(kwargs["ssl_context"], ssl.SSLContext)
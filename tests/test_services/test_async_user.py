@@ -0,0 +1,105 @@
+from unittest import mock
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.exceptions import PermissionDenied
+from django.db.models import QuerySet
+
+from idp_user.models import User, UserRole
+from idp_user.services import UserServiceAsync
+from idp_user.settings import APP_ENTITIES
+from idp_user.utils.typing import ALL
+
+
+def _user_data(username, roles):
+    return {"username": username, "is_active": True, "app_specific_configs": roles}
+
+
+def _role(*identifiers):
+    return {
+        "app_entities_restrictions": {"test_model": list(identifiers)},
+        "permission_restrictions": {},
+        "organization": None,
+    }
+
+
+class TestUserServiceAsync:
+    def test_update_user(self):
+        async_to_sync(UserServiceAsync._update_user)(
+            _user_data("async_user", {"test_role": _role(1), "old_role": _role(2)})
+        )
+        async_to_sync(UserServiceAsync._update_user)(
+            _user_data("async_user", {"test_role": _role(3)})
+        )
+
+        user = async_to_sync(UserServiceAsync.get_user)("async_user")
+        assert list(
+            UserRole.objects.filter(user=user).values_list("role", "app_entities_restrictions")
+        ) == [("test_role", {"test_model": [3]})]
+
+    def test_replayed_update_is_skipped(self):
+        data = _user_data("replayed_async_user", {"test_role": _role(1)})
+        async_to_sync(UserServiceAsync._update_user)(data)
+        User.objects.filter(username="replayed_async_user").update(first_name="Local")
+
+        async_to_sync(UserServiceAsync._update_user)(data)
+        assert User.objects.get(username="replayed_async_user").first_name == "Local"
+
+    def test_records_are_lazy_querysets(self):
+        for records_identifiers in (ALL, [1, 2]):
+            records = async_to_sync(UserServiceAsync._get_records)(
+                "test_model", records_identifiers
+            )
+            assert isinstance(records, QuerySet)
+
+    def test_get_users_with_access_to_app_entity_record(self):
+        async_to_sync(UserServiceAsync._update_user)(
+            _user_data("async_user", {"test_role": _role(1)})
+        )
+        users = async_to_sync(UserServiceAsync.get_users_with_access_to_app_entity_record)(
+            "test_model", 1, ["test_role"]
+        )
+        assert isinstance(users, QuerySet)
+        assert list(users) == [User.objects.get(username="async_user")]
+
+
+class TestAllowedAppEntityRecordsAsync:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        # Users are used as the records of the app entity, since the test model has no table
+        self.records = [User.objects.create(username=f"record_{i}") for i in range(3)]
+        self.user = User.objects.create(username="restricted_user")
+        UserRole.objects.create(
+            user=self.user,
+            role="test_role",
+            app_entities_restrictions={"test_model": [self.records[0].pk]},
+        )
+        with mock.patch.dict(
+            APP_ENTITIES, {"test_model": {"model": User, "identifier_attr": "id"}}
+        ):
+            yield
+
+    def _get_records(self, identifiers):
+        records = async_to_sync(
+            UserServiceAsync.authorize_and_get_records_or_get_all_allowed
+        )(self.user, "test_role", "test_model", identifiers)
+        return list(
+            records.filter(username__startswith="record_").values_list("username", flat=True)
+        )
+
+    def test_authorize_app_entity_records(self):
+        async_to_sync(UserServiceAsync.authorize_app_entity_records)(
+            self.user, "test_role", "test_model", [self.records[0].pk]
+        )
+        with pytest.raises(PermissionDenied):
+            async_to_sync(UserServiceAsync.authorize_app_entity_records)(
+                self.user, "test_role", "test_model", [self.records[2].pk]
+            )
+
+    def test_requested_records_are_authorized(self):
+        assert self._get_records([self.records[0].pk]) == ["record_0"]
+        with pytest.raises(PermissionDenied):
+            self._get_records([self.records[0].pk, self.records[2].pk])
+
+    def test_all_allowed_records_are_returned_without_identifiers(self):
+        assert self._get_records(None) == ["record_0"]
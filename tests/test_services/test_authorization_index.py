@@ -0,0 +1,158 @@
+from unittest import mock
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.exceptions import PermissionDenied
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from idp_user.models import User, UserRole
+from idp_user.services import UserService, UserServiceAsync
+from idp_user.services.authorization_index import (
+    AuthorizationIndex,
+    CompiledUserRole,
+)
+from idp_user.utils.typing import ALL, AuthorizationQuery
+
+
+class TestCompiledUserRole:
+    def test_permission_restrictions_take_precedence(self):
+        compiled_user_role = CompiledUserRole.from_user_role(
+            UserRole(
+                role="test_role",
+                app_entities_restrictions={"test_model": [1, 2, 3], "other": []},
+                permission_restrictions={
+                    "view": {"test_model": [1]},
+                    "sync": False,
+                },
+            )
+        )
+
+        assert compiled_user_role.get_allowed_identifiers("test_model") == {1, 2, 3}
+        assert compiled_user_role.get_allowed_identifiers("test_model", "view") == {1}
+        assert compiled_user_role.get_allowed_identifiers("test_model", "sync") == {1, 2, 3}
+        assert compiled_user_role.get_allowed_identifiers("other") == ALL
+
+    def test_missing_user_role(self):
+        compiled_user_role = CompiledUserRole.from_user_role(None)
+        assert compiled_user_role.get_allowed_identifiers("test_model") == frozenset()
+
+
+class TestAuthorizationIndex:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.index = AuthorizationIndex(ttl=60)
+        with mock.patch(
+            "idp_user.services.user.get_authorization_index", return_value=self.index
+        ), mock.patch(
+            "idp_user.services.async_user.get_authorization_index", return_value=self.index
+        ):
+            yield
+
+    def test_authorize_without_queries_once_indexed(self):
+        user = User.objects.create(username="indexed_user")
+        UserRole.objects.create(
+            user=user, role="test_role", app_entities_restrictions={"test_model": [1, 2]}
+        )
+        UserService.authorize_app_entity_records(user, "test_role", "test_model", [1])
+
+        with CaptureQueriesContext(connection) as queries:
+            UserService.authorize_app_entity_records(user, "test_role", "test_model", [2])
+            with pytest.raises(PermissionDenied):
+                UserService.authorize_app_entity_records(
+                    user, "test_role", "test_model", [3]
+                )
+        assert len(queries) == 0
+
+    def test_async_authorize_without_queries_once_indexed(self):
+        user = User.objects.create(username="indexed_user")
+        UserRole.objects.create(
+            user=user, role="test_role", app_entities_restrictions={"test_model": [1, 2]}
+        )
+        authorize_app_entity_records = async_to_sync(
+            UserServiceAsync.authorize_app_entity_records
+        )
+        authorize_app_entity_records(user, "test_role", "test_model", [1])
+        assert self.index.get(user, "test_role") is not None
+
+        with CaptureQueriesContext(connection) as queries:
+            authorize_app_entity_records(user, "test_role", "test_model", [2])
+            with pytest.raises(PermissionDenied):
+                authorize_app_entity_records(user, "test_role", "test_model", [3])
+        assert len(queries) == 0
+
+    def test_update_user_invalidates_index(self):
+        user_data = {
+            "username": "updated_user",
+            "app_specific_configs": {
+                "test_role": {
+                    "app_entities_restrictions": {"test_model": [1]},
+                    "permission_restrictions": {},
+                }
+            },
+        }
+        UserService._update_user(user_data)
+        user = User.objects.get(username="updated_user")
+        with pytest.raises(PermissionDenied):
+            UserService.authorize_app_entity_records(user, "test_role", "test_model", [2])
+
+        user_data["app_specific_configs"]["test_role"]["app_entities_restrictions"] = {
+            "test_model": [1, 2]
+        }
+        UserService._update_user(user_data)
+        UserService.authorize_app_entity_records(user, "test_role", "test_model", [2])
+
+
+class TestBulkAuthorization:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.restricted_user = User.objects.create(username="restricted_user")
+        UserRole.objects.create(
+            user=self.restricted_user,
+            role="test_role",
+            app_entities_restrictions={"test_model": [1, 2]},
+            permission_restrictions={"view": {"test_model": [1]}},
+        )
+        self.unrestricted_user = User.objects.create(username="unrestricted_user")
+        UserRole.objects.create(user=self.unrestricted_user, role="test_role")
+        self.user_without_role = User.objects.create(username="user_without_role")
+
+        self.queries = [
+            AuthorizationQuery(self.restricted_user, "test_role", "test_model"),
+            AuthorizationQuery(self.restricted_user, "test_role", "test_model", "view"),
+            AuthorizationQuery(self.unrestricted_user, "test_role", "test_model"),
+            AuthorizationQuery(self.user_without_role, "test_role", "test_model"),
+        ]
+        self.expected_results = [{1, 2}, {1}, ALL, frozenset()]
+
+    def test_user_roles_are_loaded_in_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            results = UserService.bulk_get_allowed_app_entity_records_identifiers(
+                self.queries
+            )
+        assert len(queries) == 1
+        assert [results[query] for query in self.queries] == self.expected_results
+
+    def test_async(self):
+        results = async_to_sync(
+            UserServiceAsync.bulk_get_allowed_app_entity_records_identifiers
+        )(self.queries)
+        assert [results[query] for query in self.queries] == self.expected_results
+
+    def test_authorization_index_is_used_and_filled(self):
+        index = AuthorizationIndex(ttl=60)
+        with mock.patch(
+            "idp_user.services.authorization_index.get_authorization_index",
+            return_value=index,
+        ):
+            UserService.bulk_get_allowed_app_entity_records_identifiers(self.queries)
+            with CaptureQueriesContext(connection) as queries:
+                UserService.bulk_get_allowed_app_entity_records_identifiers(self.queries)
+        assert len(queries) == 0
+        assert index.get(self.user_without_role, "test_role").exists is False
+
+    def test_unknown_role(self):
+        with pytest.raises(PermissionDenied):
+            UserService.bulk_get_allowed_app_entity_records_identifiers(
+                [(self.restricted_user, "unknown_role", "test_model")]
+            )
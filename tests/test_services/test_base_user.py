@@ -0,0 +1,139 @@
+from unittest import mock
+
+import django
+import pytest
+from asgiref.sync import async_to_sync
+from django.apps import apps
+from django.db import transaction
+from django.test import override_settings
+
+from idp_user.services.base_user import BaseUserService
+from tests.test_app_entity import AppEntityTest
+
+
+def _event(record, deleted=False):
+    return {
+        "app_identifier": "test_app",
+        "app_entity_type": "test_model",
+        "record_identifier": record.id,
+        "label": record.name,
+        "deleted": deleted,
+    }
+
+
+class TestAppEntityRecordEvents:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        with mock.patch.object(
+            BaseUserService, "send_app_entity_record_events_to_kafka"
+        ) as self.send_events:
+            yield
+
+    def test_events_are_coalesced_and_sent_on_commit(
+        self, django_capture_on_commit_callbacks
+    ):
+        with django_capture_on_commit_callbacks(execute=True):
+            with transaction.atomic():
+                record = AppEntityTest(id=1, name="first")
+                deleted_record = AppEntityTest(id=2, name="deleted")
+                for instance in (record, deleted_record):
+                    BaseUserService.process_app_entity_record_post_save(
+                        sender=AppEntityTest, instance=instance
+                    )
+
+                record.name = "second"
+                BaseUserService.process_app_entity_record_post_save(
+                    sender=AppEntityTest, instance=record
+                )
+                BaseUserService.process_app_entity_record_post_delete(
+                    sender=AppEntityTest, instance=deleted_record
+                )
+
+            self.send_events.assert_not_called()
+
+        self.send_events.assert_called_once_with(
+            [_event(record), _event(deleted_record, deleted=True)]
+        )
+
+    def test_events_of_rolled_back_savepoints_are_dropped(
+        self, django_capture_on_commit_callbacks
+    ):
+        with django_capture_on_commit_callbacks(execute=True):
+            with transaction.atomic():
+                record = AppEntityTest(id=1, name="committed")
+                BaseUserService.process_app_entity_record_post_save(
+                    sender=AppEntityTest, instance=record
+                )
+
+                with pytest.raises(ValueError), transaction.atomic():
+                    rolled_back_record = AppEntityTest(id=2, name="rolled back")
+                    BaseUserService.process_app_entity_record_post_save(
+                        sender=AppEntityTest, instance=rolled_back_record
+                    )
+                    raise ValueError()
+
+        self.send_events.assert_called_once_with([_event(record)])
+
+
+class TestAsyncAppEntityRecordEvents:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.record = AppEntityTest(id=1, name="async")
+        with mock.patch.object(
+            BaseUserService, "send_app_entity_record_events_to_kafka"
+        ) as self.send_events, mock.patch.object(
+            BaseUserService, "_add_app_entity_record_event_to_transaction", return_value=False
+        ), mock.patch(
+            "idp_user.services.base_user.AioKafkaProducer"
+        ) as self.aio_kafka_producer:
+            self.aio_kafka_producer.return_value.send_messages = mock.AsyncMock()
+            yield
+
+    def _post_save(self):
+        async_to_sync(BaseUserService.aprocess_app_entity_record_post_save)(
+            sender=AppEntityTest, instance=self.record
+        )
+
+    def test_events_are_sent_by_the_started_async_producer(self):
+        self.aio_kafka_producer.return_value.is_started.return_value = True
+        self._post_save()
+
+        self.send_events.assert_not_called()
+        send_messages = self.aio_kafka_producer.return_value.send_messages
+        assert [data for _key, data in send_messages.call_args.kwargs["messages"]] == [
+            _event(self.record)
+        ]
+
+    def test_events_are_sent_by_the_sync_producer_otherwise(self):
+        self.aio_kafka_producer.return_value.is_started.return_value = False
+        self._post_save()
+
+        self.send_events.assert_called_once_with([_event(self.record)])
+        self.aio_kafka_producer.return_value.send_messages.assert_not_called()
+
+
+class TestAppEntityRecordReceivers:
+    def _get_connected_receivers(self, **settings_overrides):
+        with override_settings(KAFKA_BROKER="localhost:9092"), mock.patch.multiple(
+            "idp_user.settings", **settings_overrides
+        ), mock.patch("idp_user.apps.post_save.connect") as post_save_connect, mock.patch(
+            "idp_user.apps.post_delete.connect"
+        ):
+            apps.get_app_config("idp_user").ready()
+
+        return [
+            call.kwargs["receiver"]
+            for call in post_save_connect.call_args_list
+            if call.kwargs["sender"] is AppEntityTest
+        ]
+
+    def test_sync_receivers_are_kept_in_async_mode(self):
+        assert self._get_connected_receivers(ASYNC_MODE=True) == [
+            BaseUserService.process_app_entity_record_post_save
+        ]
+
+    @pytest.mark.skipif(django.VERSION < (5, 0), reason="Async receivers require Django 5.0")
+    def test_async_receivers_are_opt_in(self):
+        assert self._get_connected_receivers(ASYNC_APP_ENTITY_RECORD_EVENTS=True) == [
+            BaseUserService.aprocess_app_entity_record_post_save
+        ]
@@ -0,0 +1,475 @@
+import uuid
+from unittest import mock
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.exceptions import PermissionDenied
+from django.core.cache import cache
+from django.db import connection, models
+from django.test.utils import CaptureQueriesContext
+
+from idp_user.models import User, UserRole, UserRoleEntityRestriction
+from idp_user.services import UserService, UserServiceAsync
+from idp_user.services.username_index import UsernameIndex
+from idp_user.signals import pre_update_idp_user
+
+
+def _user_record(username, roles, **user_data):
+    return {
+        "username": username,
+        "email": f"{username}@example.com",
+        "first_name": "First",
+        "last_name": "Last",
+        "is_active": True,
+        "is_staff": False,
+        "is_superuser": False,
+        "date_joined": "2024-01-01T00:00:00+00:00",
+        "is_demo": False,
+        "app_specific_configs": {"test_app": {"default": roles}},
+        **user_data,
+    }
+
+
+def _role(*identifiers):
+    return {
+        "app_entities_restrictions": {"test_model": list(identifiers)},
+        "permission_restrictions": {},
+        "organization": None,
+    }
+
+
+class TestProcessUsers:
+    def test_batch_matches_records_processed_one_by_one(self):
+        UserService.process_user(
+            _user_record("existing_user", {"test_role": _role(1), "old_role": _role(2)})
+        )
+
+        UserService.process_users(
+            [
+                _user_record("existing_user", {"test_role": _role(3)}, first_name="Stale"),
+                _user_record("new_user", {"test_role": _role(4)}),
+                _user_record("existing_user", {"test_role": _role(5)}, first_name="Latest"),
+            ]
+        )
+
+        existing_user = User.objects.get(username="existing_user")
+        assert existing_user.first_name == "Latest"
+        assert list(
+            UserRole.objects.filter(user=existing_user).values_list(
+                "role", "app_entities_restrictions"
+            )
+        ) == [("test_role", {"test_model": [5]})]
+
+        new_user = User.objects.get(username="new_user")
+        assert new_user.user_roles.get().app_entities_restrictions == {"test_model": [4]}
+
+    def test_latest_record_of_each_tenant_is_applied(self):
+        def tenant_record(tenant, role_identifier, **user_data):
+            return _user_record(
+                "multi_tenant_user",
+                {},
+                app_specific_configs={"test_app": {tenant: {"test_role": _role(role_identifier)}}},
+                **user_data,
+            )
+
+        tenants, updated_records = [], {}
+
+        def record_tenant(sender, tenant, **kwargs):
+            tenants.append(tenant)
+
+        def update_users(records):
+            updated_records[tenants[-1]] = records
+
+        pre_update_idp_user.connect(record_tenant)
+        try:
+            with mock.patch(
+                "idp_user.services.user.TENANTS", ["default", "other"]
+            ), mock.patch("idp_user.services.user.transaction.atomic"), mock.patch.object(
+                UserService, "_update_users", side_effect=update_users
+            ):
+                UserService.process_users(
+                    [
+                        tenant_record("default", 1, first_name="Stale"),
+                        tenant_record("other", 2),
+                        tenant_record("default", 3, first_name="Latest"),
+                    ]
+                )
+        finally:
+            pre_update_idp_user.disconnect(record_tenant)
+
+        # Same as processing the records one by one: the record of "other" is not superseded
+        assert {
+            tenant: [
+                (record["first_name"], record["app_specific_configs"]["test_role"])
+                for record in records
+            ]
+            for tenant, records in updated_records.items()
+        } == {"default": [("Latest", _role(3))], "other": [("First", _role(2))]}
+
+
+class TestUnchangedUsers:
+    def test_replayed_update_is_skipped(self):
+        record = _user_record("replayed_user", {"test_role": _role(1)})
+        UserService.process_user(record)
+
+        with mock.patch.object(
+            UserService, "_invalidate_user_cache_entries"
+        ) as invalidate_user_cache_entries, CaptureQueriesContext(connection) as queries:
+            UserService.process_user(record)
+            UserService.process_users([record])
+
+        invalidate_user_cache_entries.assert_not_called()
+        assert not any(
+            query["sql"].startswith(("UPDATE", "INSERT", "DELETE")) for query in queries
+        )
+
+    def test_changed_update_is_applied(self):
+        UserService.process_user(_user_record("changed_user", {"test_role": _role(1)}))
+        UserService.process_users([_user_record("changed_user", {"test_role": _role(2)})])
+
+        assert UserRole.objects.get(
+            user__username="changed_user"
+        ).app_entities_restrictions == {"test_model": [2]}
+
+    def test_cache_entries_are_invalidated_only_if_the_roles_changed(self):
+        UserService.process_user(_user_record("renamed_user", {"test_role": _role(1)}))
+
+        with mock.patch.object(
+            UserService, "_invalidate_user_cache_entries"
+        ) as invalidate_user_cache_entries:
+            UserService.process_user(
+                _user_record("renamed_user", {"test_role": _role(1)}, first_name="Renamed")
+            )
+            UserService.process_users(
+                [_user_record("renamed_user", {"test_role": _role(1)}, last_name="Renamed")]
+            )
+            invalidate_user_cache_entries.assert_not_called()
+
+            UserService.process_user(_user_record("renamed_user", {"test_role": _role(2)}))
+            UserService.process_users([_user_record("renamed_user", {"test_role": _role(3)})])
+            assert invalidate_user_cache_entries.call_count == 2
+
+        user = User.objects.get(username="renamed_user")
+        assert (user.first_name, user.last_name) == ("First", "Last")
+
+    def test_replay_restores_deleted_roles(self):
+        record = _user_record("restored_user", {"test_role": _role(1)})
+        UserService.process_user(record)
+        UserService.verify_if_user_exists_and_delete_roles({"username": "restored_user"})
+
+        UserService.process_user(record)
+        assert UserRole.objects.filter(user__username="restored_user").exists()
+
+
+class TestUsersWithAccessToAppEntityRecords:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        UserService.process_users(
+            [
+                _user_record("restricted_user", {"test_role": _role(1, 2)}),
+                _user_record(
+                    "unrestricted_user",
+                    {"test_role": {**_role(), "app_entities_restrictions": None}},
+                ),
+                _user_record("user_without_records", {"test_role": _role()}),
+                _user_record("inactive_user", {"test_role": _role(1)}, is_active=False),
+            ]
+        )
+        UserService.process_user(_user_record("updated_user", {"test_role": _role(3)}))
+        UserService.process_user(_user_record("updated_user", {"test_role": _role(2)}))
+
+    def test_single_record(self):
+        users = UserService.get_users_with_access_to_app_entity_record(
+            "test_model", 2, ["test_role"]
+        )
+        assert sorted(users.values_list("username", flat=True)) == [
+            "restricted_user",
+            "unrestricted_user",
+            "updated_user",
+        ]
+        assert not UserService.get_users_with_access_to_app_entity_record(
+            "test_model", 2, ["other_role"]
+        ).exists()
+
+    def test_many_records(self):
+        with CaptureQueriesContext(connection) as queries:
+            users_by_record = UserService.get_users_with_access_to_app_entity_records(
+                "test_model", [1, 3], ["test_role"]
+            )
+        assert len(queries) == 2
+        assert {
+            record: sorted(user.username for user in users)
+            for record, users in users_by_record.items()
+        } == {1: ["restricted_user", "unrestricted_user"], 3: ["unrestricted_user"]}
+
+    def test_async(self):
+        users_by_record = async_to_sync(
+            UserServiceAsync.get_users_with_access_to_app_entity_records
+        )("test_model", [2], ["test_role"])
+        assert sorted(user.username for user in users_by_record[2]) == [
+            "restricted_user",
+            "unrestricted_user",
+            "updated_user",
+        ]
+
+
+class TestUserRoleEntityRestrictions:
+    def _get_restrictions(self, username):
+        return sorted(
+            UserRoleEntityRestriction.objects.filter(
+                user_role__user__username=username
+            ).values_list("app_entity_type", "permission", "record_identifier"),
+            key=str,
+        )
+
+    def test_restrictions_are_kept_in_sync(self):
+        role = {
+            **_role(1, 2),
+            "permission_restrictions": {
+                "view": {"test_model": [1], "other_model": []},
+                "sync": False,
+            },
+        }
+        UserService.process_user(_user_record("synced_user", {"test_role": role}))
+        assert self._get_restrictions("synced_user") == [
+            ("test_model", "view", "1"),
+            ("test_model", "view", None),
+            ("test_model", None, "1"),
+            ("test_model", None, "2"),
+            ("test_model", None, None),
+        ]
+
+        UserService.process_users([_user_record("synced_user", {"test_role": _role(3)})])
+        assert self._get_restrictions("synced_user") == [
+            ("test_model", None, "3"),
+            ("test_model", None, None),
+        ]
+
+        UserService.process_user(_user_record("synced_user", {}))
+        assert self._get_restrictions("synced_user") == []
+
+
+class TestUserRolesSavedDirectly:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        # Users are used as the records of test_model, whose identifier_attr is the id
+        self.records = [User.objects.create(username=f"record_{i}") for i in range(3)]
+        self.user = User.objects.create(username="admin_user")
+        self.user_role = UserRole.objects.create(
+            user=self.user,
+            role="test_role",
+            app_entities_restrictions={"test_model": [self.records[0].pk]},
+        )
+
+    def _get_allowed_records(self):
+        return sorted(
+            UserService.filter_allowed_app_entity_records(
+                User.objects.filter(username__startswith="record_"),
+                user=self.user,
+                role="test_role",
+                app_entity_type="test_model",
+            ).values_list("username", flat=True)
+        )
+
+    def test_queryset_is_restricted(self):
+        assert self._get_allowed_records() == ["record_0"]
+        # Same answer as the restrictions of the user role
+        UserService.authorize_app_entity_records(
+            self.user, "test_role", "test_model", [self.records[0].pk]
+        )
+        with pytest.raises(PermissionDenied):
+            UserService.authorize_app_entity_records(
+                self.user, "test_role", "test_model", [self.records[2].pk]
+            )
+
+    def test_users_with_access_are_restricted(self):
+        assert not UserService.get_users_with_access_to_app_entity_record(
+            "test_model", self.records[2].pk, ["test_role"]
+        ).exists()
+        assert list(
+            UserService.get_users_with_access_to_app_entity_record(
+                "test_model", self.records[0].pk, ["test_role"]
+            )
+        ) == [self.user]
+
+    def test_restrictions_follow_the_saves(self):
+        self.user_role.app_entities_restrictions = {"test_model": [self.records[1].pk]}
+        self.user_role.save()
+        assert self._get_allowed_records() == ["record_1"]
+
+        self.user_role.organization = "organization"
+        self.user_role.save(update_fields=["organization"])
+        assert self._get_allowed_records() == ["record_1"]
+
+        self.user_role.app_entities_restrictions = None
+        self.user_role.save()
+        assert self._get_allowed_records() == ["record_0", "record_1", "record_2"]
+
+
+class TestFilterAllowedAppEntityRecords:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        # Users are used as the records of test_model, whose identifier_attr is the id
+        self.records = [User.objects.create(username=f"record_{i}") for i in range(3)]
+
+    def _get_allowed_records(self, role_data, permission=None):
+        UserService.process_user(_user_record("filtering_user", {"test_role": role_data}))
+        user = User.objects.get(username="filtering_user")
+        return sorted(
+            UserService.filter_allowed_app_entity_records(
+                User.objects.filter(username__startswith="record_"),
+                user=user,
+                role="test_role",
+                permission=permission,
+                app_entity_type="test_model",
+            ).values_list("username", flat=True)
+        )
+
+    def test_role_restrictions(self):
+        first, second, third = self.records
+        assert self._get_allowed_records(_role(first.pk, third.pk)) == [
+            "record_0",
+            "record_2",
+        ]
+        assert self._get_allowed_records(_role()) == ["record_0", "record_1", "record_2"]
+
+    def test_permission_restrictions_take_precedence(self):
+        first, second, third = self.records
+        role_data = {
+            **_role(first.pk, second.pk),
+            "permission_restrictions": {"view": {"test_model": [second.pk]}, "sync": False},
+        }
+        assert self._get_allowed_records(role_data, permission="view") == ["record_1"]
+        assert self._get_allowed_records(role_data, permission="sync") == [
+            "record_0",
+            "record_1",
+        ]
+
+    def test_user_without_role(self):
+        UserService.process_user(
+            _user_record("filtering_user", {"other_role": _role()})
+        )
+        user = User.objects.get(username="filtering_user")
+        assert not UserService.filter_allowed_app_entity_records(
+            User.objects.all(), user=user, role="test_role", app_entity_type="test_model"
+        ).exists()
+
+
+class UUIDRecord(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+
+    class Meta:
+        app_label = "tests"
+
+
+class TestAllowedRecordsIdentifierTypes:
+    def _get_allowed_records(self, queryset, identifiers, identifier_attr):
+        user = User.objects.create(username="typed_user")
+        UserRole.objects.create(
+            user=user, role="test_role", app_entities_restrictions={"test_model": identifiers}
+        )
+        return queryset.filter(
+            UserRoleEntityRestriction.get_allowed_records_condition(
+                user=user,
+                role="test_role",
+                app_entity_type="test_model",
+                identifier_attr=identifier_attr,
+                model=queryset.model,
+            )
+        )
+
+    def test_string_identifiers(self):
+        for username in ("record_a", "record_b"):
+            User.objects.create(username=username)
+
+        allowed_records = self._get_allowed_records(
+            User.objects.filter(username__startswith="record_"), ["record_b"], "username"
+        )
+        assert list(allowed_records.values_list("username", flat=True)) == ["record_b"]
+
+    @pytest.mark.django_db(transaction=True)
+    def test_uuid_identifiers(self):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(UUIDRecord)
+        try:
+            # The first record is not allowed
+            UUIDRecord.objects.create()
+            record = UUIDRecord.objects.create()
+
+            # Identifiers are compared regardless of how the database casts UUIDs
+            for identifier in (str(record.pk), record.pk.hex, str(record.pk).upper()):
+                allowed_records = self._get_allowed_records(
+                    UUIDRecord.objects.all(), [identifier], "id"
+                )
+                assert list(allowed_records) == [record]
+                User.objects.filter(username="typed_user").delete()
+        finally:
+            with connection.schema_editor() as schema_editor:
+                schema_editor.delete_model(UUIDRecord)
+
+
+class TestUsernameIndex:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        cache.clear()
+        self.username_index = UsernameIndex(ttl=None)
+        with mock.patch(
+            "idp_user.services.user.get_username_index", return_value=self.username_index
+        ), mock.patch(
+            "idp_user.services.username_index.get_username_index",
+            return_value=self.username_index,
+        ):
+            yield
+
+    def test_unknown_users_do_not_query_the_tenants(self):
+        UserService.load_username_index()
+        with CaptureQueriesContext(connection) as queries:
+            UserService.verify_if_user_exists_and_delete_roles({"username": "unknown_user"})
+        assert len(queries) == 0
+
+    def test_roles_of_known_users_are_deleted(self):
+        UserService.load_username_index()
+        UserService.process_user(_user_record("known_user", {"test_role": _role(1)}))
+        assert self.username_index.contains("default", "known_user")
+
+        UserService.verify_if_user_exists_and_delete_roles({"username": "known_user"})
+        assert not UserRole.objects.filter(user__username="known_user").exists()
+
+    def test_tenants_are_loaded_when_first_checked(self):
+        User.objects.create(username="existing_user")
+        UserRole.objects.create(user=User.objects.get(username="existing_user"), role="test_role")
+
+        UserService.verify_if_user_exists_and_delete_roles({"username": "existing_user"})
+        assert self.username_index.is_loaded("default")
+        assert not UserRole.objects.filter(user__username="existing_user").exists()
+
+    def test_roles_of_users_created_outside_the_user_updates_are_deleted(self):
+        UserService.load_username_index()
+        user = User.objects.create(username="admin_user")
+        UserRole.objects.create(user=user, role="test_role")
+
+        UserService.verify_if_user_exists_and_delete_roles({"username": "admin_user"})
+        assert not UserRole.objects.filter(user=user).exists()
+
+    def test_users_created_by_other_processes_cause_a_reload(self):
+        UserService.load_username_index()
+        # Created by another process, which does not update the index of this one
+        with mock.patch(
+            "idp_user.services.username_index.get_username_index",
+            return_value=UsernameIndex(),
+        ):
+            user = User.objects.create(username="other_process_user")
+        UserRole.objects.create(user=user, role="test_role")
+        assert self.username_index.contains("default", "other_process_user") is False
+
+        UserService.verify_if_user_exists_and_delete_roles({"username": "other_process_user"})
+        assert not UserRole.objects.filter(user=user).exists()
+
+    def test_creations_of_this_process_do_not_cause_a_reload(self):
+        UserService.load_username_index()
+        UserService.process_users([_user_record("batch_user", {"test_role": _role(1)})])
+        UserService.process_user(_user_record("single_user", {"test_role": _role(1)}))
+
+        with CaptureQueriesContext(connection) as queries:
+            UserService.verify_if_user_exists_and_delete_roles({"username": "unknown_user"})
+        assert len(queries) == 0
@@ -0,0 +1,250 @@
+import asyncio
+import time
+from unittest import mock
+
+import pytest
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from idp_user.models import User
+from idp_user.utils.caches import LRUCache
+from idp_user.utils.functions import (
+    _MISS,
+    _read_user_service_cache_entry,
+    cache_user_service_results,
+    increment_user_cache_generation,
+    update_changed_fields,
+    update_record,
+)
+from idp_user.utils.serializers import JSONSerializer, PackedSerializer
+
+
+class TestCacheUserServiceResults:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        cache.clear()
+        self.user = User(username="cached_user")
+        self.calls = []
+
+        def get_identifiers(user, app_entity_type):
+            self.calls.append(app_entity_type)
+            return [1, 2]
+
+        with mock.patch.dict(settings.IDP_USER_APP, {"USE_REDIS_CACHE": True}):
+            self.get_identifiers = cache_user_service_results(get_identifiers)
+            yield
+
+    def test_results_are_cached(self):
+        assert self.get_identifiers(user=self.user, app_entity_type="test_model") == [1, 2]
+        assert self.get_identifiers(user=self.user, app_entity_type="test_model") == [1, 2]
+        assert self.calls == ["test_model"]
+
+    def test_increment_generation_invalidates_entries_of_the_user(self):
+        other_user = User(username="other_user")
+        self.get_identifiers(user=self.user, app_entity_type="test_model")
+        self.get_identifiers(user=other_user, app_entity_type="test_model")
+
+        increment_user_cache_generation(self.user.username)
+        self.get_identifiers(user=self.user, app_entity_type="test_model")
+        self.get_identifiers(user=other_user, app_entity_type="test_model")
+        assert len(self.calls) == 3
+
+    def test_evicted_generation_does_not_reuse_old_entries(self):
+        self.get_identifiers(user=self.user, app_entity_type="test_model")
+        cache.delete(f"{settings.IDP_USER_APP['APP_IDENTIFIER']}-cached_user-generation")
+
+        increment_user_cache_generation(self.user.username)
+        self.get_identifiers(user=self.user, app_entity_type="test_model")
+        assert len(self.calls) == 2
+
+    def test_empty_results_are_cached_with_the_negative_ttl(self):
+        def get_no_identifiers(user, app_entity_type):
+            self.calls.append(app_entity_type)
+            return []
+
+        with mock.patch.dict(
+            settings.IDP_USER_APP,
+            {"USER_SERVICE_CACHE": {"TTL": 600, "NEGATIVE_TTL": 30}},
+        ), mock.patch.object(cache, "set", wraps=cache.set) as cache_set:
+            get_no_identifiers = cache_user_service_results(get_no_identifiers)
+            assert get_no_identifiers(user=self.user, app_entity_type="test_model") == []
+            assert get_no_identifiers(user=self.user, app_entity_type="test_model") == []
+            self.get_identifiers(user=self.user, app_entity_type="test_model")
+
+        assert self.calls == ["test_model", "test_model"]
+        timeouts = [call.kwargs["timeout"] for call in cache_set.call_args_list]
+        assert timeouts == [30, 600]
+
+    def test_entries_are_recomputed_early_close_to_their_expiration(self):
+        # Took 1 second to compute, expires in 0.5 seconds
+        entry = (
+            "idp_user.utils.serializers.JSONSerializer",
+            b"-[1, 2]",
+            1.0,
+            time.time() + 0.5,
+        )
+
+        with mock.patch("idp_user.utils.functions.random.random", return_value=0.5):
+            assert _read_user_service_cache_entry(entry) is _MISS
+            with mock.patch.dict(
+                settings.IDP_USER_APP,
+                {"USER_SERVICE_CACHE": {"EARLY_EXPIRATION_BETA": 0}},
+            ):
+                assert _read_user_service_cache_entry(entry) == [1, 2]
+
+    def test_results_are_stored_with_the_configured_serializer(self):
+        with mock.patch(
+            "idp_user.utils.functions.get_user_service_cache_serializer",
+            return_value=PackedSerializer(),
+        ):
+            self.get_identifiers(user=self.user, app_entity_type="test_model")
+            assert self.get_identifiers(
+                user=self.user, app_entity_type="test_model"
+            ) == frozenset({1, 2})
+        assert len(self.calls) == 1
+
+    def test_entries_of_another_serializer_are_recomputed(self):
+        self.get_identifiers(user=self.user, app_entity_type="test_model")
+        with mock.patch(
+            "idp_user.utils.functions.get_user_service_cache_serializer",
+            return_value=PackedSerializer(),
+        ):
+            assert self.get_identifiers(user=self.user, app_entity_type="test_model") == [1, 2]
+        assert len(self.calls) == 2
+
+    def test_entries_that_cannot_be_decoded_are_recomputed(self):
+        self.get_identifiers(user=self.user, app_entity_type="test_model")
+        with mock.patch.object(
+            PackedSerializer, "serializer_id", JSONSerializer().serializer_id
+        ), mock.patch(
+            "idp_user.utils.functions.get_user_service_cache_serializer",
+            return_value=PackedSerializer(),
+        ):
+            assert self.get_identifiers(user=self.user, app_entity_type="test_model") == [1, 2]
+        assert len(self.calls) == 2
+
+    def test_l1_cache_avoids_shared_cache_round_trips(self):
+        with mock.patch(
+            "idp_user.utils.functions.get_user_service_l1_cache",
+            return_value=LRUCache(ttl=5),
+        ):
+            self.get_identifiers(user=self.user, app_entity_type="test_model")
+            with mock.patch.object(cache, "get", wraps=cache.get) as cache_get:
+                assert self.get_identifiers(user=self.user, app_entity_type="test_model") == [1, 2]
+            cache_get.assert_not_called()
+
+            increment_user_cache_generation(self.user.username)
+            self.get_identifiers(user=self.user, app_entity_type="test_model")
+        assert len(self.calls) == 2
+
+    def test_l1_cache_results_cannot_be_changed_by_the_callers(self):
+        with mock.patch(
+            "idp_user.utils.functions.get_user_service_l1_cache",
+            return_value=LRUCache(ttl=5),
+        ):
+            self.get_identifiers(user=self.user, app_entity_type="test_model").append(3)
+            self.get_identifiers(user=self.user, app_entity_type="test_model").append(4)
+            assert self.get_identifiers(user=self.user, app_entity_type="test_model") == [1, 2]
+        assert len(self.calls) == 1
+
+
+class TestCacheUserServiceResultsAsync:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        cache.clear()
+        self.user = User(username="cached_user")
+        self.calls = []
+
+        async def get_identifiers(user, app_entity_type):
+            self.calls.append(app_entity_type)
+            await asyncio.sleep(0.01)
+            return [1, 2]
+
+        with mock.patch.dict(settings.IDP_USER_APP, {"USE_REDIS_CACHE": True}):
+            self.get_identifiers = cache_user_service_results(get_identifiers)
+            yield
+
+    def test_concurrent_lookups_are_computed_once_and_cached(self):
+        async def lookup():
+            return await self.get_identifiers(user=self.user, app_entity_type="test_model")
+
+        async def lookups():
+            concurrent_results = await asyncio.gather(lookup(), lookup(), lookup())
+            return concurrent_results, await lookup()
+
+        concurrent_results, cached_result = asyncio.run(lookups())
+        assert concurrent_results == [[1, 2]] * 3
+        assert cached_result == [1, 2]
+        assert self.calls == ["test_model"]
+
+    def test_waiting_lookups_are_not_cancelled_with_the_computing_one(self):
+        calls = []
+
+        @cache_user_service_results
+        async def get_identifiers(user, app_entity_type):
+            calls.append(app_entity_type)
+            if len(calls) == 1:
+                # The first computation never completes, until it is cancelled
+                await asyncio.Event().wait()
+            return [1, 2]
+
+        async def lookups():
+            leader = asyncio.ensure_future(
+                get_identifiers(user=self.user, app_entity_type="test_model")
+            )
+            while not calls:
+                await asyncio.sleep(0.001)
+            follower = asyncio.ensure_future(
+                get_identifiers(user=self.user, app_entity_type="test_model")
+            )
+            await asyncio.sleep(0.05)
+            assert not follower.done()
+
+            leader.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await leader
+            return await follower
+
+        with mock.patch.dict(settings.IDP_USER_APP, {"USE_REDIS_CACHE": True}):
+            assert asyncio.run(lookups()) == [1, 2]
+        # The waiting lookup computed the result itself
+        assert calls == ["test_model", "test_model"]
+
+
+class TestUpdateChangedFields:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.user = User.objects.create(
+            username="updated_user",
+            first_name="First",
+            date_joined="2024-01-01T00:00:00+00:00",
+        )
+        self.user.refresh_from_db()
+
+    def test_unchanged_values_are_not_saved(self):
+        with CaptureQueriesContext(connection) as queries:
+            changed_fields = update_changed_fields(
+                self.user,
+                first_name="First",
+                # Compared as the datetime it is loaded as
+                date_joined="2024-01-01T00:00:00+00:00",
+            )
+
+        assert changed_fields == []
+        assert len(queries) == 0
+
+    def test_only_changed_fields_are_saved(self):
+        User.objects.filter(pk=self.user.pk).update(last_name="Concurrent")
+
+        assert update_changed_fields(self.user, first_name="Changed", last_name="") == [
+            "first_name"
+        ]
+
+        self.user.refresh_from_db()
+        assert (self.user.first_name, self.user.last_name) == ("Changed", "Concurrent")
+
+    def test_update_record_returns_the_record(self):
+        assert update_record(self.user, first_name="Changed") is self.user
+        assert User.objects.get(pk=self.user.pk).first_name == "Changed"
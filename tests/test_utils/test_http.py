@@ -0,0 +1,55 @@
+import asyncio
+import threading
+
+from asgiref.sync import async_to_sync
+
+from idp_user.utils.http import (
+    _async_sessions,
+    close_idp_async_session,
+    get_idp_async_session,
+    get_idp_session,
+)
+
+
+def test_sync_sessions_are_reused_per_thread():
+    session = get_idp_session()
+    assert get_idp_session() is session
+
+    other_thread_sessions = []
+    thread = threading.Thread(target=lambda: other_thread_sessions.append(get_idp_session()))
+    thread.start()
+    thread.join()
+    assert other_thread_sessions[0] is not session
+
+
+def test_async_sessions_are_reused_per_event_loop():
+    async def get_sessions():
+        return await get_idp_async_session(), await get_idp_async_session()
+
+    session, same_session = asyncio.run(get_sessions())
+    assert session is same_session
+
+    other_session, _ = asyncio.run(get_sessions())
+    assert other_session is not session
+
+
+def test_async_sessions_are_closed_with_their_event_loop():
+    session = asyncio.run(get_idp_async_session())
+    assert session.closed
+    assert not _async_sessions
+
+    session = async_to_sync(get_idp_async_session)()
+    assert session.closed
+    assert not _async_sessions
+
+
+def test_async_sessions_can_be_closed_before_their_event_loop():
+    async def close_session():
+        session = await get_idp_async_session()
+        await close_idp_async_session()
+        return session, await get_idp_async_session()
+
+    session, new_session = asyncio.run(close_session())
+    assert session.closed
+    assert new_session is not session
+    assert new_session.closed
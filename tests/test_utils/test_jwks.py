@@ -0,0 +1,69 @@
+import json
+import time
+from unittest import mock
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+
+from idp_user.utils.functions import authorize_request_locally
+from idp_user.utils.jwks import JWKSClient
+
+
+def _generate_key(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({"kid": kid, "alg": "RS256", "use": "sig"})
+    return private_key, jwk
+
+
+def _encode(private_key, kid, **claims):
+    payload = {"username": "test_user", "exp": int(time.time()) + 60, **claims}
+    return jwt.encode(payload, private_key, algorithm="RS256", headers={"kid": kid})
+
+
+class TestLocalTokenValidation:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.private_key, jwk = _generate_key("key-1")
+        self.jwks = {"keys": [jwk]}
+        self.client = JWKSClient(url="http://idp.test/jwks", min_refresh_interval=0)
+
+        with mock.patch.object(
+            self.client, "fetch_jwks", side_effect=lambda: self.jwks
+        ) as self.fetch_jwks, mock.patch(
+            "idp_user.utils.functions.get_jwks_client", return_value=self.client
+        ), mock.patch(
+            "idp_user.utils.functions.get_local_token_validation_config", return_value={}
+        ):
+            yield
+
+    def test_valid_token_fetches_keys_once(self):
+        token = _encode(self.private_key, "key-1")
+
+        assert authorize_request_locally(token) is None
+        assert authorize_request_locally(token) is None
+        assert self.fetch_jwks.call_count == 1
+
+    def test_expired_token(self):
+        token = _encode(self.private_key, "key-1", exp=int(time.time()) - 60)
+        assert "expired" in authorize_request_locally(token)
+
+    def test_not_yet_valid_token(self):
+        token = _encode(self.private_key, "key-1", nbf=int(time.time()) + 60)
+        assert authorize_request_locally(token) is not None
+
+    def test_token_signed_with_another_key(self):
+        other_private_key, _ = _generate_key("key-1")
+        token = _encode(other_private_key, "key-1")
+        assert authorize_request_locally(token) is not None
+
+    def test_unknown_kid_refreshes_keys(self):
+        assert authorize_request_locally(_encode(self.private_key, "key-1")) is None
+
+        rotated_private_key, rotated_jwk = _generate_key("key-2")
+        self.jwks = {"keys": [rotated_jwk]}
+
+        assert authorize_request_locally(_encode(rotated_private_key, "key-2")) is None
+        assert self.fetch_jwks.call_count == 2
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from idp_user.utils.lanes import OrderedLanes, get_lane
+
+
+def test_get_lane_is_stable():
+    assert get_lane("user", 4) == get_lane("user", 4)
+    assert all(0 <= get_lane(f"user_{i}", 4) < 4 for i in range(100))
+
+
+def test_items_with_the_same_key_are_processed_in_order():
+    processed = []
+
+    async def process(item):
+        key, index = item
+        # Later items of other keys may complete first
+        await asyncio.sleep(0.001 * (index % 3))
+        processed.append(item)
+
+    async def run():
+        async with OrderedLanes(process, concurrency=4, max_in_flight=8) as lanes:
+            for index in range(60):
+                key = f"user_{index % 6}"
+                await lanes.submit(key, (key, index))
+            await lanes.join()
+
+    asyncio.run(run())
+
+    assert len(processed) == 60
+    for user in range(6):
+        indexes = [index for key, index in processed if key == f"user_{user}"]
+        assert indexes == sorted(indexes)
+
+
+def test_items_of_different_lanes_are_processed_concurrently():
+    running = 0
+    max_running = 0
+
+    async def process(item):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    keys = ["a", "b", "c", "d", "e", "f", "g", "h"]
+    lanes_count = len({get_lane(key, 4) for key in keys})
+
+    async def run():
+        async with OrderedLanes(process, concurrency=4) as lanes:
+            for key in keys:
+                await lanes.submit(key, key)
+            await lanes.join()
+
+    asyncio.run(run())
+
+    assert max_running == lanes_count > 1
+
+
+def test_submit_waits_while_the_lane_is_full():
+    release = None
+
+    async def process(item):
+        await release.wait()
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        async with OrderedLanes(process, concurrency=1, max_in_flight=2) as lanes:
+            for item in range(3):
+                # The first item is being processed, the next two fill the lane
+                await lanes.submit("key", item)
+            submit = asyncio.ensure_future(lanes.submit("key", 3))
+            await asyncio.sleep(0.01)
+            assert not submit.done()
+
+            release.set()
+            await submit
+            await lanes.join()
+
+    asyncio.run(run())
+
+
+def test_the_error_of_a_lane_is_raised():
+    async def process(item):
+        raise ValueError(item)
+
+    async def run():
+        async with OrderedLanes(process, concurrency=1, max_in_flight=1) as lanes:
+            await lanes.submit("key", "first")
+            await lanes.join()
+
+    with pytest.raises(ValueError, match="first"):
+        asyncio.run(run())
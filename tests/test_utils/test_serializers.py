@@ -0,0 +1,44 @@
+import pytest
+
+from idp_user.utils.serializers import (
+    JSONSerializer,
+    MsgpackSerializer,
+    PackedSerializer,
+)
+
+
+@pytest.mark.parametrize("value", [[1, 2], [], "all", ["a", "b"]])
+def test_json_serializer_round_trip(value):
+    serializer = JSONSerializer()
+    assert serializer.loads(serializer.dumps(value)) == value
+
+
+def test_packed_serializer_loads_integers_as_frozenset():
+    serializer = PackedSerializer()
+    data = serializer.dumps([3, 1, 2])
+
+    assert len(data) == 2 + 3 * 8
+    assert serializer.loads(data) == frozenset({1, 2, 3})
+
+
+@pytest.mark.parametrize("value", ["all", ["a", "b"], [True, 1], [2**64]])
+def test_packed_serializer_falls_back_to_json(value):
+    serializer = PackedSerializer()
+    assert serializer.loads(serializer.dumps(value)) == value
+
+
+def test_payloads_are_compressed_above_the_threshold():
+    serializer = PackedSerializer(compression_threshold=100)
+    identifiers = list(range(1000))
+
+    data = serializer.dumps(identifiers)
+    assert len(data) < 1000 * 8
+    assert serializer.loads(data) == frozenset(identifiers)
+    assert serializer.dumps([1]).startswith(b"-")
+
+
+def test_msgpack_serializer_round_trip():
+    pytest.importorskip("msgpack")
+    serializer = MsgpackSerializer()
+    assert serializer.loads(serializer.dumps([1, 2])) == (1, 2)
+    assert serializer.loads(serializer.dumps("all")) == "all"
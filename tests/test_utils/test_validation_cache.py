@@ -0,0 +1,62 @@
+import time
+from unittest import mock
+
+import jwt
+import pytest
+from django.test import RequestFactory
+
+from idp_user.utils.caches import ValidationResultCache
+from idp_user.utils.functions import authorize_request_with_idp
+
+
+def _response(status_code, detail=None):
+    response = mock.MagicMock(status_code=status_code, ok=status_code < 400)
+    response.json.return_value = {"detail": detail}
+    return response
+
+
+class TestValidationResultCache:
+    token = jwt.encode({"username": "test_user", "exp": int(time.time()) + 60}, "secret")
+
+    @pytest.fixture(autouse=True, params=["local", "django"])
+    def setup(self, request):
+        self.validation_cache = ValidationResultCache(backend=request.param)
+        self.validation_cache._django_cache.clear()
+        with mock.patch(
+            "idp_user.utils.functions.get_validation_cache",
+            return_value=self.validation_cache,
+        ), mock.patch("idp_user.utils.functions.idp_request") as self.idp_request:
+            yield
+
+    def _authorize(self, path="/api/vehicles/", tenant="tenant_1"):
+        request = RequestFactory().get(path, HTTP_X_TENANT=tenant)
+        return authorize_request_with_idp(request, self.token)
+
+    def test_successful_validation_is_cached_per_request_shape(self):
+        self.idp_request.return_value = _response(200)
+
+        assert self._authorize() is None
+        assert self._authorize() is None
+        assert self.idp_request.call_count == 1
+
+        assert self._authorize(tenant="tenant_2") is None
+        assert self.idp_request.call_count == 2
+        assert self.validation_cache.stats() == {"hits": 1, "misses": 2}
+
+    def test_rejection_is_cached(self):
+        self.idp_request.return_value = _response(403, "Forbidden")
+
+        assert self._authorize() == "Forbidden"
+        assert self._authorize() == "Forbidden"
+        assert self.idp_request.call_count == 1
+
+    def test_idp_errors_are_not_cached(self):
+        self.idp_request.return_value = _response(502, "Bad Gateway")
+
+        self._authorize()
+        self._authorize()
+        assert self.idp_request.call_count == 2
+
+    def test_entries_do_not_outlive_the_token(self):
+        expired_token = jwt.encode({"exp": int(time.time()) - 1}, "secret")
+        assert self.validation_cache._get_timeout(expired_token, error=None) is None